@@ -4,24 +4,46 @@ CSM Speech Generator - A web UI for the CSM text-to-speech model
 """
 
 import os
+import threading
 import time
-import numpy as np
-import torch
-import torchaudio
+from dataclasses import asdict
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_file
-import mlx.core as mx
-from mlx_lm.sample_utils import make_sampler
-from huggingface_hub import hf_hub_download
-from csm_mlx import CSM, csm_1b, generate, Segment
+from flask import Flask, Response, render_template, request, jsonify, send_file
+from csm_mlx import load_csm
+from csm_mlx.audio_io import SAMPLE_RATE, wav_header
+from csm_mlx.audio_stream import AudioStream
+from csm_mlx.jobs import JobStore, TooManyJobs
+from csm_mlx.loading import weights_identity
+from csm_mlx.result_cache import CachedScheduler, ResultCache
+from csm_mlx.scheduler import BatchScheduler
+from csm_mlx.worker_pool import WorkerPool
 from csm_mlx.voice_presets import get_presets_by_category, get_preset_by_name, BASIC_VOICES
+from audio_store import AudioStore
+from compiled_voices import CompiledVoiceStore, PresetSpeechRequest, PresetVoiceScheduler
 
 app = Flask(__name__)
 
 # Global variables for model and configuration
 model = None
-output_dir = "static/audio"  # For browser playback
-downloads_dir = "outputs"    # For downloads
+load_stats = None
+scheduler = None
+cached_scheduler = None
+voice_scheduler = None
+jobs = None
+scheduler_lock = threading.Lock()
+output_dir = "static/audio"  # Generated files, for playback and download
+downloads_dir = "outputs"    # Downloads saved before both URLs shared one file
+
+# Generated audio, named by content and kept within a size and age quota.
+# Files used by voice preset samples are never removed.
+audio_store = AudioStore(
+    output_dir,
+    max_bytes=int(os.environ.get('CSM_AUDIO_MAX_MB', 2048)) << 20,
+    max_age_seconds=float(os.environ.get('CSM_AUDIO_MAX_AGE_DAYS', 30)) * 86400,
+    # 16-bit WAV, or FLAC (needs soundfile) for about half the size again
+    audio_format=os.environ.get('CSM_AUDIO_FORMAT', 'wav').lower(),
+    referenced=lambda: voice_db.get_sample_audio_paths()
+)
 
 # Create directories
 os.makedirs(output_dir, exist_ok=True)
@@ -29,16 +51,60 @@ os.makedirs(downloads_dir, exist_ok=True)
 
 def get_model():
     """Load the model once and reuse it for multiple requests"""
-    global model
+    global model, load_stats
     if model is None:
         print("Initializing CSM model...")
-        start_time = time.time()
-        model = CSM(csm_1b())
-        weight = hf_hub_download(repo_id="senstella/csm-1b-mlx", filename="ckpt.safetensors")
-        model.load_weights(weight)
-        print(f"Model loaded in {time.time() - start_time:.2f} seconds")
+        model, load_stats = load_csm(os.environ.get('CSM_MODEL'))
+        print(f"Model loaded in {load_stats}")
     return model
 
+def get_scheduler():
+    """
+    Start the batch scheduler once; all /generate requests share its batch.
+    With CSM_WORKERS set, a pool of that many model processes is started
+    instead, each running its own batch, and this process never loads the model.
+    Repeated seeded requests are answered from a result cache in front of it,
+    and requests for a voice preset get its compiled voice before that.
+    """
+    global scheduler, cached_scheduler, voice_scheduler
+    with scheduler_lock:
+        if scheduler is None:
+            max_batch_size = int(os.environ.get('CSM_MAX_BATCH', 8))
+            workers = int(os.environ.get('CSM_WORKERS', 0))
+            if workers > 0:
+                scheduler = WorkerPool(workers, model_path=os.environ.get('CSM_MODEL'), max_batch_size=max_batch_size)
+            else:
+                scheduler = BatchScheduler(get_model(), max_batch_size=max_batch_size)
+            
+            # Set CSM_RESULT_CACHE_DIR to an empty string to keep results in memory only
+            result_cache = ResultCache(
+                max_memory_bytes=int(os.environ.get('CSM_RESULT_CACHE_MB', 256)) << 20,
+                directory=os.environ.get('CSM_RESULT_CACHE_DIR', 'cache/results') or None,
+                max_disk_bytes=int(os.environ.get('CSM_RESULT_CACHE_DISK_MB', 1024)) << 20
+            )
+            cached_scheduler = CachedScheduler(scheduler, result_cache, weights_identity(os.environ.get('CSM_MODEL')))
+            voice_scheduler = PresetVoiceScheduler(cached_scheduler, compiled_voices, preset_reference)
+    return voice_scheduler
+
+def get_jobs():
+    """The job store behind the /jobs endpoints"""
+    global jobs
+    job_scheduler = get_scheduler()
+    with scheduler_lock:
+        if jobs is None:
+            jobs = JobStore(
+                job_scheduler,
+                max_jobs=int(os.environ.get('CSM_MAX_JOBS', 1000)),
+                retention_seconds=float(os.environ.get('CSM_JOB_RETENTION', 3600))
+            )
+    return jobs
+
+def scheduler_ready():
+    """Whether /generate can start work right away"""
+    if scheduler is None:
+        return False
+    return scheduler.ready if isinstance(scheduler, WorkerPool) else True
+
 @app.route('/')
 def index():
     """Render the main page"""
@@ -59,11 +125,64 @@ def get_voices():
 # New endpoints for voice preset database
 from voice_db import VoicePreset, db as voice_db
 
+# Each preset's first sample compiled into Mimi codes and backbone KV state,
+# saved next to the database, so generating with a preset skips both
+compiled_voices = CompiledVoiceStore(
+    os.path.join(os.path.dirname(os.path.abspath(voice_db.db_path)), 'compiled_voices'),
+    locate=audio_store.locate,
+    max_loaded=int(os.environ.get('CSM_COMPILED_VOICES', 8))
+)
+
+# Largest page the paginated list endpoints return
+MAX_PAGE_SIZE = 1000
+
+def preset_from_json(data, existing=None):
+    """VoicePreset from request JSON; missing fields are taken from `existing`, if given"""
+    if existing is None:
+        required_fields = ['name', 'speaker_id', 'temperature', 'min_p']
+        if not all(field in data for field in required_fields):
+            raise ValueError("Missing required fields")
+        existing = VoicePreset(name=None, speaker_id=None, temperature=None, min_p=None)
+    
+    return VoicePreset(
+        id=existing.id,
+        name=data.get('name', existing.name),
+        speaker_id=int(data.get('speaker_id', existing.speaker_id)),
+        temperature=float(data.get('temperature', existing.temperature)),
+        min_p=float(data.get('min_p', existing.min_p)),
+        seed=data.get('seed', existing.seed),
+        speed=float(data.get('speed', existing.speed)),
+        description=data.get('description', existing.description)
+    )
+
+def page_args():
+    """(limit, cursor) of a paginated list request; limit is None for the whole list"""
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return limit, request.args.get('cursor')
+
+def paginated(items, limit, next_cursor):
+    """JSON list response, with the next page's cursor in X-Next-Cursor and a Link header"""
+    response = jsonify(items)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = f'<{request.path}?limit={limit}&cursor={next_cursor}>; rel="next"'
+    return response
+
 @app.route('/api/presets', methods=['GET'])
 def get_all_presets():
-    """Get all saved voice presets"""
-    presets = voice_db.get_all_presets()
-    return jsonify([preset.to_dict() for preset in presets])
+    """Get saved voice presets, newest first; a page of them with ?limit= (and ?cursor=)"""
+    limit, cursor = page_args()
+    if limit is None:
+        presets = voice_db.get_all_presets()
+        return jsonify([preset.to_dict() for preset in presets])
+    
+    try:
+        presets, next_cursor = voice_db.list_presets(limit, cursor)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return paginated([preset.to_dict() for preset in presets], limit, next_cursor)
 
 @app.route('/api/presets/<int:preset_id>', methods=['GET'])
 def get_preset(preset_id):
@@ -79,19 +198,10 @@ def create_preset():
     data = request.json
     
     # Basic validation
-    required_fields = ['name', 'speaker_id', 'temperature', 'min_p']
-    if not all(field in data for field in required_fields):
-        return jsonify({"error": "Missing required fields"}), 400
-    
-    preset = VoicePreset(
-        name=data['name'],
-        speaker_id=int(data['speaker_id']),
-        temperature=float(data['temperature']),
-        min_p=float(data['min_p']),
-        seed=data.get('seed'),
-        speed=float(data.get('speed', 1.0)),
-        description=data.get('description')
-    )
+    try:
+        preset = preset_from_json(data)
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
     
     preset_id = voice_db.create_preset(preset)
     
@@ -103,6 +213,28 @@ def create_preset():
     preset.id = preset_id
     return jsonify(preset.to_dict()), 201
 
+@app.route('/api/presets/bulk', methods=['POST'])
+def create_presets():
+    """Create a list of voice presets in one transaction"""
+    data = request.json
+    if not isinstance(data, list):
+        return jsonify({"error": "Expected a list of presets"}), 400
+    
+    try:
+        presets = [preset_from_json(item) for item in data]
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # Samples included with the presets go in together, too
+    samples = [
+        (index, item['audio_path'], item['text'])
+        for index, item in enumerate(data)
+        if 'audio_path' in item and 'text' in item
+    ]
+    preset_ids = voice_db.create_presets(presets, samples)
+    
+    return jsonify({"ids": preset_ids}), 201
+
 @app.route('/api/presets/<int:preset_id>', methods=['PUT'])
 def update_preset(preset_id):
     """Update an existing preset"""
@@ -114,16 +246,10 @@ def update_preset(preset_id):
         return jsonify({"error": "Preset not found"}), 404
     
     # Update the preset
-    preset = VoicePreset(
-        id=preset_id,
-        name=data.get('name', existing.name),
-        speaker_id=int(data.get('speaker_id', existing.speaker_id)),
-        temperature=float(data.get('temperature', existing.temperature)),
-        min_p=float(data.get('min_p', existing.min_p)),
-        seed=data.get('seed', existing.seed),
-        speed=float(data.get('speed', existing.speed)),
-        description=data.get('description', existing.description)
-    )
+    try:
+        preset = preset_from_json(data, existing)
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
     
     success = voice_db.update_preset(preset)
     
@@ -133,24 +259,70 @@ def update_preset(preset_id):
     
     return jsonify(preset.to_dict())
 
+@app.route('/api/presets/bulk', methods=['PUT'])
+def update_presets():
+    """Update a list of presets (each with its "id") in one transaction"""
+    data = request.json
+    if not isinstance(data, list) or not all(isinstance(item, dict) and 'id' in item for item in data):
+        return jsonify({"error": "Expected a list of presets with IDs"}), 400
+    
+    existing = voice_db.get_presets_by_ids(item['id'] for item in data)
+    missing = [item['id'] for item in data if item['id'] not in existing]
+    if missing:
+        return jsonify({"error": "Preset not found", "ids": missing}), 404
+    
+    try:
+        presets = [preset_from_json(item, existing[item['id']]) for item in data]
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
+    
+    return jsonify({"updated": voice_db.update_presets(presets)})
+
 @app.route('/api/presets/<int:preset_id>', methods=['DELETE'])
 def delete_preset(preset_id):
     """Delete a voice preset"""
     success = voice_db.delete_preset(preset_id)
     if not success:
         return jsonify({"error": "Preset not found"}), 404
+    compiled_voices.discard(preset_id)
     return jsonify({"message": "Preset deleted successfully"})
 
 @app.route('/api/presets/<int:preset_id>/samples', methods=['GET'])
 def get_preset_samples(preset_id):
-    """Get all audio samples for a preset"""
+    """Get the audio samples for a preset, newest first; a page of them with ?limit= (and ?cursor=)"""
     # Check if preset exists
     preset = voice_db.get_preset_by_id(preset_id)
     if not preset:
         return jsonify({"error": "Preset not found"}), 404
-        
-    samples = voice_db.get_voice_samples(preset_id)
-    return jsonify(samples)
+    
+    limit, cursor = page_args()
+    if limit is None:
+        samples = voice_db.get_voice_samples(preset_id)
+        return jsonify(samples)
+    
+    try:
+        samples, next_cursor = voice_db.list_voice_samples(preset_id, limit, cursor)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return paginated(samples, limit, next_cursor)
+
+@app.route('/api/presets/export', methods=['GET'])
+def export_presets():
+    """Stream every preset and voice sample as newline-delimited JSON"""
+    return Response(
+        voice_db.export_ndjson(),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': 'attachment; filename="voice_presets.ndjson"'}
+    )
+
+@app.route('/api/presets/import', methods=['POST'])
+def import_presets():
+    """Import the presets and samples of an export, read from the request body as it arrives"""
+    try:
+        counts = voice_db.import_ndjson(request.stream)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(counts)
 
 @app.route('/api/presets/similar', methods=['GET'])
 def find_similar_presets():
@@ -172,151 +344,178 @@ def find_similar_presets():
     
     return jsonify([preset.to_dict() for preset in presets])
 
-@app.route('/generate', methods=['POST'])
-def generate_speech():
-    """Generate speech from text"""
+def parse_generation_form(form):
+    """Generation parameters from a /generate or /jobs form"""
+    text = form.get('text', 'Hello from CSM!')
+    speaker_id = form.get('speaker', '0')
+    
+    # Convert speaker ID to integer but limit to 0-9 range
     try:
-        # Get parameters from request
-        text = request.form.get('text', 'Hello from CSM!')
-        speaker_id = request.form.get('speaker', '0')
-        
-        # Convert speaker ID to integer but limit to 0-9 range
+        speaker = int(speaker_id) % 10  # Enforce range 0-9
+    except ValueError:
+        speaker = 0
+    
+    temperature = float(form.get('temperature', 0.7))
+    min_p = float(form.get('min_p', 0.05))
+    max_duration = int(form.get('max_duration', 30000))  # Default to 30 seconds
+    
+    # Get random seed if provided to ensure consistent results
+    seed = form.get('seed')
+    seed_value = None
+    
+    if seed:
         try:
-            speaker = int(speaker_id) % 10  # Enforce range 0-9
+            seed_value = int(seed)
+            print(f"Using seed: {seed_value}")
         except ValueError:
-            speaker = 0
-        
-        temperature = float(request.form.get('temperature', 0.7))
-        min_p = float(request.form.get('min_p', 0.05))
-        max_duration = int(request.form.get('max_duration', 30000))  # Default to 30 seconds
-        
-        # Get random seed if provided to ensure consistent results
-        seed = request.form.get('seed')
-        seed_value = None
-        
-        if seed:
-            try:
-                seed_value = int(seed)
-                # Set random seed for consistent generation
-                mx.random.seed(seed_value)
-                print(f"Using seed: {seed_value}")
-            except ValueError:
-                print(f"Invalid seed provided: {seed}, using random seed")
-        else:
-            # If no seed provided, let's generate a random one for reproducibility
-            seed_value = int(time.time()) % 1000000
-            mx.random.seed(seed_value)
-            print(f"No seed provided, using random seed: {seed_value}")
-        
-        # Generate unique filenames
-        timestamp = int(time.time())
-        web_filename = f"speech_{timestamp}_speaker_{speaker}.wav"
-        download_filename = f"speech_{timestamp}_speaker_{speaker}.wav"
-        
-        web_path = os.path.join(output_dir, web_filename)
-        download_path = os.path.join(downloads_dir, download_filename)
-        
-        # Get the model
-        csm = get_model()
-        
-        # Ensure text ends with punctuation for better speech quality
-        if text and not text[-1] in ['.', '!', '?', ',', ';', ':', '-']:
-            text += '.'
-        
-        # Generate audio - always use max allowed length to ensure full text is generated
-        start_time = time.time()
-        
-        audio = generate(
-            csm,
-            text=text,
-            speaker=speaker,
-            context=[],
-            max_audio_length_ms=max_duration,
-            sampler=make_sampler(temp=temperature, min_p=min_p),
+            print(f"Invalid seed provided: {seed}, using random seed")
+    else:
+        # If no seed provided, let's generate a random one for reproducibility
+        seed_value = int(time.time()) % 1000000
+        print(f"No seed provided, using random seed: {seed_value}")
+    
+    # Voice preset whose reference sample the speech continues, if any
+    preset_id = form.get('preset_id')
+    try:
+        preset_id = int(preset_id) if preset_id else None
+    except ValueError:
+        print(f"Invalid preset_id provided: {preset_id}, ignoring")
+        preset_id = None
+    
+    # Ensure text ends with punctuation for better speech quality
+    if text and not text[-1] in ['.', '!', '?', ',', ';', ':', '-']:
+        text += '.'
+    
+    return {
+        'text': text,
+        'speaker': speaker,
+        'temperature': temperature,
+        'min_p': min_p,
+        'max_duration': max_duration,
+        'seed': seed_value,
+        'auto_save': form.get('auto_save') == 'true',
+        'preset_id': preset_id,
+    }
+
+def preset_reference(preset_id):
+    """A preset and the sample its compiled voice is made from; None if it has no sample"""
+    preset = voice_db.get_preset_by_id(preset_id)
+    sample = voice_db.get_reference_sample(preset_id) if preset else None
+    return (preset, sample) if sample else None
+
+def speech_request(params):
+    """The scheduler request for parsed generation parameters; its preset's voice is resolved by the scheduler"""
+    return PresetSpeechRequest(
+        text=params['text'],
+        speaker=params['speaker'],
+        max_audio_length_ms=params['max_duration'],
+        temperature=params['temperature'],
+        min_p=params['min_p'],
+        seed=params['seed'],
+        preset_id=params['preset_id'],
+    )
+
+def save_generation(audio, params, generation_time):
+    """Write the generated audio, auto-save its voice preset if asked, and build the response"""
+    text = params['text']
+    speaker = params['speaker']
+    temperature = params['temperature']
+    min_p = params['min_p']
+    seed_value = params['seed']
+    
+    # Written once, under the hash of its contents; /static/audio and /download both serve this file
+    web_filename = audio_store.put(audio, SAMPLE_RATE)
+    web_path = audio_store.path(web_filename)
+    # The name browsers save the download as
+    download_filename = f"speech_{int(time.time())}_speaker_{speaker}.{audio_store.audio_format}"
+    
+    # Calculate audio duration
+    audio_duration = len(audio) / SAMPLE_RATE
+    
+    # Auto-save this voice preset if requested
+    preset_id = None
+    if params['auto_save']:
+        # Check if similar preset exists
+        similar_presets = voice_db.find_similar_preset(
+            speaker_id=speaker,
+            temperature=temperature,
+            min_p=min_p,
+            seed=str(seed_value) if seed_value else None
         )
         
-        generation_time = time.time() - start_time
-        
-        # Convert to numpy and save
-        audio_array = np.asarray(audio)
-        
-        # Save for web playback
-        torchaudio.save(web_path, torch.Tensor(audio_array).unsqueeze(0).cpu(), 24_000)
-        
-        # Save for download (same file for now, but could be different format if needed)
-        torchaudio.save(download_path, torch.Tensor(audio_array).unsqueeze(0).cpu(), 24_000)
-        
-        # Calculate audio duration
-        audio_duration = len(audio) / 24000  # 24kHz sample rate
-        
-        # Auto-save this voice preset if requested
-        preset_id = None
-        if request.form.get('auto_save') == 'true':
-            # Check if similar preset exists
-            similar_presets = voice_db.find_similar_preset(
+        if similar_presets:
+            # Use the first similar preset
+            preset_id = similar_presets[0].id
+            
+            # Add this generation as a sample
+            voice_db.add_voice_sample(
+                preset_id=preset_id,
+                audio_path=web_path,
+                text=text
+            )
+        else:
+            # Create a new preset
+            preset_name = f"Voice {speaker} (T:{temperature:.2f}, P:{min_p:.2f})"
+            if seed_value:
+                preset_name += f", S:{seed_value}"
+            
+            preset = VoicePreset(
+                name=preset_name,
                 speaker_id=speaker,
                 temperature=temperature,
                 min_p=min_p,
-                seed=str(seed_value) if seed_value else None
+                seed=str(seed_value) if seed_value else None,
+                speed=1.0,
+                description=f"Auto-saved voice from generation on {datetime.now().strftime('%Y-%m-%d %H:%M')}"
             )
             
-            if similar_presets:
-                # Use the first similar preset
-                preset_id = similar_presets[0].id
-                
-                # Add this generation as a sample
-                voice_db.add_voice_sample(
-                    preset_id=preset_id,
-                    audio_path=web_path,
-                    text=text
-                )
-            else:
-                # Create a new preset
-                preset_name = f"Voice {speaker} (T:{temperature:.2f}, P:{min_p:.2f})"
-                if seed_value:
-                    preset_name += f", S:{seed_value}"
-                
-                preset = VoicePreset(
-                    name=preset_name,
-                    speaker_id=speaker,
-                    temperature=temperature,
-                    min_p=min_p,
-                    seed=str(seed_value) if seed_value else None,
-                    speed=1.0,
-                    description=f"Auto-saved voice from generation on {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-                )
-                
-                preset_id = voice_db.create_preset(preset)
-                
-                # Add this generation as the first sample
-                voice_db.add_voice_sample(
-                    preset_id=preset_id,
-                    audio_path=web_path,
-                    text=text
-                )
-        
-        response = {
-            'success': True,
-            'message': 'Speech generated successfully',
-            'audio_path': f"/static/audio/{web_filename}",
-            'download_path': f"/download/{download_filename}",
-            'filename': download_filename,
-            'duration': f"{audio_duration:.2f}",
-            'generation_time': f"{generation_time:.2f}",
-            'real_time_factor': f"{generation_time / audio_duration:.2f}" if audio_duration > 0 else "0.0",
-            'voice_parameters': {
-                'speaker': speaker,
-                'temperature': temperature,
-                'min_p': min_p,
-                'seed': seed_value
-            }
+            preset_id = voice_db.create_preset(preset)
+            
+            # Add this generation as the first sample
+            voice_db.add_voice_sample(
+                preset_id=preset_id,
+                audio_path=web_path,
+                text=text
+            )
+    
+    response = {
+        'success': True,
+        'message': 'Speech generated successfully',
+        'audio_path': f"/static/audio/{web_filename}",
+        'download_path': f"/download/{web_filename}",
+        'filename': download_filename,
+        'duration': f"{audio_duration:.2f}",
+        'generation_time': f"{generation_time:.2f}",
+        'real_time_factor': f"{generation_time / audio_duration:.2f}" if audio_duration > 0 else "0.0",
+        'voice_parameters': {
+            'speaker': speaker,
+            'temperature': temperature,
+            'min_p': min_p,
+            'seed': seed_value
         }
+    }
+    
+    # Add preset info if created or found
+    if preset_id:
+        response['preset_id'] = preset_id
+    
+    return response
+
+@app.route('/generate', methods=['POST'])
+def generate_speech():
+    """Generate speech from text"""
+    try:
+        params = parse_generation_form(request.form)
+        
+        # Generate audio - always use max allowed length to ensure full text is generated
+        start_time = time.time()
         
-        # Add preset info if created or found
-        if preset_id:
-            response['preset_id'] = preset_id
+        # Runs in the shared batch alongside any other in-flight requests
+        audio = get_scheduler().generate(speech_request(params))
         
-        return jsonify(response)
+        generation_time = time.time() - start_time
+        
+        return jsonify(save_generation(audio, params, generation_time))
     except Exception as e:
         import traceback
         error_traceback = traceback.format_exc()
@@ -328,19 +527,113 @@ def generate_speech():
             'error_details': error_traceback
         }), 500  # Return 500 status to clearly indicate server error
 
+@app.route('/generate/stream', methods=['POST'])
+def generate_speech_stream():
+    """Stream speech while it is generated, as WAV or (format=pcm) raw 16-bit little-endian PCM"""
+    audio_format = request.args.get('format', request.form.get('format', 'wav'))
+    if audio_format not in ('wav', 'pcm'):
+        return jsonify({'success': False, 'message': f"Unknown format: {audio_format}"}), 400
+    
+    try:
+        params = parse_generation_form(request.form)
+        stream = AudioStream(sample_rate=SAMPLE_RATE)
+        start_time = time.time()
+        # A job, so the saved files and stats can be fetched from /jobs/<id>/result afterwards
+        job = get_jobs().submit(
+            speech_request(params),
+            finish=lambda audio: save_generation(audio, params, time.time() - start_time),
+            on_audio=stream.push
+        )
+    except TooManyJobs as e:
+        return jsonify({'success': False, 'message': str(e)}), 429
+    except Exception as e:
+        return jsonify({'success': False, 'message': f"Error generating speech: {str(e)}"}), 500
+    job.future.add_done_callback(lambda future: stream.end())
+    
+    def body():
+        try:
+            if audio_format == 'wav':
+                yield wav_header(SAMPLE_RATE)
+            yield from stream
+        finally:
+            # Also runs when the client disconnects, which stops the generation
+            stream.close()
+    
+    response = Response(body(), mimetype='audio/wav' if audio_format == 'wav' else 'application/octet-stream')
+    response.headers['Cache-Control'] = 'no-store'
+    # Keep reverse proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.headers['X-Job-Id'] = job.id
+    response.headers['X-Sample-Rate'] = str(SAMPLE_RATE)
+    return response
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue a generation and return its job id right away; takes the same form as /generate"""
+    try:
+        params = parse_generation_form(request.form)
+        start_time = time.time()
+        job = get_jobs().submit(
+            speech_request(params),
+            finish=lambda audio: save_generation(audio, params, time.time() - start_time)
+        )
+    except TooManyJobs as e:
+        return jsonify({'success': False, 'message': str(e)}), 429
+    except Exception as e:
+        return jsonify({'success': False, 'message': f"Error submitting job: {str(e)}"}), 500
+    
+    response = jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': f"/jobs/{job.id}",
+        'result_url': f"/jobs/{job.id}/result"
+    })
+    response.headers['Location'] = f"/jobs/{job.id}"
+    return response, 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Status and progress (frames generated out of the frame budget) of a job"""
+    job = get_jobs().get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Unknown or expired job'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """The /generate response of a finished job; 202 while it is still running"""
+    job = get_jobs().get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Unknown or expired job'}), 404
+    if job.status == 'failed':
+        return jsonify({'success': False, 'message': f"Error generating speech: {job.error}"}), 500
+    if job.status != 'done':
+        return jsonify(job.to_dict()), 202
+    return jsonify(job.result)
+
 @app.route('/static/audio/<filename>')
 def serve_audio(filename):
     """Serve the generated audio file for web playback"""
+    path = audio_store.path(filename)
+    if path is None:
+        return "Invalid file name", 404
+    audio_store.touch(filename)
     try:
-        return send_file(os.path.join(output_dir, filename))
+        return send_file(path)
     except Exception as e:
         return f"Error serving audio file: {str(e)}", 404
 
 @app.route('/download/<filename>')
 def download_audio(filename):
     """Serve the generated audio file for download"""
+    path = audio_store.path(filename)
+    if path is None:
+        return "Invalid file name", 404
+    if not os.path.exists(path):
+        path = os.path.join(downloads_dir, filename)
+    audio_store.touch(filename)
     try:
-        return send_file(os.path.join(downloads_dir, filename), 
+        return send_file(path, 
                         as_attachment=True, 
                         download_name=filename)
     except Exception as e:
@@ -352,12 +645,51 @@ def health_check():
     return jsonify({
         'status': 'ok',
         'message': 'CSM Speech Generator is running',
-        'timestamp': time.time()
+        'timestamp': time.time(),
+        'ready': scheduler_ready(),
+        'scheduler': scheduler.stats() if scheduler is not None else None,
+        'result_cache': cached_scheduler.stats() if cached_scheduler is not None else None,
+        'jobs': jobs.stats() if jobs is not None else None,
+        'audio_store': audio_store.stats(),
+        'compiled_voices': compiled_voices.stats(),
+        'model_load': asdict(load_stats) if load_stats is not None else None
     })
 
+def collect_garbage():
+    """Drop samples whose audio or preset is gone, then sweep the audio store and compiled voices"""
+    deleted = voice_db.delete_orphan_samples(audio_store.exists)
+    removed_files, removed_bytes = audio_store.sweep()
+    removed_voices = compiled_voices.sweep(voice_db.get_preset_ids())
+    print(f"Audio GC: {deleted} orphaned samples, {removed_files} files ({removed_bytes / 2**20:.1f} MiB), {removed_voices} compiled voices removed")
+
+def garbage_collector(interval):
+    """Run collect_garbage every `interval` seconds"""
+    while True:
+        try:
+            collect_garbage()
+        except Exception as e:
+            print(f"Audio GC failed: {str(e)}")
+        time.sleep(interval)
+
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: 200 once a model can take requests, 503 until then"""
+    if scheduler_ready():
+        return jsonify({'ready': True})
+    return jsonify({'ready': False}), 503
+
 if __name__ == '__main__':
-    # Force preloading the model
-    get_model()
-    print("Model loaded, starting server...")
-    # Use 0.0.0.0 to make it accessible from any network interface
-    app.run(debug=True, host='0.0.0.0', port=8080)
\ No newline at end of file
+    # Force preloading the model (worker processes load theirs in the background)
+    get_scheduler()
+    threading.Thread(
+        target=garbage_collector,
+        args=(float(os.environ.get('CSM_AUDIO_GC_INTERVAL', 3600)),),
+        name="audio-gc",
+        daemon=True
+    ).start()
+    print("Model loading started, starting server..." if isinstance(scheduler, WorkerPool) else "Model loaded, starting server...")
+    # Use 0.0.0.0 to make it accessible from any network interface.
+    # The debugger runs code for anyone who can reach the port, so it is opt-in.
+    # The reloader would start a second copy of the model (or of the worker pool).
+    debug = os.environ.get('CSM_DEBUG', '').lower() in ('1', 'true', 'yes')
+    app.run(debug=debug, use_reloader=False, threaded=True, host='0.0.0.0', port=8080)
\ No newline at end of file
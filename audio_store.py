@@ -0,0 +1,103 @@
+"""
+Content-addressed store for generated audio
+"""
+
+import hashlib
+import os
+
+from csm_mlx.audio_io import SAMPLE_RATE, write_audio
+from csm_mlx.lru_store import DiskLRU
+
+AUDIO_EXTENSIONS = ('.wav', '.flac')
+# Written before being renamed into place; left behind only by a crash
+TEMP_EXTENSIONS = ('.tmp', '.partial')
+
+class AudioStore:
+    """
+    Generated audio files named by the hash of their contents.
+
+    Identical outputs (e.g. a repeated seeded request) share one file. The
+    store keeps within `max_bytes` and drops files not used for
+    `max_age_seconds`, least recently used first, where serving a file or
+    storing it again counts as a use (its mtime is bumped). Files named by
+    `referenced()` (e.g. voice preset samples) are never removed, and
+    neither is anything younger than `grace_seconds`, so a file can be
+    referenced right after it is stored.
+    """
+
+    def __init__(self, directory, *, max_bytes=2 << 30, max_age_seconds=30 * 86400,
+                 grace_seconds=600, audio_format="wav", referenced=None):
+        """Open the store, creating `directory` if needed"""
+        self.directory = directory
+        self.audio_format = audio_format
+        self.referenced = referenced or (lambda: set())
+        self._files = DiskLRU(
+            directory,
+            max_bytes,
+            AUDIO_EXTENSIONS,
+            max_age_seconds=max_age_seconds,
+            grace_seconds=grace_seconds,
+            temp_extensions=TEMP_EXTENSIONS,
+            temp_grace_seconds=grace_seconds
+        )
+
+    def path(self, filename):
+        """Path of a stored file; None for names that would leave the store"""
+        if not filename or os.path.basename(filename) != filename or filename.startswith('.'):
+            return None
+        return os.path.join(self.directory, filename)
+
+    def put(self, audio, sample_rate=SAMPLE_RATE):
+        """Store `audio` and return its filename; the file is only written if it is new"""
+        tmp_path = self._files.temp_path()
+        try:
+            write_audio(tmp_path, audio, sample_rate, format=self.audio_format)
+            digest = hashlib.sha256()
+            with open(tmp_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        filename = f"{digest.hexdigest()[:32]}.{self.audio_format}"
+        self._files.add(tmp_path, filename)
+        if self._files.bytes > self._files.max_bytes:
+            self.sweep()
+        return filename
+
+    def touch(self, filename):
+        """Mark a file as just used"""
+        if self.path(filename):
+            self._files.touch(filename)
+
+    def sweep(self):
+        """
+        Remove files past the age limit, then the least recently used ones
+        until the store fits in `max_bytes`, plus leftover temporary files
+
+        Returns:
+            The number of files and bytes removed
+        """
+        referenced = {os.path.basename(path) for path in self.referenced() if path}
+        return self._files.evict(keep=referenced)
+
+    def locate(self, path):
+        """The file behind a sample's audio path (a file path or /static/audio URL); None if it is gone"""
+        if os.path.exists(path):
+            return path
+        stored = self.path(os.path.basename(path))
+        return stored if stored is not None and os.path.exists(stored) else None
+
+    def exists(self, path):
+        """Whether a sample's audio path is still stored"""
+        return self.locate(path) is not None
+
+    def stats(self):
+        """Size of the store and how much the sweeper has removed"""
+        return {
+            'bytes': self._files.bytes,
+            'max_bytes': self._files.max_bytes,
+            'removed_files': self._files.removed_files,
+            'removed_bytes': self._files.removed_bytes
+        }
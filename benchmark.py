@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+CSM benchmarks
+
+Speed and quality reports for the generation options of csm_mlx.
+
+Usage:
+    python benchmark.py codebooks --codebooks 32 16 8 4
+    python benchmark.py prefill --chunk-sizes 0 512 128 --repeats 1 8 32
+    python benchmark.py kv-cache --policies full q8 q4 window:128:4
+    python benchmark.py startup --runs 3
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import mlx.core as mx
+import numpy as np
+from mlx.utils import tree_flatten
+from mlx_lm.sample_utils import make_sampler
+
+from csm_mlx import KVCachePolicy, generate, load_csm
+from csm_mlx.generation import _prepare, default_stream, generate_codes
+from csm_mlx.loading import peak_rss_bytes
+from csm_mlx.quantization import teacher_forced_codes
+from csm_mlx.tokenizers import decode_audio
+
+SAMPLE_RATE = 24_000
+FRAME_SAMPLES = 1920  # 80 ms at 24 kHz
+
+DEFAULT_TEXTS = [
+    "Hello! This is a test of the Conversation Speech Model running on Apple Silicon with MLX.",
+    "The quick brown fox jumps over the lazy dog, then takes a long nap in the afternoon sun.",
+    "Please hold while we connect your call to the next available representative.",
+]
+
+
+def load_model():
+    """Load the CSM model with the default checkpoint"""
+    print("Initializing CSM model...")
+    model, load_stats = load_csm()
+    print(f"Model loaded in {load_stats}")
+    return model
+
+
+def log_spectral_distance(reference, degraded, n_fft=1024, hop=256):
+    """Log-spectral distance in dB between two signals (lower is closer)"""
+    length = min(len(reference), len(degraded))
+    if length < n_fft:
+        return float("nan")
+
+    window = np.hanning(n_fft)
+
+    def spectrum(x):
+        frames = np.lib.stride_tricks.sliding_window_view(x[:length], n_fft)[::hop]
+        return 20 * np.log10(np.abs(np.fft.rfft(frames * window, axis=-1)) + 1e-7)
+
+    difference = spectrum(reference) - spectrum(degraded)
+    return float(np.mean(np.sqrt(np.mean(difference**2, axis=-1))))
+
+
+def snr(reference, degraded):
+    """Signal-to-noise ratio in dB of `degraded` against `reference`"""
+    length = min(len(reference), len(degraded))
+    noise = reference[:length] - degraded[:length]
+    return float(10 * np.log10(np.sum(reference[:length] ** 2) / (np.sum(noise**2) + 1e-12)))
+
+
+def benchmark_codebooks(model, texts, codebook_counts, args):
+    """
+    Report speed and fidelity of the reduced-codebook fast mode.
+
+    Speed: each text is generated with only the first K codebooks sampled.
+    Fidelity: a full 32-codebook generation is decoded with all codebooks and
+    with only its first K, so the difference isolates what dropping the
+    upper codebooks costs, independent of sampling randomness.
+    """
+    sampler = make_sampler(temp=args.temp, min_p=args.min_p)
+
+    # Warm up compilation and the Mimi decoders
+    for n_codebooks in codebook_counts:
+        generate(model, texts[0], args.speaker, [], 400, sampler=sampler, n_codebooks=n_codebooks)
+
+    references = []
+    for text in texts:
+        mx.random.seed(args.seed)
+        references.append(
+            generate_codes(model, text, args.speaker, [], args.max_duration, sampler=sampler)
+        )
+
+    print()
+    print(f"{'K':>4} {'decoder steps':>14} {'ms/frame':>10} {'RTF':>7} {'speedup':>8} {'LSD dB':>8} {'SNR dB':>8}")
+
+    baseline_ms = None
+    for n_codebooks in codebook_counts:
+        total_time = 0.0
+        total_frames = 0
+        for text in texts:
+            mx.random.seed(args.seed)
+            start_time = time.time()
+            audio = generate(
+                model,
+                text,
+                args.speaker,
+                [],
+                args.max_duration,
+                sampler=sampler,
+                n_codebooks=n_codebooks,
+            )
+            mx.eval(audio)
+            total_time += time.time() - start_time
+            total_frames += audio.shape[0] // FRAME_SAMPLES
+
+        ms_per_frame = 1000 * total_time / max(total_frames, 1)
+        baseline_ms = baseline_ms or ms_per_frame
+        rtf = ms_per_frame / 80
+
+        distances, ratios = [], []
+        for codes in references:
+            full = np.asarray(decode_audio(codes, n_audio_codebooks=codes.shape[1]))[0, 0]
+            reduced = np.asarray(
+                decode_audio(codes[:, :n_codebooks], n_audio_codebooks=n_codebooks)
+            )[0, 0]
+            distances.append(log_spectral_distance(full, reduced))
+            ratios.append(snr(full, reduced))
+
+        print(
+            f"{n_codebooks:>4} {n_codebooks - 1:>14} {ms_per_frame:>10.1f} {rtf:>7.2f} "
+            f"{baseline_ms / ms_per_frame:>7.2f}x {np.mean(distances):>8.2f} {np.mean(ratios):>8.2f}"
+        )
+
+
+def peak_memory():
+    """Peak device memory in bytes since the last reset"""
+    get_peak_memory = getattr(mx, "get_peak_memory", None) or mx.metal.get_peak_memory
+    return get_peak_memory()
+
+
+def reset_peak_memory():
+    reset = getattr(mx, "reset_peak_memory", None) or mx.metal.reset_peak_memory
+    reset()
+
+
+def benchmark_prefill(model, texts, chunk_sizes, repeats, args):
+    """
+    Report time to first frame and peak memory of the prompt prefill.
+
+    The prompt is the texts joined `repeats` times, so its length grows
+    with `repeats`. Chunk size 0 prefills the prompt in one shot.
+    """
+    sampler = make_sampler(temp=args.temp, min_p=args.min_p)
+    generate_codes(model, texts[0], args.speaker, [], 80, sampler=sampler)  # warm up
+
+    print()
+    print(f"{'repeats':>8} {'positions':>10} {'chunk':>6} {'first frame s':>14} {'peak MiB':>9}")
+
+    for repeat in repeats:
+        text = " ".join(texts * repeat)
+        for chunk_size in chunk_sizes:
+            mx.synchronize()
+            reset_peak_memory()
+            start_time = time.time()
+            try:
+                engine, input, mask = _prepare(
+                    model,
+                    text,
+                    args.speaker,
+                    [],
+                    1,
+                    sampler=sampler,
+                    compiled=True,
+                    stream=default_stream,
+                    prefix_cache=None,
+                    prefill_chunk_size=chunk_size or None,
+                )
+            except ValueError:
+                print(f"{repeat:>8} {'too long':>10}")
+                break
+            next(engine.run(input, mask, 1), None)
+            mx.synchronize()
+            elapsed = time.time() - start_time
+
+            positions = engine.backbone_cache[0].offset
+            print(
+                f"{repeat:>8} {positions:>10} {chunk_size or 'all':>6} "
+                f"{elapsed:>14.3f} {peak_memory() / 2**20:>9.0f}"
+            )
+
+
+def cache_bytes(cache):
+    """Bytes allocated by the keys and values of a backbone cache"""
+    return sum(
+        value.nbytes
+        for layer_cache in cache
+        for _, value in tree_flatten((layer_cache.keys, layer_cache.values))
+    )
+
+
+def benchmark_kv_cache(model, texts, policies, args):
+    """
+    Report KV cache memory, speed and fidelity of each cache policy.
+
+    Speed and memory: each text is generated greedily with the policy, and
+    the backbone cache is measured at the end. Fidelity: the policy predicts
+    every frame of a greedy full-cache reference from the reference frames
+    before it (teacher forcing), and the predicted codes are compared with
+    the reference, both as codes and as decoded audio.
+    """
+    generate_codes(model, texts[0], args.speaker, [], 400)  # warm up
+    references = [generate_codes(model, text, args.speaker, [], args.max_duration) for text in texts]
+    reference_audio = [
+        np.asarray(decode_audio(codes, n_audio_codebooks=codes.shape[1]))[0, 0]
+        for codes in references
+    ]
+    max_audio_frames = int(args.max_duration / 80)
+
+    print()
+    print(f"{'policy':<16} {'KV MiB':>8} {'ms/frame':>10} {'codes %':>8} {'cb0 %':>7} {'LSD dB':>8} {'SNR dB':>8}")
+
+    for spec in policies:
+        policy = KVCachePolicy.from_string(spec)
+
+        total_time = 0.0
+        total_frames = 0
+        kv_bytes = 0
+        for text in texts:
+            start_time = time.time()
+            engine, input, mask = _prepare(
+                model,
+                text,
+                args.speaker,
+                [],
+                max_audio_frames,
+                sampler=None,
+                compiled=True,
+                stream=default_stream,
+                prefix_cache=None,
+                kv_cache=policy,
+            )
+            for _ in engine.run(input, mask, max_audio_frames):
+                total_frames += 1
+            mx.synchronize()
+            total_time += time.time() - start_time
+            kv_bytes = max(kv_bytes, cache_bytes(engine.backbone_cache))
+
+        matches = codebook0_matches = total = n_frames = 0
+        distances, ratios = [], []
+        for text, reference, audio in zip(texts, references, reference_audio):
+            if reference.shape[2] == 0:
+                continue
+            predicted = teacher_forced_codes(model, text, args.speaker, reference, kv_cache=policy)
+            agreement = predicted == reference
+            matches += agreement.sum().item()
+            codebook0_matches += agreement[:, 0].sum().item()
+            total += agreement.size
+            n_frames += reference.shape[2]
+
+            predicted_audio = np.asarray(
+                decode_audio(predicted, n_audio_codebooks=predicted.shape[1])
+            )[0, 0]
+            distances.append(log_spectral_distance(audio, predicted_audio))
+            ratios.append(snr(audio, predicted_audio))
+
+        print(
+            f"{spec:<16} {kv_bytes / 2**20:>8.1f} {1000 * total_time / max(total_frames, 1):>10.1f} "
+            f"{100 * matches / max(total, 1):>8.1f} {100 * codebook0_matches / max(n_frames, 1):>7.1f} "
+            f"{np.mean(distances):>8.2f} {np.mean(ratios):>8.2f}"
+        )
+
+
+def startup_child(args):
+    """One cold start, reported as a JSON line on stdout"""
+    start_time = time.time()
+    model, load_stats = load_csm(args.model, lazy=args.child == "lazy")
+    codes = generate_codes(model, args.text[0] if args.text else DEFAULT_TEXTS[0], args.speaker, [], 80)
+    mx.eval(codes)
+    first_frame = time.time() - start_time
+    print(json.dumps({
+        "load_s": load_stats.seconds,
+        "first_frame_s": first_frame,
+        "peak_rss_mib": peak_rss_bytes() / 2**20,
+    }))
+
+
+def benchmark_startup(args):
+    """
+    Report cold-start time and peak memory of eager and lazy weight loading.
+
+    Every run is a fresh process, so this includes interpreter start and
+    imports. The OS page cache is not dropped: the first run reads the
+    checkpoint from disk, later runs mostly from memory, which is why
+    each mode's first run is reported separately from the best one.
+    """
+    command = [sys.executable, __file__, "startup", "--speaker", str(args.speaker)]
+    if args.model:
+        command += ["--model", args.model]
+    for text in args.text or []:
+        command += ["--text", text]
+
+    print()
+    print(f"{'mode':<6} {'run':>4} {'process s':>10} {'load s':>8} {'first frame s':>14} {'peak RSS MiB':>13}")
+
+    for mode in ("eager", "lazy"):
+        runs = []
+        for _ in range(args.runs):
+            start_time = time.time()
+            result = subprocess.run(command + ["--child", mode], capture_output=True, text=True, check=True)
+            report = json.loads(result.stdout.strip().splitlines()[-1])
+            runs.append((time.time() - start_time, report))
+
+        best = min(range(len(runs)), key=lambda index: runs[index][0])
+        for label, (elapsed, report) in (("first", runs[0]), ("best", runs[best])):
+            print(
+                f"{mode:<6} {label:>4} {elapsed:>10.2f} {report['load_s']:>8.2f} "
+                f"{report['first_frame_s']:>14.2f} {report['peak_rss_mib']:>13.0f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CSM benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    codebooks = subparsers.add_parser("codebooks", help="Speed/quality of the reduced-codebook fast mode")
+    codebooks.add_argument("--codebooks", type=int, nargs="+", default=[32, 24, 16, 8, 4])
+
+    prefill = subparsers.add_parser("prefill", help="Peak memory and latency of chunked prefill")
+    prefill.add_argument("--chunk-sizes", type=int, nargs="+", default=[0, 512, 128],
+                         help="Prefill chunk sizes, 0 for a single chunk")
+    prefill.add_argument("--repeats", type=int, nargs="+", default=[1, 8, 32],
+                         help="How many times the texts are repeated in the prompt")
+
+    kv_cache = subparsers.add_parser("kv-cache", help="Memory/speed/quality of the KV cache policies")
+    kv_cache.add_argument("--policies", type=str, nargs="+", default=["full", "q8", "q4", "window:128:4", "window:64:4"],
+                          help="Policies as full, q8, q4 or window:<max_size>[:<keep>]")
+
+    startup = subparsers.add_parser("startup", help="Cold-start time and peak memory of the model loader")
+    startup.add_argument("--runs", type=int, default=3, help="Fresh processes per loading mode")
+    startup.add_argument("--model", "-m", type=str, default=None,
+                         help="Checkpoint file or quantized model directory (default checkpoint if omitted)")
+    startup.add_argument("--child", choices=["eager", "lazy"], help=argparse.SUPPRESS)
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument("--text", "-t", type=str, action="append", help="Text to synthesize (repeatable)")
+        subparser.add_argument("--temp", type=float, default=0.5, help="Sampling temperature")
+        subparser.add_argument("--min_p", type=float, default=0.1, help="Minimum probability for sampling")
+        subparser.add_argument("--speaker", "-s", type=int, default=0, help="Speaker ID")
+        subparser.add_argument("--seed", type=int, default=1234, help="Random seed")
+        subparser.add_argument("--max_duration", "-d", type=int, default=10000,
+                               help="Maximum audio duration in milliseconds")
+
+    args = parser.parse_args()
+    texts = args.text or DEFAULT_TEXTS
+    if args.command == "kv-cache":
+        try:
+            for spec in args.policies:
+                KVCachePolicy.from_string(spec)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.command == "startup":
+        if args.child:
+            startup_child(args)
+        else:
+            benchmark_startup(args)
+        return
+
+    model = load_model()
+
+    if args.command == "codebooks":
+        benchmark_codebooks(model, texts, args.codebooks, args)
+    elif args.command == "prefill":
+        benchmark_prefill(model, texts, args.chunk_sizes, args.repeats, args)
+    elif args.command == "kv-cache":
+        benchmark_kv_cache(model, texts, args.policies, args)
+
+
+if __name__ == "__main__":
+    main()
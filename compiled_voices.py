@@ -0,0 +1,320 @@
+"""
+Compiled voices of the voice presets, kept next to the preset database
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, fields
+from functools import partial
+from typing import Optional
+
+import mlx.core as mx
+
+from csm_mlx.audio_io import SAMPLE_RATE, read_audio
+from csm_mlx.compiled_voice import load_voice, save_voice
+from csm_mlx.scheduler import SpeechRequest, VoiceRequest
+from csm_mlx.segment import Segment
+
+def _resolved(value):
+    """A Future that already holds `value`"""
+    future = Future()
+    future.set_result(value)
+    return future
+
+class CompiledVoiceStore:
+    """
+    The compiled voice of each voice preset: the Mimi codes of its reference
+    sample and the backbone KV state after prefilling it.
+
+    A preset's voice is made from its first sample (audio and transcript)
+    the first time it is asked for, and saved as
+    `<preset id>-<fingerprint>.safetensors`. The fingerprint covers the
+    sample and the model weights, so when the sample is removed or the
+    weights change the voice is compiled again and the stale file deleted.
+    Concurrent requests for a voice being compiled share its Future rather
+    than compiling it again. Up to `max_loaded` voices are kept in memory, least
+    recently used first out.
+    """
+
+    def __init__(self, directory, *, locate=None, max_loaded=8, max_reference_seconds=20):
+        """Open the store, creating `directory` if needed"""
+        self.directory = directory
+        # Where a sample's audio_path is on disk, or None if it is gone
+        self.locate = locate or (lambda path: path if os.path.exists(path) else None)
+        self.max_loaded = max_loaded
+        self.max_reference_seconds = max_reference_seconds
+        self.hits = self.loads = self.compiles = 0
+        self._loaded = OrderedDict()
+        self._compiling = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _name(self, preset_id, sample, model_id):
+        """File name of a preset's voice compiled from `sample` for the weights `model_id`"""
+        fingerprint = hashlib.sha256(
+            json.dumps([sample['id'], sample['audio_path'], sample['text'], model_id]).encode()
+        ).hexdigest()[:16]
+        return f"{preset_id}-{fingerprint}.safetensors"
+
+    def get(self, preset, sample, model_id, compile):
+        """
+        The compiled voice of `preset` from its reference `sample`, loaded
+        from disk or, failing that, compiled with `compile(context)`, which
+        returns a Future of a CompiledVoice (e.g. a scheduler's compile_voice).
+        A compile is not waited for: the thread that resolves its Future saves
+        the voice
+
+        Returns:
+            A Future of the voice, or of None if the sample's audio is gone or
+            too long to use
+        """
+        name = self._name(preset.id, sample, model_id)
+        with self._lock:
+            voice = self._loaded.get(name)
+            if voice is not None:
+                self._loaded.move_to_end(name)
+                self.hits += 1
+                return _resolved(voice)
+            flight = self._compiling.get(name)
+            if flight is not None:
+                return flight
+            flight = self._compiling[name] = Future()
+
+        try:
+            voice = self._load_or_compile(preset, sample, compile, name)
+        except Exception as e:
+            self._land(name, flight, error=e)
+            return flight
+        if isinstance(voice, Future):
+            voice.add_done_callback(partial(self._compiled, preset.id, name, flight))
+        else:
+            self._land(name, flight, voice)
+        return flight
+
+    def _load_or_compile(self, preset, sample, compile, name):
+        """The voice from its file, or the Future of compiling it"""
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path):
+            try:
+                voice = load_voice(path)
+                self.loads += 1
+                return voice
+            except (OSError, ValueError) as e:
+                print(f"Recompiling voice of preset {preset.id}: {e}")
+
+        audio_path = self.locate(sample['audio_path'])
+        if audio_path is None:
+            return None
+        audio, sample_rate = read_audio(audio_path)
+        if sample_rate != SAMPLE_RATE or len(audio) > self.max_reference_seconds * SAMPLE_RATE:
+            return None
+
+        context = [Segment(speaker=preset.speaker_id, text=sample['text'], audio=mx.array(audio))]
+        return compile(context)
+
+    def _compiled(self, preset_id, name, flight, compiled):
+        """Save a voice that has finished compiling, and hand it to the requests waiting for it"""
+        try:
+            voice = compiled.result()
+            self.compiles += 1
+            save_voice(voice, os.path.join(self.directory, name))
+            self.discard(preset_id, keep=name)
+        except Exception as e:
+            self._land(name, flight, error=e)
+        else:
+            self._land(name, flight, voice)
+
+    def _land(self, name, flight, voice=None, error=None):
+        """Resolve the flight of `name` with its voice (or None), or with `error`"""
+        with self._lock:
+            # Loaded before the flight is gone, so no request misses both
+            if voice is not None:
+                self._loaded[name] = voice
+                while len(self._loaded) > self.max_loaded:
+                    self._loaded.popitem(last=False)
+            del self._compiling[name]
+        if error is not None:
+            flight.set_exception(error)
+        else:
+            flight.set_result(voice)
+
+    def discard(self, preset_id, keep=None):
+        """Delete a preset's compiled voices, except the file named `keep`"""
+        prefix = f"{preset_id}-"
+        with self._lock:
+            for name in [name for name in self._loaded if name.startswith(prefix) and name != keep]:
+                del self._loaded[name]
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name != keep:
+                self._remove(name)
+
+    def sweep(self, preset_ids, grace_seconds=3600):
+        """
+        Delete the compiled voices of presets not in `preset_ids`, and
+        temporary files older than `grace_seconds`, left behind by a crash
+        while saving
+
+        Returns:
+            The number of files removed
+        """
+        now = time.time()
+        removed = 0
+        for name in os.listdir(self.directory):
+            preset_id = name.split('-', 1)[0]
+            if preset_id.isdigit():
+                if int(preset_id) in preset_ids:
+                    continue
+            else:
+                try:
+                    if now - os.path.getmtime(os.path.join(self.directory, name)) < grace_seconds:
+                        continue
+                except FileNotFoundError:
+                    continue
+            removed += self._remove(name)
+        return removed
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def stats(self):
+        """Voices in memory, and how requests for them were served"""
+        with self._lock:
+            return {
+                'loaded': len(self._loaded),
+                'loaded_bytes': sum(voice.nbytes for voice in self._loaded.values()),
+                'hits': self.hits,
+                'loads': self.loads,
+                'compiles': self.compiles
+            }
+
+@dataclass
+class PresetSpeechRequest(SpeechRequest):
+    """A speech request in the voice of a saved preset, for PresetVoiceScheduler"""
+    preset_id: Optional[int] = None
+
+class PresetVoiceScheduler:
+    """
+    Scheduler (e.g. a CachedScheduler) in front of which each
+    PresetSpeechRequest gets its preset's compiled voice.
+
+    `submit` returns at once. The voice is looked up and loaded on a thread
+    of this wrapper's; compiling it is queued on the scheduler like any
+    request, without holding that thread. Once the voice is there, the
+    request goes to the scheduler with it. When the voice can't be read or
+    compiled, the request is generated without it and a warning printed.
+    `reference(preset_id)` returns the preset and the sample its voice is
+    made from, or None.
+    """
+
+    def __init__(self, scheduler, store, reference, *, max_workers=2):
+        self.scheduler = scheduler
+        self.store = store
+        self.reference = reference
+        self._resolver = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="csm-voices")
+
+    @property
+    def model_id(self):
+        return self.scheduler.model_id
+
+    @property
+    def ready(self):
+        return self.scheduler.ready
+
+    def submit(self, request, on_progress=None, on_audio=None):
+        """As the scheduler's submit; a preset's voice is resolved first"""
+        preset_id = getattr(request, 'preset_id', None)
+        if preset_id is None:
+            return self.scheduler.submit(request, on_progress=on_progress, on_audio=on_audio)
+
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self._resolver.submit(self._resolve, future, request, on_progress, on_audio)
+        return future
+
+    def _resolve(self, future, request, on_progress, on_audio):
+        try:
+            voice = self.voice(request.preset_id)
+        except Exception as e:
+            voice = Future()
+            voice.set_exception(e)
+        voice.add_done_callback(partial(self._send, future, request, on_progress, on_audio))
+
+    def _send(self, future, request, on_progress, on_audio, voice):
+        # A plain SpeechRequest, which the scheduler (and worker processes) know
+        plain = SpeechRequest(**{
+            field.name: getattr(request, field.name) for field in fields(SpeechRequest)
+        })
+        try:
+            plain.voice = voice.result()
+        except Exception as e:
+            print(f"Warning: generating without the compiled voice of preset {request.preset_id}: {e}")
+        try:
+            shared = self.scheduler.submit(plain, on_progress=on_progress, on_audio=on_audio)
+        except Exception as e:
+            future.set_exception(e)
+            return
+
+        def done(shared):
+            try:
+                future.set_result(shared.result())
+            except BaseException as e:
+                future.set_exception(e)
+
+        shared.add_done_callback(done)
+
+    def voice(self, preset_id):
+        """A Future of the compiled voice of a preset, or of None if it has no usable sample"""
+        found = self.reference(preset_id)
+        if found is None:
+            return _resolved(None)
+        preset, sample = found
+        model_id = self.scheduler.model_id
+        return self.store.get(preset, sample, model_id, partial(self._compile, model_id))
+
+    def _compile(self, model_id, context):
+        """
+        Queue compiling a voice on the scheduler. The Future returned is
+        resolved on a resolver thread, so the store saves the voice there
+        rather than on the scheduler's thread
+        """
+        compiled = self.scheduler.compile_voice(VoiceRequest(context, model_id))
+        future = Future()
+
+        def copy(compiled):
+            try:
+                future.set_result(compiled.result())
+            except BaseException as e:
+                future.set_exception(e)
+
+        def hand_over(compiled):
+            try:
+                self._resolver.submit(copy, compiled)
+            except RuntimeError:
+                copy(compiled)  # shutting down
+
+        compiled.add_done_callback(hand_over)
+        return future
+
+    def generate(self, request, timeout=None):
+        """`submit` and wait for the audio"""
+        return self.submit(request).result(timeout)
+
+    def compile_voice(self, request):
+        return self.scheduler.compile_voice(request)
+
+    def stats(self):
+        return self.scheduler.stats()
+
+    def close(self):
+        self._resolver.shutdown()
+        self.scheduler.close()
@@ -12,8 +12,7 @@ import torch
 import torchaudio
 import mlx.core as mx
 from mlx_lm.sample_utils import make_sampler
-from huggingface_hub import hf_hub_download
-from csm_mlx import CSM, csm_1b, generate, Segment
+from csm_mlx import generate, load_csm, Segment
 
 def main():
     # Create output directory
@@ -22,11 +21,8 @@ def main():
     
     # Initialize the model
     print("Initializing CSM model...")
-    start_time = time.time()
-    csm = CSM(csm_1b())
-    weight = hf_hub_download(repo_id="senstella/csm-1b-mlx", filename="ckpt.safetensors")
-    csm.load_weights(weight)
-    print(f"Model loaded in {time.time() - start_time:.2f} seconds")
+    csm, load_stats = load_csm()
+    print(f"Model loaded in {load_stats}")
     
     # Set up a conversation
     conversation = [
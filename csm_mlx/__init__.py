@@ -1,13 +1,35 @@
-from csm_mlx.generation import generate
+from csm_mlx.audio_io import read_audio, write_audio
+from csm_mlx.compiled_voice import CompiledVoice, compile_voice, load_voice, save_voice
+from csm_mlx.generation import generate, generate_batch
+from csm_mlx.kv_cache import KVCachePolicy
+from csm_mlx.loading import load_csm
+from csm_mlx.longform import generate_long, stream_generate_long
 from csm_mlx.models import CSM, csm_1b
+from csm_mlx.prefix_cache import PrefixCache
+from csm_mlx.quantization import load_quantized, quantize_model, save_quantized
 from csm_mlx.segment import Segment
 from csm_mlx.voice_presets import VoicePreset, get_preset_by_name, get_presets_by_category, BASIC_VOICES
 
 __all__ = [
     "generate",
+    "generate_batch",
+    "generate_long",
+    "stream_generate_long",
     "CSM",
     "csm_1b",
+    "load_csm",
+    "PrefixCache",
+    "CompiledVoice",
+    "compile_voice",
+    "save_voice",
+    "load_voice",
+    "KVCachePolicy",
+    "quantize_model",
+    "save_quantized",
+    "load_quantized",
     "Segment",
+    "read_audio",
+    "write_audio",
     "VoicePreset",
     "get_preset_by_name",
     "get_presets_by_category",
@@ -1,4 +1,5 @@
 import math
+from functools import cache
 from typing import Any, Optional
 
 import mlx.core as mx
@@ -7,14 +8,50 @@ from mlx_lm.models.base import scaled_dot_product_attention
 from mlx_lm.models.llama import ModelArgs
 
 
+@cache
+def llama3_scaled_frequencies(
+    dim: int,
+    base: float,
+    scale_factor: float,
+    low_freq_factor: int,
+    high_freq_factor: int,
+    old_context_len: int,
+) -> mx.array:
+    """
+    Llama 3 scaled RoPE frequencies, ``dim // 2`` of them.
+
+    Computed once per configuration and shared by every layer that uses it.
+    """
+    freqs = 1.0 / (base ** (mx.arange(0, dim, 2).astype(mx.float32) / dim))
+
+    low_freq_wavelen = old_context_len / low_freq_factor
+    high_freq_wavelen = old_context_len / high_freq_factor
+    assert low_freq_wavelen != high_freq_wavelen
+
+    wavelen = 2 * math.pi / freqs
+    smooth = (old_context_len / wavelen - low_freq_factor) / (
+        high_freq_factor - low_freq_factor
+    )
+    return mx.where(
+        wavelen < high_freq_wavelen,
+        freqs,
+        mx.where(
+            wavelen > low_freq_wavelen,
+            freqs / scale_factor,
+            (1 - smooth) * freqs / scale_factor + smooth * freqs,
+        ),
+    )
+
+
 class Llama3ScaledRoPE(nn.Module):
     """
     This class implements Rotary Positional Embeddings (RoPE)
     proposed in https://arxiv.org/abs/2104.09864 with additional
     scaling from https://github.com/meta-llama/llama-models/blob/dc42f22a3b05502e7296402b019a51f57fa045c9/models/llama3_1.
 
-    In this implementation we cache the embeddings for each position upto
-    ``max_seq_len`` by computing this during init.
+    The rotation itself is ``mx.fast.rope`` on interleaved pairs with the
+    scaled frequencies from ``llama3_scaled_frequencies``, so there is no
+    per-position table and no length limit.
 
     Default scaling factors are from the following Meta-Llama code:
     https://github.com/meta-llama/llama-models/blob/dc42f22a3b05502e7296402b019a51f57fa045c9/models/llama3_1/api/model.py#L41
@@ -22,8 +59,7 @@ class Llama3ScaledRoPE(nn.Module):
     Args:
         dim (int): Embedding dimension. This is usually set to the dim of each
             head in the attention module computed as ````embed_dim`` // ``num_heads````
-        max_seq_len (int): Maximum expected sequence length for the
-            model, if exceeded the cached freqs will be recomputed
+        max_seq_len (int): Maximum expected sequence length for the model
         base (int): The base for the geometric progression used to compute
             the rotation angles
         scale_factor (int): scaling factor for theta. Default: 8
@@ -51,134 +87,59 @@ class Llama3ScaledRoPE(nn.Module):
         self.low_freq_factor = low_freq_factor
         self.high_freq_factor = high_freq_factor
         self.old_context_len = old_context_len
-        self.is_cache_built = False
-        self.rope_init()
 
-    def rope_init(self):
-        """
-        Warning: this is called in recipes before torch.compile,
-        so that the cache is built in advance.
-        """
-        freqs = 1.0 / (
-            self.base
-            ** (
-                mx.arange(0, self.dim, 2)[: (self.dim // 2)].astype(mx.float32)
-                / self.dim
-            )
-        )
-
-        theta = self.apply_scaling(
-            freqs,
-            self.scale_factor,
-            self.low_freq_factor,
-            self.high_freq_factor,
-            self.old_context_len,
+        self._theta = llama3_scaled_frequencies(
+            dim, base, scale_factor, low_freq_factor, high_freq_factor, old_context_len
         )
-        self._theta = theta
-        self.build_rope_cache(self.max_seq_len)
-        self.is_cache_built = True
-
-    def build_rope_cache(self, max_seq_len: int = 4096) -> None:
-        # Create position indexes `[0, 1, ..., max_seq_len - 1]`
-        seq_idx = mx.arange(max_seq_len, dtype=self._theta.dtype)
-
-        # Outer product of theta and position index; output tensor has
-        # a shape of [max_seq_len, dim // 2]
-        idx_theta = mx.einsum("i, j -> ij", seq_idx, self._theta).astype(mx.float32)
+        # mx.fast.rope takes the inverse frequencies
+        self._periods = 1.0 / self._theta
+        # Not parameters, so evaluate them here: a lazy array can only be
+        # evaluated on the thread that built it
+        mx.eval(self._theta, self._periods)
 
-        # cache includes both the cos and sin components and so the output shape is
-        # [max_seq_len, dim // 2, 2]
-        cache = mx.stack([mx.cos(idx_theta), mx.sin(idx_theta)], axis=-1)
-        self._cache = cache
-
-    def apply_scaling(
-        self,
-        freqs: mx.array,
-        scale_factor: float,
-        low_freq_factor: int,
-        high_freq_factor: int,
-        old_context_len: int,
-    ):
-        low_freq_wavelen = old_context_len / low_freq_factor
-        high_freq_wavelen = old_context_len / high_freq_factor
-        new_freqs = []
-        for freq in freqs:
-            wavelen = 2 * math.pi / freq
-            if wavelen < high_freq_wavelen:
-                new_freqs.append(freq)
-            elif wavelen > low_freq_wavelen:
-                new_freqs.append(freq / scale_factor)
-            else:
-                assert low_freq_wavelen != high_freq_wavelen
-                smooth = (old_context_len / wavelen - low_freq_factor) / (
-                    high_freq_factor - low_freq_factor
-                )
-                new_freqs.append((1 - smooth) * freq / scale_factor + smooth * freq)
-        return mx.array(new_freqs, dtype=freqs.dtype)
-
-    def __call__(self, x: mx.array, *, offset: int) -> mx.array:
+    def shift(self, x: mx.array, delta: int) -> mx.array:
         """
-        Args:
-            x (torch.Tensor): input tensor with shape
-                [b, s, n_h, h_d]
-            input_pos (Optional[torch.Tensor]): Optional tensor which contains the position ids
-                of each token. During training, this is used to indicate the positions
-                of each token relative to its sample when packed, shape [b, s].
-                During inference, this indicates the position of the current token.
-                If none, assume the index of the token is its position id. Default is None.
+        Move already embedded ``x`` by ``delta`` positions.
 
-        Returns:
-            Tensor: output tensor with RoPE applied
-
-        Notation used for tensor shapes:
-            - b: batch size
-            - s: sequence length
-            - n_h: num heads
-            - h_d: head dim
-
-        Raises:
-            RuntimeError: if RoPE cache is not initialized prior to forward call
+        Rotations compose, so this is the same as having embedded ``x`` at
+        positions ``delta`` further along. Every position is rotated by the
+        same angle, so any layout with ``h_d`` last works, including the
+        ``[b, n_kv, s, h_d]`` keys of a KV cache.
         """
+        if delta == 0:
+            return x
 
-        if not self.is_cache_built:
-            raise RuntimeError(
-                "RoPE cache is not built. Please call rope_init() first."
-            )
-
-        # input tensor has shape [b, s, n_h, h_d]
-        seq_len = x.shape[1]
-
-        # extract the values based on whether input_pos is set or not
-        rope_cache = (
-            self._cache[:seq_len]
-            if offset is None
-            else self._cache[None, offset : offset + seq_len]
-        )
+        angle = delta * self._theta
+        cos, sin = mx.cos(angle), mx.sin(angle)
 
-        # reshape input; the last dimension is used for computing the output.
-        # Cast to float to match the reference implementation
-        # tensor has shape [b, s, n_h, h_d // 2, 2]
         xshaped = x.astype(mx.float32).reshape(*x.shape[:-1], -1, 2)
-
-        # reshape the cache for broadcasting
-        # tensor has shape [b, s, 1, h_d // 2, 2] if packed samples,
-        # otherwise has shape [1, s, 1, h_d // 2, 2]
-        rope_cache = rope_cache.reshape(-1, xshaped.shape[1], 1, xshaped.shape[3], 2)
-
-        # tensor has shape [b, s, n_h, h_d // 2, 2]
         x_out = mx.stack(
             [
-                xshaped[..., 0] * rope_cache[..., 0]
-                - xshaped[..., 1] * rope_cache[..., 1],
-                xshaped[..., 1] * rope_cache[..., 0]
-                + xshaped[..., 0] * rope_cache[..., 1],
+                xshaped[..., 0] * cos - xshaped[..., 1] * sin,
+                xshaped[..., 1] * cos + xshaped[..., 0] * sin,
             ],
             -1,
         )
+        return x_out.flatten(-2).astype(x.dtype)
 
-        # tensor has shape [b, s, n_h, h_d]
-        x_out = x_out.flatten(3)
-        return x_out.astype(x.dtype)
+    def __call__(self, x: mx.array, *, offset: int) -> mx.array:
+        """
+        Args:
+            x (mx.array): input with shape [b, n_h, s, h_d]
+            offset (int): position of the first of the ``s`` positions
+
+        Returns:
+            mx.array: ``x`` with RoPE applied, in the dtype of ``x``
+        """
+        return mx.fast.rope(
+            x,
+            self.dim,
+            traditional=True,
+            base=None,
+            scale=1.0,
+            offset=offset,
+            freqs=self._periods,
+        )
 
 
 class Attention(nn.Module):
@@ -215,63 +176,24 @@ class Attention(nn.Module):
         cache: Optional[Any] = None,
     ) -> mx.array:
         b, s_x, _ = x.shape
-        y = x
-
-        s_y = y.shape[1] if y is not None else 0
-
-        # q has shape [b, s_x, num_heads * head_dim]
-        q = self.q_proj(x)
+        offset = cache.offset if cache else 0
 
-        # number of queries per key/value
-        q_per_kv = self.n_heads // self.n_kv_heads
-        q = q.reshape(b, s_x, self.n_kv_heads * q_per_kv, self.head_dim)
+        # q: [b, n_h, s_x, h_d], k,v: [b, n_kv, s_x, h_d]
+        q = self.q_proj(x).reshape(b, s_x, self.n_heads, self.head_dim).swapaxes(1, 2)
+        k = self.k_proj(x).reshape(b, s_x, self.n_kv_heads, self.head_dim).swapaxes(1, 2)
+        v = self.v_proj(x).reshape(b, s_x, self.n_kv_heads, self.head_dim).swapaxes(1, 2)
 
         # Apply positional embeddings
-        if self.rope is not None:
-            q = self.rope(q, offset=cache.offset if cache else 0)
-
-        # [b, n_h, s_x, h_d]
-        q = q.swapaxes(1, 2)
-
-        # Update k and v shape, positional embeddings, and normalization
-
-        # k,v shape [b, s_y, num_kv_heads * head_dim]
-        k = self.k_proj(y)
-        v = self.v_proj(y)
-
-        # Apply positional embeddings
-        # k,v shape: [b, s_y, n_kv, h_d]
-        k = k.reshape(b, s_y, -1, self.head_dim)
-        v = v.reshape(b, s_y, -1, self.head_dim)
-        if self.rope is not None:
-            k = self.rope(k, offset=cache.offset if cache else 0)
-
-        # k,v shape: [b, n_kv, s_y, h_d]
-        k = k.swapaxes(1, 2)
-        v = v.swapaxes(1, 2)
+        q = self.rope(q, offset=offset)
+        k = self.rope(k, offset=offset)
 
         # Update key-value cache
         if cache:
             k, v = cache.update_and_fetch(k, v)
 
-        # If needed, expand the key and value tensors to have the same shape
-        # as the query tensor by copying values across the relevant dim
-        # k,v shape: [b, n_kv, s, h_d] -> [b, n_h, s, h_d]
-        if self.n_heads != self.n_kv_heads:
-            q_per_kv = self.n_heads // self.n_kv_heads
-
-            k = mx.expand_dims(k, axis=2)
-            v = mx.expand_dims(v, axis=2)
-
-            k_expand_shape = (b, self.n_kv_heads, q_per_kv) + k.shape[3:]
-            v_expand_shape = (b, self.n_kv_heads, q_per_kv) + v.shape[3:]
-
-            k = mx.broadcast_to(k, k_expand_shape)
-            v = mx.broadcast_to(v, v_expand_shape)
-
-            k = k.reshape(b, self.n_kv_heads * q_per_kv, *k.shape[3:])
-            v = v.reshape(b, self.n_kv_heads * q_per_kv, *v.shape[3:])
-
+        # The fused kernel handles grouped-query attention itself, so the
+        # n_kv key/value heads are passed as they are rather than repeated
+        # to n_h
         output = scaled_dot_product_attention(
             q, k, v, cache=cache, scale=self.scale, mask=mask
         )
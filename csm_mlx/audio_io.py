@@ -0,0 +1,173 @@
+import os
+import struct
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import mlx.core as mx
+import numpy as np
+
+SAMPLE_RATE = 24_000
+# Samples converted to 16-bit at a time, so conversion never copies a whole file
+BLOCK_SAMPLES = 1 << 16
+
+FORMATS = ("wav", "flac")
+SAMPLE_FORMATS = ("int16", "float32")
+
+
+def as_float32(audio: Any) -> np.ndarray:
+    """A flat float32 view of ``audio``, copied only if its dtype or layout requires."""
+    if isinstance(audio, mx.array) and audio.dtype != mx.float32:
+        audio = audio.astype(mx.float32)
+    return np.ascontiguousarray(np.asarray(audio, dtype=np.float32).reshape(-1))
+
+
+def pcm16(audio: Any) -> bytes:
+    """Float audio in [-1, 1] as little-endian 16-bit PCM."""
+    return _to_int16(as_float32(audio)).tobytes()
+
+
+def _to_int16(audio: np.ndarray) -> np.ndarray:
+    return (np.clip(audio, -1.0, 1.0) * 32767).astype("<i2")
+
+
+def wav_header(
+    sample_rate: int = SAMPLE_RATE,
+    n_samples: Optional[int] = None,
+    sample_format: str = "int16",
+) -> bytes:
+    """
+    Header of a mono WAV file of 16-bit PCM or 32-bit float samples.
+
+    Without ``n_samples`` the sizes are set to the maximum, which players
+    read as "until the end of the stream", so the header can be sent before
+    the audio is generated.
+    """
+    if sample_format not in SAMPLE_FORMATS:
+        raise ValueError(f"sample_format must be one of {', '.join(SAMPLE_FORMATS)}")
+    width = 2 if sample_format == "int16" else 4
+    data_size = 0xFFFFFFFF if n_samples is None else n_samples * width
+    riff_size = 0xFFFFFFFF if n_samples is None else 36 + data_size
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF",
+        riff_size,
+        b"WAVE",
+        b"fmt ",
+        16,
+        1 if sample_format == "int16" else 3,  # PCM or IEEE float
+        1,  # mono
+        sample_rate,
+        sample_rate * width,
+        width,
+        width * 8,
+        b"data",
+        data_size,
+    )
+
+
+def read_audio(path: Union[str, Path]) -> tuple[np.ndarray, int]:
+    """
+    Read a WAV file of 16-bit PCM or 32-bit float samples, or a FLAC file
+    (with the optional ``soundfile`` package). Multichannel audio is mixed
+    down to mono.
+
+    Returns:
+        The samples as float32 in [-1, 1], and the sample rate
+    """
+    if Path(path).suffix.lower() == ".flac":
+        try:
+            import soundfile
+        except ImportError as e:
+            raise RuntimeError("FLAC input needs the soundfile package") from e
+
+        samples, sample_rate = soundfile.read(path, dtype="float32", always_2d=True)
+        return np.ascontiguousarray(samples.mean(axis=1, dtype=np.float32)), sample_rate
+
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError(f"{path} is not a WAV file")
+
+    fmt = samples = None
+    position = 12
+    while position + 8 <= len(data):
+        chunk_id, size = struct.unpack_from("<4sI", data, position)
+        body = data[position + 8 : position + 8 + size]  # all of it, if the size is unknown
+        if chunk_id == b"fmt ":
+            fmt = struct.unpack_from("<HHIIHH", body)
+            if fmt[0] == 0xFFFE:  # WAVE_FORMAT_EXTENSIBLE: the real format opens the subformat GUID
+                fmt = (struct.unpack_from("<H", body, 24)[0], *fmt[1:])
+        elif chunk_id == b"data":
+            samples = body
+            break
+        position += 8 + size + (size & 1)
+    if fmt is None or samples is None:
+        raise ValueError(f"{path} has no audio")
+
+    audio_format, channels, sample_rate, _, _, bits = fmt
+    if audio_format == 1 and bits == 16:
+        audio = np.frombuffer(samples, "<i2", len(samples) // 2).astype(np.float32) / 32768
+    elif audio_format == 3 and bits == 32:
+        audio = np.frombuffer(samples, "<f4", len(samples) // 4).astype(np.float32)
+    else:
+        raise ValueError(f"{path}: only 16-bit PCM and 32-bit float WAV files are supported")
+
+    audio = audio[: len(audio) - len(audio) % channels].reshape(-1, channels)
+    return np.ascontiguousarray(audio.mean(axis=1, dtype=np.float32)), sample_rate
+
+
+def write_audio(
+    path: Union[str, Path],
+    audio: Any,
+    sample_rate: int = SAMPLE_RATE,
+    *,
+    format: Optional[str] = None,
+    sample_format: str = "int16",
+) -> int:
+    """
+    Write mono ``audio`` (an ``mx.array`` or NumPy array in [-1, 1]) once.
+
+    The samples are read straight from the array's buffer: float32 WAV is
+    written without copying them, and 16-bit output (WAV or FLAC) is
+    converted ``BLOCK_SAMPLES`` at a time. 16-bit WAV is half the size of
+    float32, and FLAC, which needs the optional ``soundfile`` package, is
+    smaller again.
+
+    Args:
+        format: ``wav`` or ``flac``; by default taken from the file extension
+        sample_format: ``int16`` or ``float32`` (WAV only)
+
+    Returns:
+        The number of bytes written
+    """
+    format = (format or Path(path).suffix.lstrip(".")).lower()
+    if format not in FORMATS:
+        raise ValueError(f"Unsupported audio format '{format}', expected {' or '.join(FORMATS)}")
+    if sample_format not in SAMPLE_FORMATS:
+        raise ValueError(f"sample_format must be one of {', '.join(SAMPLE_FORMATS)}")
+    if format == "flac" and sample_format != "int16":
+        raise ValueError("FLAC output is 16-bit only")
+
+    samples = as_float32(audio)
+
+    if format == "flac":
+        try:
+            import soundfile
+        except ImportError as e:
+            raise RuntimeError("FLAC output needs the soundfile package") from e
+
+        with soundfile.SoundFile(
+            path, "w", sample_rate, 1, subtype="PCM_16", format="FLAC"
+        ) as output:
+            for start in range(0, len(samples), BLOCK_SAMPLES):
+                output.write(_to_int16(samples[start : start + BLOCK_SAMPLES]))
+        return os.path.getsize(path)
+
+    with open(path, "wb") as output:
+        output.write(wav_header(sample_rate, len(samples), sample_format))
+        if sample_format == "float32":
+            output.write(memoryview(samples).cast("B"))
+        else:
+            for start in range(0, len(samples), BLOCK_SAMPLES):
+                output.write(_to_int16(samples[start : start + BLOCK_SAMPLES]).data)
+        return output.tell()
@@ -0,0 +1,98 @@
+import threading
+import time
+from collections.abc import Iterator
+from typing import Any
+
+from csm_mlx.audio_io import SAMPLE_RATE, pcm16
+
+
+class AudioStream:
+    """
+    Hands audio from the generating thread to a slower reader, such as an
+    HTTP response, as 16-bit PCM.
+
+    ``push`` never blocks, so one slow client can't stall a batch that other
+    requests share. Iterating yields the audio coalesced into chunks of at
+    least ``chunk_ms``: the first chunk goes out as soon as it exists, to
+    start playback early, and later ones are held back until enough audio
+    has built up, or at most ``max_delay`` seconds. A reader that falls more
+    than ``max_buffered_ms`` behind makes ``push`` return False, which stops
+    the generation, so the buffer stays bounded; the reader then gets what
+    was buffered and the stream ends.
+    """
+
+    def __init__(
+        self,
+        *,
+        sample_rate: int = SAMPLE_RATE,
+        chunk_ms: float = 320,
+        max_delay: float = 0.25,
+        max_buffered_ms: float = 60_000,
+    ):
+        self.sample_rate = sample_rate
+        self.chunk_bytes = int(sample_rate * chunk_ms / 1000) * 2
+        self.max_delay = max_delay
+        self.max_buffered_bytes = int(sample_rate * max_buffered_ms / 1000) * 2
+
+        self._chunks: list[bytes] = []
+        self._buffered = 0
+        self._ended = False
+        self._closed = False
+        self.overflowed = False
+        self._condition = threading.Condition()
+
+    def push(self, audio: Any) -> bool:
+        """Queue ``audio``; False once the reader is gone or too far behind."""
+        data = pcm16(audio)
+        with self._condition:
+            if self._closed or self._ended:
+                return False
+            if self._buffered + len(data) > self.max_buffered_bytes:
+                self.overflowed = True
+                self._ended = True
+                self._condition.notify()
+                return False
+            self._chunks.append(data)
+            self._buffered += len(data)
+            self._condition.notify()
+        return True
+
+    def end(self) -> None:
+        """No more audio: the reader gets what is buffered, then stops."""
+        with self._condition:
+            self._ended = True
+            self._condition.notify()
+
+    def close(self) -> None:
+        """The reader has gone; drop the buffer and refuse further audio."""
+        with self._condition:
+            self._closed = True
+            self._chunks = []
+            self._buffered = 0
+            self._condition.notify()
+
+    def __iter__(self) -> Iterator[bytes]:
+        first = True
+        while True:
+            with self._condition:
+                deadline = None
+                while not (self._ended or self._closed):
+                    if self._buffered and (first or self._buffered >= self.chunk_bytes):
+                        break
+                    if self._buffered and deadline is None:
+                        deadline = time.monotonic() + self.max_delay
+                    timeout = None if deadline is None else deadline - time.monotonic()
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+
+                data = b"".join(self._chunks)
+                self._chunks = []
+                self._buffered = 0
+                done = self._ended or self._closed
+
+            if data:
+                first = False
+                yield data
+            if done:
+                return
@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Generator, Optional, Union
+
+import mlx.core as mx
+import numpy as np
+
+from csm_mlx.engine import FrameEngine
+from csm_mlx.models import CSM
+from csm_mlx.segment import Segment
+from csm_mlx.tokenizers import encode_audio, tokenize_segment
+
+# Bumped whenever the file layout changes; older files are rejected
+FORMAT_VERSION = 1
+
+
+@dataclass
+class CompiledVoice:
+    """
+    A voice prompt prepared once and reused by every request that speaks in it.
+
+    Holds the reference segments with their Mimi codes (their audio is not
+    kept) and the backbone KV state after prefilling them, so a request
+    passing it as ``voice`` instead of ``context`` skips both the Mimi
+    encoder and the prefill of the reference. The state belongs to the
+    weights identified by ``model_id``.
+    """
+
+    segments: list[Segment]
+    # one (keys, values) pair per backbone layer, each (1, n_kv_heads, length, head_dim)
+    state: list[tuple[mx.array, mx.array]]
+    length: int
+    # Hash of the prompt tokens, identifying the voice e.g. in cache keys
+    digest: str
+    model_id: str = ""
+
+    @property
+    def nbytes(self) -> int:
+        return sum(keys.nbytes + values.nbytes for keys, values in self.state)
+
+    def restore(self, cache: list[Any]) -> None:
+        """Load the voice into an empty full-precision backbone cache."""
+        for layer_cache, layer_state in zip(cache, self.state):
+            layer_cache.state = layer_state
+            layer_cache.offset = self.length
+
+
+def compile_voice_steps(
+    model: CSM,
+    context: list[Segment],
+    *,
+    model_id: str = "",
+    prefill_chunk_size: Optional[int] = None,
+    stream: Optional[mx.Stream] = None,
+) -> Generator[None, None, CompiledVoice]:
+    """
+    ``compile_voice``, yielding after every prefill chunk like
+    ``FrameEngine.prefill_steps``.
+    """
+    if not context:
+        raise ValueError("A voice needs at least one context segment")
+
+    segments, tokens, masks = [], [], []
+    for segment in context:
+        audio_tokens = segment.audio_tokens
+        if audio_tokens is None:
+            audio_tokens = encode_audio(segment.audio, n_audio_codebooks=model.n_audio_codebooks)
+        segment = Segment(
+            speaker=segment.speaker,
+            text=segment.text,
+            audio=mx.zeros((0,)),
+            audio_tokens=audio_tokens,
+        )
+        segment_tokens, segment_mask = tokenize_segment(
+            segment, n_audio_codebooks=model.n_audio_codebooks
+        )
+        segments.append(segment)
+        tokens.append(segment_tokens)
+        masks.append(segment_mask)
+
+    prompt_tokens = mx.concat(tokens, axis=0).astype(mx.int64)
+    prompt_mask = mx.concat(masks, axis=0).astype(mx.bool_)
+
+    engine = FrameEngine(model, max_frames=1, compiled=False, stream=stream)
+    yield from engine.prefill_steps(
+        mx.expand_dims(prompt_tokens, 0),
+        mx.expand_dims(prompt_mask, 0),
+        chunk_size=prefill_chunk_size,
+    )
+    state = [layer_cache.state for layer_cache in engine.backbone_cache]
+    mx.eval(state, [segment.audio_tokens for segment in segments])
+
+    digest = hashlib.sha256()
+    digest.update(np.asarray(prompt_tokens).tobytes())
+    digest.update(np.asarray(prompt_mask).tobytes())
+    return CompiledVoice(
+        segments=segments,
+        state=state,
+        length=prompt_tokens.shape[0],
+        digest=digest.hexdigest(),
+        model_id=model_id,
+    )
+
+
+def compile_voice(
+    model: CSM,
+    context: list[Segment],
+    *,
+    model_id: str = "",
+    prefill_chunk_size: Optional[int] = None,
+    stream: Optional[mx.Stream] = None,
+) -> CompiledVoice:
+    """
+    Encode the ``context`` segments with Mimi and prefill them through the
+    backbone of ``model``, whose weights ``model_id`` identifies.
+    """
+    steps = compile_voice_steps(
+        model,
+        context,
+        model_id=model_id,
+        prefill_chunk_size=prefill_chunk_size,
+        stream=stream,
+    )
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+
+
+def save_voice(voice: CompiledVoice, path: Union[str, Path]) -> None:
+    """Write ``voice`` to the safetensors file ``path``, replacing it atomically."""
+    arrays = {}
+    for index, (keys, values) in enumerate(voice.state):
+        arrays[f"keys.{index}"] = keys
+        arrays[f"values.{index}"] = values
+    for index, segment in enumerate(voice.segments):
+        arrays[f"codes.{index}"] = segment.audio_tokens
+
+    metadata = {
+        "format": str(FORMAT_VERSION),
+        "length": str(voice.length),
+        "digest": voice.digest,
+        "model_id": voice.model_id,
+        "segments": json.dumps([[segment.speaker, segment.text] for segment in voice.segments]),
+    }
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".safetensors")
+    os.close(fd)
+    try:
+        mx.save_safetensors(tmp_path, arrays, metadata=metadata)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_voice(path: Union[str, Path]) -> CompiledVoice:
+    """Read a voice written by ``save_voice``; ValueError if the file is of another format."""
+    arrays, metadata = mx.load(str(path), return_metadata=True)
+    if metadata.get("format") != str(FORMAT_VERSION):
+        raise ValueError(f"{path} is not a compiled voice of format {FORMAT_VERSION}")
+
+    segments = [
+        Segment(speaker=speaker, text=text, audio=mx.zeros((0,)), audio_tokens=arrays[f"codes.{index}"])
+        for index, (speaker, text) in enumerate(json.loads(metadata["segments"]))
+    ]
+    n_layers = sum(name.startswith("keys.") for name in arrays)
+    state = [(arrays[f"keys.{index}"], arrays[f"values.{index}"]) for index in range(n_layers)]
+    # Concrete, so any thread can use them
+    mx.eval(state, [segment.audio_tokens for segment in segments])
+
+    return CompiledVoice(
+        segments=segments,
+        state=state,
+        length=int(metadata["length"]),
+        digest=metadata["digest"],
+        model_id=metadata["model_id"],
+    )
@@ -0,0 +1,363 @@
+from collections.abc import Callable
+from typing import Any, Generator, Optional
+
+import mlx.core as mx
+from mlx.utils import tree_map
+
+from csm_mlx.kv_cache import KVCachePolicy, causal_mask
+from csm_mlx.models import CSM
+
+
+class DepthCache:
+    """
+    Fixed-size KV cache for the depth decoder.
+
+    The depth decoder only ever sees a single frame (the backbone hidden state
+    followed by one position per codebook), so it never needs more than
+    ``size`` positions. The buffer is allocated on first use and rewound with
+    ``reset`` instead of being rebuilt for every frame.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.keys: Optional[mx.array] = None
+        self.values: Optional[mx.array] = None
+        self.offset = 0
+
+    def update_and_fetch(self, keys: mx.array, values: mx.array):
+        if self.keys is None or self.keys.shape[0] != keys.shape[0]:
+            B, n_kv_heads, _, k_head_dim = keys.shape
+            v_head_dim = values.shape[3]
+            self.keys = mx.zeros((B, n_kv_heads, self.size, k_head_dim), keys.dtype)
+            self.values = mx.zeros((B, n_kv_heads, self.size, v_head_dim), values.dtype)
+
+        prev = self.offset
+        self.offset += keys.shape[2]
+        self.keys[..., prev : self.offset, :] = keys
+        self.values[..., prev : self.offset, :] = values
+        return self.keys[..., : self.offset, :], self.values[..., : self.offset, :]
+
+    def reset(self) -> None:
+        self.offset = 0
+
+
+def select_cache_rows(cache: list[Any], rows: mx.array) -> None:
+    """Keep only ``rows`` of the batch dimension of every layer cache, in place."""
+    for layer_cache in cache:
+        layer_cache.keys, layer_cache.values = tree_map(
+            lambda x: x[rows], (layer_cache.keys, layer_cache.values)
+        )
+
+
+class FrameEngine:
+    """
+    Frame-step engine for a single generation.
+
+    Everything that is identical from one frame to the next is set up once:
+    the depth decoder cache, a ``(batch, max_frames, n_codebooks)`` code
+    buffer the frames are written into, and the token mask of an audio frame.
+
+    ``n_codebooks`` below ``model.n_audio_codebooks`` is a fast mode: only the
+    first ``n_codebooks`` codebooks are sampled, so the depth decoder runs
+    ``n_codebooks - 1`` times per frame instead of 31. The remaining codebooks
+    are zero-filled and masked out of the next backbone input, and the frames
+    must be decoded with ``decode_audio(..., n_audio_codebooks=n_codebooks)``.
+
+    The codebook-0 head and the depth decoder loop see the same shapes on
+    every frame and are wrapped in ``mx.compile`` (``compiled=True``), so the
+    graph for those 31 decoder steps is built once per batch size. The
+    backbone step itself stays eager: its KV cache grows by one position each
+    frame. With ``compiled=True`` the sampler must be traceable, which is the
+    case for the samplers from ``mlx_lm.sample_utils.make_sampler``.
+
+    ``kv_cache`` selects how the backbone cache stores keys and values (see
+    ``KVCachePolicy``); quantized and rotating caches only support a batch of
+    one unless every step passes its own ``attention_mask``.
+    """
+
+    def __init__(
+        self,
+        model: CSM,
+        *,
+        max_frames: int,
+        batch_size: int = 1,
+        sampler: Optional[Callable[..., mx.array]] = None,
+        n_codebooks: Optional[int] = None,
+        compiled: bool = True,
+        stream: Optional[mx.Stream] = None,
+        kv_cache: Optional[KVCachePolicy] = None,
+    ):
+        self.model = model
+        self.sampler = sampler or (lambda x: mx.argmax(x, axis=-1))
+        self.stream = stream or mx.default_stream(mx.default_device())
+        self.n_codebooks = n_codebooks or model.n_audio_codebooks
+        if not 1 <= self.n_codebooks <= model.n_audio_codebooks:
+            raise ValueError(
+                f"n_codebooks must be between 1 and {model.n_audio_codebooks}"
+            )
+
+        self.backbone_cache = (kv_cache or KVCachePolicy()).make_cache(model.backbone)
+        self.decoder_cache = [
+            DepthCache(self.n_codebooks) for _ in model.decoder.layers
+        ]
+        self.codes = mx.zeros((batch_size, max_frames, self.n_codebooks), dtype=mx.int32)
+        # (1, 1, 33): the sampled codebooks are visible, the rest and text are not
+        self.frame_mask = mx.expand_dims(
+            mx.arange(model.n_audio_codebooks + 1) < self.n_codebooks, (0, 1)
+        )
+
+        # Arrays ``_sample`` reads besides the logits, e.g. per-row sampling
+        # parameters. Mutate in place so compiled decoding sees new values.
+        self.sampling_state: list[mx.array] = []
+        self.next_embeds: Optional[mx.array] = None
+
+        if compiled:
+            self._decode = mx.compile(
+                self._decode_fresh,
+                inputs=[mx.random.state, self.sampling_state],
+                outputs=mx.random.state,
+            )
+        else:
+            self._decode = self._decode_reused
+
+    def _sample(self, logits: mx.array, codebook: int) -> mx.array:
+        return self.sampler(logits)
+
+    def _depth_decode(
+        self, backbone_last_hidden: mx.array, cache: list[Any]
+    ) -> tuple[mx.array, mx.array]:
+        model = self.model
+
+        c0_logits = model.codebook0_head(backbone_last_hidden)
+        c0_sample = mx.expand_dims(self._sample(c0_logits, 0), axis=-1)
+        c0_embeds = model.embed_audio(0, c0_sample)
+
+        decoder_inputs = mx.concat(
+            [mx.expand_dims(backbone_last_hidden, axis=1), c0_embeds], axis=1
+        )
+        samples = [c0_sample]
+        embeds = [c0_embeds]
+
+        for index in range(1, self.n_codebooks):
+            decoder_hidden = model.decoder(model.projection(decoder_inputs), cache=cache)
+
+            ci_logits = model.audio_head_logits(index, decoder_hidden[:, -1, :])
+            ci_sample = mx.expand_dims(self._sample(ci_logits, index), axis=-1)
+
+            decoder_inputs = model.embed_audio(index, ci_sample)
+            samples.append(ci_sample)
+            embeds.append(decoder_inputs)
+
+        # The sampled codebooks' embeddings, summed, are exactly the next
+        # backbone input, so the next step does not look them up again
+        return mx.concat(samples, axis=1), mx.concat(embeds, axis=1).sum(axis=1, keepdims=True)
+
+    def _decode_reused(self, backbone_last_hidden: mx.array) -> tuple[mx.array, mx.array]:
+        for layer_cache in self.decoder_cache:
+            layer_cache.reset()
+        return self._depth_decode(backbone_last_hidden, self.decoder_cache)
+
+    def _decode_fresh(self, backbone_last_hidden: mx.array) -> tuple[mx.array, mx.array]:
+        # Only traced once per shape: the buffers become part of the compiled graph
+        cache = [DepthCache(self.n_codebooks) for _ in self.model.decoder.layers]
+        return self._depth_decode(backbone_last_hidden, cache)
+
+    def _attention_mask(
+        self, length: int, attention_mask: Optional[mx.array], dtype: mx.Dtype
+    ) -> Optional[mx.array]:
+        if attention_mask is None:
+            attention_mask = causal_mask(self.backbone_cache[0], length)
+        if attention_mask is not None and mx.issubdtype(attention_mask.dtype, mx.floating):
+            attention_mask = attention_mask.astype(dtype)
+        return attention_mask
+
+    def embed(self, tokens: mx.array, token_mask: mx.array) -> mx.array:
+        """Backbone input for ``tokens``, looking up only the unmasked columns."""
+        return self.model.embed_masked(tokens, token_mask)
+
+    def prefill(
+        self,
+        tokens: mx.array,
+        token_mask: mx.array,
+        *,
+        chunk_size: Optional[int] = None,
+    ) -> None:
+        """
+        Run the backbone over ``tokens`` without sampling a frame.
+
+        The backbone cache grows by exactly ``tokens.shape[1]`` positions, so
+        its ``state`` can be snapshotted without slicing into a larger buffer.
+        See ``prefill_steps`` for ``chunk_size``.
+        """
+        for _ in self.prefill_steps(tokens, token_mask, chunk_size=chunk_size):
+            pass
+
+    def prefill_steps(
+        self,
+        tokens: mx.array,
+        token_mask: mx.array,
+        *,
+        chunk_size: Optional[int] = None,
+    ) -> Generator[None, None, None]:
+        """
+        ``prefill``, yielding after each chunk of ``chunk_size`` positions.
+
+        Each chunk is embedded, run through the backbone and evaluated before
+        the next one starts, so activation memory depends on ``chunk_size``
+        rather than on the prompt length. The caller can run other work
+        (e.g. decode steps of another engine) between chunks. Without
+        ``chunk_size`` the whole prompt is one chunk.
+        """
+        length = tokens.shape[1]
+        chunk_size = chunk_size or length
+
+        # Grow each cache once, to exactly the prompt length
+        steps = [layer_cache.step for layer_cache in self.backbone_cache]
+        for layer_cache in self.backbone_cache:
+            layer_cache.step = length
+
+        try:
+            for start in range(0, length, chunk_size):
+                backbone_input = self.embed(
+                    tokens[:, start : start + chunk_size],
+                    token_mask[:, start : start + chunk_size],
+                )
+                mask = self._attention_mask(
+                    backbone_input.shape[1], None, backbone_input.dtype
+                )
+                with mx.stream(self.stream):
+                    self.model.backbone(
+                        backbone_input, mask=mask, cache=self.backbone_cache
+                    )
+                mx.eval([layer_cache.state for layer_cache in self.backbone_cache])
+                yield
+        finally:
+            for layer_cache, step in zip(self.backbone_cache, steps):
+                layer_cache.step = step
+
+    def step(
+        self,
+        tokens: mx.array,
+        token_mask: mx.array,
+        *,
+        attention_mask: Optional[mx.array] = None,
+    ) -> mx.array:
+        """
+        Run one backbone step over ``tokens`` and sample the next frame.
+
+        Returns:
+            (batch, n_codebooks), not yet evaluated
+        """
+        return self.step_embeds(
+            self.embed(tokens, token_mask), attention_mask=attention_mask
+        )
+
+    def step_embeds(
+        self,
+        backbone_input: mx.array,
+        *,
+        attention_mask: Optional[mx.array] = None,
+    ) -> mx.array:
+        """
+        ``step`` on an already embedded (batch, seq_len, embedding) input.
+
+        After every step ``next_embeds`` holds the backbone input that feeds
+        the sampled frame back in.
+        """
+        attention_mask = self._attention_mask(
+            backbone_input.shape[1], attention_mask, backbone_input.dtype
+        )
+
+        with mx.stream(self.stream):
+            backbone_hidden = self.model.backbone(
+                backbone_input, mask=attention_mask, cache=self.backbone_cache
+            )
+            sample, self.next_embeds = self._decode(backbone_hidden[:, -1, :])
+        return sample
+
+    def next_input(self, sample: mx.array) -> tuple[mx.array, mx.array]:
+        """
+        Backbone tokens and token mask that feed ``sample`` back in.
+
+        For a frame this engine sampled, ``next_embeds`` is the same input
+        already embedded.
+        """
+        n_unsampled = self.model.n_audio_codebooks + 1 - self.n_codebooks
+        tokens = mx.concat(
+            [
+                sample.astype(mx.int64),
+                mx.zeros((sample.shape[0], n_unsampled), dtype=mx.int64),
+            ],
+            axis=1,
+        )
+        return mx.expand_dims(tokens, 1), self.frame_mask
+
+    def write(self, index: int, sample: mx.array) -> None:
+        self.codes[:, index] = sample
+
+    def frames(self, n_frames: int) -> mx.array:
+        """
+        Returns:
+            (batch, n_codebooks, n_frames), ready for ``decode_audio``
+        """
+        return self.codes[:, :n_frames].swapaxes(1, 2)
+
+    def run(
+        self,
+        tokens: mx.array,
+        token_mask: mx.array,
+        max_frames: int,
+        *,
+        pipelined: bool = True,
+    ) -> Generator[mx.array, None, None]:
+        """
+        Yield sampled frames until an all-zero (EOS) frame or ``max_frames``.
+
+        Every yielded frame has already been written to the code buffer, so
+        ``frames(n)`` returns the first ``n`` of them.
+
+        With ``pipelined=True`` frame N+1 is built and queued with
+        ``mx.async_eval`` before frame N is read back for the EOS check, so the
+        host never waits on the device between frames. EOS is therefore seen
+        one frame late and the frame queued after it is discarded.
+        """
+        backbone_input = self.embed(tokens, token_mask)
+
+        if not pipelined:
+            for index in range(max_frames):
+                sample = self.step_embeds(backbone_input)
+
+                if sample.sum() == 0:
+                    return  # eos
+
+                self.write(index, sample)
+                yield sample
+
+                backbone_input = self.next_embeds
+            return
+
+        sample = self.step_embeds(backbone_input)
+        eos = sample.sum() == 0
+        mx.async_eval(sample, eos)
+
+        for index in range(max_frames):
+            if index + 1 < max_frames:
+                next_sample = self.step_embeds(self.next_embeds)
+                next_eos = next_sample.sum() == 0
+                mx.async_eval(next_sample, next_eos)
+
+            if eos.item():
+                return  # eos, the frame queued above is dropped
+
+            self.write(index, sample)
+            yield sample
+
+            if index + 1 == max_frames:
+                return
+            sample, eos = next_sample, next_eos
+
+    def select_rows(self, rows: mx.array) -> None:
+        select_cache_rows(self.backbone_cache, rows)
+        self.codes = self.codes[rows]
+        if self.next_embeds is not None:
+            self.next_embeds = self.next_embeds[rows]
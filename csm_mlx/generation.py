@@ -4,9 +4,14 @@ from typing import Any, Generator, Optional
 import mlx.core as mx
 from mlx_lm.models.cache import make_prompt_cache
 
+from csm_mlx.compiled_voice import CompiledVoice
+from csm_mlx.engine import FrameEngine
+from csm_mlx.kv_cache import KVCachePolicy
 from csm_mlx.models import CSM
+from csm_mlx.prefix_cache import PrefixCache
 from csm_mlx.segment import Segment
 from csm_mlx.tokenizers import (
+    StreamingAudioDecoder,
     decode_audio,
     tokenize_segment,
     tokenize_text_segment,
@@ -15,6 +20,10 @@ from csm_mlx.tokenizers import (
 default_stream = mx.new_stream(mx.default_device())
 
 
+class PromptTooLong(ValueError):
+    """Raised when the prompt leaves no room in the model's context for the audio to generate."""
+
+
 def generate_frame(
     model: CSM,
     tokens: mx.array,
@@ -22,17 +31,20 @@ def generate_frame(
     token_mask: Optional[mx.array] = None,
     sampler: Optional[Callable[..., mx.array]] = None,
     cache: Optional[Any] = None,
+    attention_mask: Optional[mx.array] = None,
     stream: mx.Stream = default_stream,
 ) -> mx.array:
     sampler = sampler or (lambda x: mx.argmax(x, axis=-1))
     token_mask = token_mask if token_mask is not None else mx.ones_like(tokens)
 
-    backbone_embeds = model.embed_tokens(tokens)
-    backbone_embeds = backbone_embeds * mx.expand_dims(token_mask, axis=-1)
-    backbone_input = backbone_embeds.sum(-2)
+    backbone_input = model.embed_masked(tokens, token_mask)
+    if attention_mask is not None and mx.issubdtype(attention_mask.dtype, mx.floating):
+        attention_mask = attention_mask.astype(backbone_input.dtype)
 
     with mx.stream(stream):
-        backbone_hidden = model.backbone(backbone_input, cache=cache)
+        backbone_hidden = model.backbone(
+            backbone_input, mask=attention_mask, cache=cache
+        )
         backbone_last_hidden = backbone_hidden[:, -1, :]
 
         c0_logits = model.codebook0_head(backbone_last_hidden)
@@ -51,7 +63,7 @@ def generate_frame(
                 cache=decoder_cache,
             )
 
-            ci_logits = mx.matmul(decoder_hidden[:, -1, :], model.audio_head[index - 1])
+            ci_logits = model.audio_head_logits(index, decoder_hidden[:, -1, :])
             ci_sample = mx.expand_dims(sampler(ci_logits), axis=-1)
             ci_embeds = model.embed_audio(index, ci_sample)
 
@@ -61,18 +73,9 @@ def generate_frame(
     return decoder_sample
 
 
-def generate(
-    model: CSM,
-    text: str,
-    speaker: int,
-    context: list[Segment],
-    max_audio_length_ms: float = 90_000,
-    *,
-    sampler: Optional[Callable[..., mx.array]] = None,
-    stream: mx.Stream = default_stream,
-) -> mx.array:
-    max_audio_frames = int(max_audio_length_ms / 80)
-
+def _tokenize_prompt(
+    model: CSM, text: str, speaker: int, context: list[Segment]
+) -> tuple[mx.array, mx.array, int]:
     tokens, tokens_mask = [], []
     for segment in context:
         segment_tokens, segment_tokens_mask = tokenize_segment(
@@ -80,51 +83,236 @@ def generate(
         )
         tokens.append(segment_tokens)
         tokens_mask.append(segment_tokens_mask)
+    context_length = sum(segment_tokens.shape[0] for segment_tokens in tokens)
 
     text_segment_tokens, text_segment_tokens_mask = tokenize_text_segment(text, speaker)
     tokens.append(text_segment_tokens)
     tokens_mask.append(text_segment_tokens_mask)
 
-    prompt_tokens = mx.concat(tokens, axis=0).astype(mx.int64)
-    prompt_tokens_mask = mx.concat(tokens_mask, axis=0)
+    return (
+        mx.concat(tokens, axis=0).astype(mx.int64),
+        mx.concat(tokens_mask, axis=0),
+        context_length,
+    )
+
+
+def tokenize_prompt(
+    model: CSM, text: str, speaker: int, context: list[Segment]
+) -> tuple[mx.array, mx.array]:
+    """
+    Returns:
+        (seq_len, 33), (seq_len, 33)
+    """
+    prompt_tokens, prompt_tokens_mask, _ = _tokenize_prompt(
+        model, text, speaker, context
+    )
+    return prompt_tokens, prompt_tokens_mask
+
+
+def _prepare_steps(
+    model: CSM,
+    text: str,
+    speaker: int,
+    context: list[Segment],
+    max_audio_frames: int,
+    *,
+    sampler: Optional[Callable[..., mx.array]],
+    compiled: bool,
+    stream: mx.Stream,
+    prefix_cache: Optional[PrefixCache],
+    n_codebooks: Optional[int] = None,
+    prefill_chunk_size: Optional[int] = None,
+    kv_cache: Optional[KVCachePolicy] = None,
+    voice: Optional[CompiledVoice] = None,
+) -> Generator[None, None, tuple[FrameEngine, mx.array, mx.array]]:
+    """
+    Tokenize the prompt and set up a FrameEngine for it.
+
+    With a ``prefix_cache`` the context segments are prefilled here: the
+    longest cached prefix is restored, only the remainder goes through the
+    backbone, and the resulting context state is cached for later requests.
+
+    A ``voice`` takes the place of the context segments: its backbone state
+    is restored and nothing of it is prefilled. ``context`` must then be empty.
+
+    With a ``prefill_chunk_size`` the rest of the prompt, all but its last
+    position, is prefilled here too, in chunks of that many positions.
+
+    ``kv_cache`` picks the backbone cache (see ``KVCachePolicy``). The
+    prefix cache and compiled voices hold full-precision states, so they
+    only work with the default policy.
+
+    Yields after every prefill chunk, so a caller can interleave other work.
+
+    Returns:
+        The engine and the (1, seq_len, 33) tokens and mask still to be fed.
+    """
+    prompt_tokens, prompt_tokens_mask, context_length = _tokenize_prompt(
+        model, text, speaker, context
+    )
 
-    samples = []
-    input = mx.expand_dims(prompt_tokens, 0)
-    mask = mx.expand_dims(prompt_tokens_mask, 0)
-    backbone_cache = make_prompt_cache(model.backbone)
+    if prefix_cache is not None and kv_cache is not None and not kv_cache.is_default:
+        raise ValueError("prefix_cache requires the default KV cache policy")
+    if voice is not None:
+        if context:
+            raise ValueError("Pass a compiled voice or context segments, not both")
+        if kv_cache is not None and not kv_cache.is_default:
+            raise ValueError("A compiled voice requires the default KV cache policy")
 
+    voice_length = voice.length if voice is not None else 0
     max_seq_len = 2048 - max_audio_frames
-    if input.shape[1] >= max_seq_len:
-        raise ValueError(
+    if voice_length + prompt_tokens.shape[0] >= max_seq_len:
+        raise PromptTooLong(
             f"Inputs too long, must be below max_seq_len - max_audio_frames: {max_seq_len}"
         )
 
-    for _ in range(max_audio_frames):
-        sample = generate_frame(
-            model,
-            input,
-            sampler=sampler,
-            token_mask=mask,
-            cache=backbone_cache,
-            stream=stream,
-        )
+    engine = FrameEngine(
+        model,
+        max_frames=max_audio_frames,
+        sampler=sampler,
+        n_codebooks=n_codebooks,
+        compiled=compiled,
+        stream=stream,
+        kv_cache=kv_cache,
+    )
 
-        if sample.sum() == 0:
-            break  # eos
+    if voice is not None:
+        voice.restore(engine.backbone_cache)
+
+    if prefix_cache is not None and context_length > 0:
+        cached_length = 0
+        entry = prefix_cache.lookup(prompt_tokens, prompt_tokens_mask, context_length)
+        if entry is not None:
+            prefix_cache.restore(entry, engine.backbone_cache)
+            cached_length = entry.length
+
+        if cached_length < context_length:
+            yield from engine.prefill_steps(
+                mx.expand_dims(prompt_tokens[cached_length:context_length], 0),
+                mx.expand_dims(prompt_tokens_mask[cached_length:context_length], 0),
+                chunk_size=prefill_chunk_size,
+            )
+            prefix_cache.insert(
+                prompt_tokens[:context_length],
+                prompt_tokens_mask[:context_length],
+                engine.backbone_cache,
+            )
 
-        samples.append(sample)
+        prompt_tokens = prompt_tokens[context_length:]
+        prompt_tokens_mask = prompt_tokens_mask[context_length:]
 
-        input = mx.expand_dims(mx.concat([sample, mx.zeros((1, 1))], axis=1), 1).astype(
-            mx.int64
+    if prefill_chunk_size is not None and prompt_tokens.shape[0] > 1:
+        yield from engine.prefill_steps(
+            mx.expand_dims(prompt_tokens[:-1], 0),
+            mx.expand_dims(prompt_tokens_mask[:-1], 0),
+            chunk_size=prefill_chunk_size,
         )
-        mask = mx.expand_dims(
-            mx.concat([mx.ones_like(sample), mx.zeros((1, 1))], axis=1), 1
-        ).astype(mx.bool_)  # type: ignore
+        prompt_tokens = prompt_tokens[-1:]
+        prompt_tokens_mask = prompt_tokens_mask[-1:]
+
+    return (
+        engine,
+        mx.expand_dims(prompt_tokens, 0),
+        mx.expand_dims(prompt_tokens_mask, 0),
+    )
+
+
+def _prepare(*args, **kwargs) -> tuple[FrameEngine, mx.array, mx.array]:
+    """``_prepare_steps``, run to completion."""
+    steps = _prepare_steps(*args, **kwargs)
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+
+
+def generate_codes(
+    model: CSM,
+    text: str,
+    speaker: int,
+    context: list[Segment],
+    max_audio_length_ms: float = 90_000,
+    *,
+    sampler: Optional[Callable[..., mx.array]] = None,
+    compiled: bool = True,
+    pipelined: bool = True,
+    prefix_cache: Optional[PrefixCache] = None,
+    n_codebooks: Optional[int] = None,
+    prefill_chunk_size: Optional[int] = None,
+    kv_cache: Optional[KVCachePolicy] = None,
+    voice: Optional[CompiledVoice] = None,
+    stream: mx.Stream = default_stream,
+) -> mx.array:
+    """
+    Like ``generate``, but return the Mimi codes instead of decoding them.
+
+    Returns:
+        (1, n_codebooks, n_frames)
+    """
+    max_audio_frames = int(max_audio_length_ms / 80)
+
+    engine, input, mask = _prepare(
+        model,
+        text,
+        speaker,
+        context,
+        max_audio_frames,
+        sampler=sampler,
+        compiled=compiled,
+        stream=stream,
+        prefix_cache=prefix_cache,
+        n_codebooks=n_codebooks,
+        prefill_chunk_size=prefill_chunk_size,
+        kv_cache=kv_cache,
+        voice=voice,
+    )
+
+    n_frames = 0
+    for _ in engine.run(input, mask, max_audio_frames, pipelined=pipelined):
+        n_frames += 1
+
+    return engine.frames(n_frames)
+
+
+def generate(
+    model: CSM,
+    text: str,
+    speaker: int,
+    context: list[Segment],
+    max_audio_length_ms: float = 90_000,
+    *,
+    sampler: Optional[Callable[..., mx.array]] = None,
+    compiled: bool = True,
+    pipelined: bool = True,
+    prefix_cache: Optional[PrefixCache] = None,
+    n_codebooks: Optional[int] = None,
+    prefill_chunk_size: Optional[int] = None,
+    kv_cache: Optional[KVCachePolicy] = None,
+    voice: Optional[CompiledVoice] = None,
+    stream: mx.Stream = default_stream,
+) -> mx.array:
+    audio_tokens = generate_codes(
+        model,
+        text,
+        speaker,
+        context,
+        max_audio_length_ms,
+        sampler=sampler,
+        compiled=compiled,
+        pipelined=pipelined,
+        prefix_cache=prefix_cache,
+        n_codebooks=n_codebooks,
+        prefill_chunk_size=prefill_chunk_size,
+        kv_cache=kv_cache,
+        voice=voice,
+        stream=stream,
+    )
 
     audio = (
         decode_audio(
-            mx.stack(samples).transpose(1, 2, 0),
-            n_audio_codebooks=model.n_audio_codebooks,
+            audio_tokens,
+            n_audio_codebooks=audio_tokens.shape[1],
         )
         .squeeze(0)
         .squeeze(0)
@@ -143,61 +331,186 @@ def stream_generate(
     max_audio_length_ms: float = 90_000,
     *,
     sampler: Optional[Callable[..., mx.array]] = None,
+    compiled: bool = True,
+    pipelined: bool = True,
+    chunk_frames: int = 1,
+    prefix_cache: Optional[PrefixCache] = None,
+    n_codebooks: Optional[int] = None,
+    prefill_chunk_size: Optional[int] = None,
+    kv_cache: Optional[KVCachePolicy] = None,
+    voice: Optional[CompiledVoice] = None,
     stream: mx.Stream = default_stream,
 ) -> Generator[mx.array, None, None]:
+    """
+    Yield audio as it is generated, ``chunk_frames`` frames (80 ms each) at a
+    time. The chunks are decoded by one streaming Mimi session, so they can be
+    concatenated (or played back to back) without seams.
+    """
     max_audio_frames = int(max_audio_length_ms / 80)
 
-    tokens, tokens_mask = [], []
-    for segment in context:
-        segment_tokens, segment_tokens_mask = tokenize_segment(
-            segment, n_audio_codebooks=model.n_audio_codebooks
+    engine, input, mask = _prepare(
+        model,
+        text,
+        speaker,
+        context,
+        max_audio_frames,
+        sampler=sampler,
+        compiled=compiled,
+        stream=stream,
+        prefix_cache=prefix_cache,
+        n_codebooks=n_codebooks,
+        prefill_chunk_size=prefill_chunk_size,
+        kv_cache=kv_cache,
+        voice=voice,
+    )
+
+    with StreamingAudioDecoder(
+        n_audio_codebooks=engine.n_codebooks, chunk_frames=chunk_frames
+    ) as decoder:
+        for sample in engine.run(input, mask, max_audio_frames, pipelined=pipelined):
+            decoded = decoder.push(sample)
+            if decoded is not None:
+                yield decoded.squeeze(0).squeeze(0)
+
+        decoded = decoder.flush()
+        if decoded is not None:
+            yield decoded.squeeze(0).squeeze(0)
+
+
+def _padding_mask(padding: mx.array, query_len: int, key_len: int) -> mx.array:
+    """
+    Additive (batch, 1, query_len, key_len) causal mask that also hides each
+    row's left padding. A position can always attend to itself so that padded
+    queries never see an empty softmax.
+    """
+    keys = mx.arange(key_len)
+    queries = mx.expand_dims(mx.arange(key_len - query_len, key_len), -1)
+
+    visible = (queries >= keys) & (keys >= padding[:, None, None])
+    visible = visible | (queries == keys)
+
+    return mx.expand_dims(mx.where(visible, 0.0, -1e9), 1)
+
+
+def _decode_rows(frames: mx.array) -> list[mx.array]:
+    if frames.shape[-1] == 0:
+        return [mx.zeros((0,)) for _ in range(frames.shape[0])]
+
+    return [
+        decode_audio(
+            frames[index : index + 1], n_audio_codebooks=frames.shape[1]
         )
-        tokens.append(segment_tokens)
-        tokens_mask.append(segment_tokens_mask)
+        .squeeze(0)
+        .squeeze(0)
+        for index in range(frames.shape[0])
+    ]
 
-    text_segment_tokens, text_segment_tokens_mask = tokenize_text_segment(text, speaker)
-    tokens.append(text_segment_tokens)
-    tokens_mask.append(text_segment_tokens_mask)
 
-    prompt_tokens = mx.concat(tokens, axis=0).astype(mx.int64)
-    prompt_tokens_mask = mx.concat(tokens_mask, axis=0)
+def generate_batch(
+    model: CSM,
+    texts: list[str],
+    speakers: list[int],
+    contexts: Optional[list[list[Segment]]] = None,
+    max_audio_length_ms: float = 90_000,
+    *,
+    sampler: Optional[Callable[..., mx.array]] = None,
+    compiled: bool = True,
+    n_codebooks: Optional[int] = None,
+    stream: mx.Stream = default_stream,
+) -> list[mx.array]:
+    """
+    Generate several utterances at once.
+
+    Prompts are left-padded to a common length so the backbone and the depth
+    decoder run over the whole batch on every frame. Each row stops on its own
+    EOS frame and is dropped from the batch (and from the backbone cache), so
+    the remaining rows keep decoding at a smaller batch size.
+
+    Returns:
+        One audio array per text, in input order.
+    """
+    contexts = contexts if contexts is not None else [[] for _ in texts]
+    if not len(texts) == len(speakers) == len(contexts):
+        raise ValueError("texts, speakers and contexts must have the same length")
+
+    max_audio_frames = int(max_audio_length_ms / 80)
 
-    input = mx.expand_dims(prompt_tokens, 0)
-    mask = mx.expand_dims(prompt_tokens_mask, 0)
-    backbone_cache = make_prompt_cache(model.backbone)
+    prompts = [
+        tokenize_prompt(model, text, speaker, context)
+        for text, speaker, context in zip(texts, speakers, contexts)
+    ]
+    lengths = [prompt_tokens.shape[0] for prompt_tokens, _ in prompts]
+    width = max(lengths)
 
     max_seq_len = 2048 - max_audio_frames
-    if input.shape[1] >= max_seq_len:
-        raise ValueError(
+    if width >= max_seq_len:
+        raise PromptTooLong(
             f"Inputs too long, must be below max_seq_len - max_audio_frames: {max_seq_len}"
         )
 
-    for _ in range(max_audio_frames):
-        sample = generate_frame(
-            model,
-            input,
-            sampler=sampler,
-            token_mask=mask,
-            cache=backbone_cache,
-            stream=stream,
-        )
+    input = mx.stack(
+        [
+            mx.pad(prompt_tokens, [(width - length, 0), (0, 0)])
+            for (prompt_tokens, _), length in zip(prompts, lengths)
+        ]
+    )
+    mask = mx.stack(
+        [
+            mx.pad(prompt_tokens_mask.astype(mx.int64), [(width - length, 0), (0, 0)])
+            for (_, prompt_tokens_mask), length in zip(prompts, lengths)
+        ]
+    ).astype(mx.bool_)
+    padding = mx.array([width - length for length in lengths])
+
+    engine = FrameEngine(
+        model,
+        max_frames=max_audio_frames,
+        batch_size=len(texts),
+        sampler=sampler,
+        n_codebooks=n_codebooks,
+        compiled=compiled,
+        stream=stream,
+    )
 
-        if sample.sum() == 0:
-            break  # eos
+    # rows[i] is the index into `texts` of the i-th row still in the batch
+    rows = list(range(len(texts)))
+    audio: list[Optional[mx.array]] = [None] * len(texts)
 
-        input = mx.expand_dims(mx.concat([sample, mx.zeros((1, 1))], axis=1), 1).astype(
-            mx.int64
-        )
-        mask = mx.expand_dims(
-            mx.concat([mx.ones_like(sample), mx.zeros((1, 1))], axis=1), 1
-        )
+    backbone_input = engine.embed(input, mask)
 
-        decoded = (
-            decode_audio(
-                mx.expand_dims(sample, 0).transpose(1, 2, 0),
-                n_audio_codebooks=model.n_audio_codebooks,
-            )
-            .squeeze(0)
-            .squeeze(0)
+    n_frames = 0
+    for _ in range(max_audio_frames):
+        query_len = backbone_input.shape[1]
+        key_len = engine.backbone_cache[0].offset + query_len
+        sample = engine.step_embeds(
+            backbone_input,
+            attention_mask=_padding_mask(padding, query_len, key_len),
         )
-        yield decoded
+
+        finished = (sample.sum(axis=-1) == 0).tolist()
+        if any(finished):
+            done = [index for index, eos in enumerate(finished) if eos]
+            for index, row_audio in zip(
+                done, _decode_rows(engine.frames(n_frames)[mx.array(done)])
+            ):
+                audio[rows[index]] = row_audio
+
+            keep = [index for index, eos in enumerate(finished) if not eos]
+            if not keep:
+                break  # eos on every row
+
+            keep_rows = mx.array(keep)
+            rows = [rows[index] for index in keep]
+            sample = sample[keep_rows]
+            padding = padding[keep_rows]
+            engine.select_rows(keep_rows)
+
+        engine.write(n_frames, sample)
+        n_frames += 1
+
+        backbone_input = engine.next_embeds
+    else:
+        for row, row_audio in zip(rows, _decode_rows(engine.frames(n_frames))):
+            audio[row] = row_audio
+
+    return audio  # type: ignore
@@ -0,0 +1,153 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Optional, Union
+
+from csm_mlx.scheduler import AudioCallback, BatchScheduler, SpeechRequest
+from csm_mlx.worker_pool import WorkerPool
+
+
+class TooManyJobs(RuntimeError):
+    """Raised by ``JobStore.submit`` when every retained job is still unfinished."""
+
+
+@dataclass
+class Job:
+    id: str
+    max_frames: int
+    created_at: float = field(default_factory=time.time)
+    frames: int = 0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    # What ``finish`` returned for the audio, or the audio itself
+    result: Any = None
+    error: Optional[str] = None
+    future: Optional[Future] = field(default=None, repr=False)
+
+    @property
+    def status(self) -> str:
+        if self.error is not None:
+            return "failed"
+        if self.finished_at is not None:
+            return "done"
+        # Set by the first progress report: schedulers mark futures as running
+        # as soon as they are queued, so future.running() can't tell
+        if self.started_at is not None:
+            return "running"
+        return "queued"
+
+    def to_dict(self) -> dict[str, Any]:
+        """Status and progress, without the result"""
+        return {
+            "id": self.id,
+            "status": self.status,
+            "progress": {
+                "frames": self.frames,
+                "max_frames": self.max_frames,
+                "fraction": self.frames / self.max_frames if self.max_frames else 1.0,
+            },
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+
+class JobStore:
+    """
+    Asynchronous generation on top of a ``BatchScheduler`` or ``WorkerPool``.
+
+    ``submit`` returns a ``Job`` right away; its status and progress (frames
+    generated against the request's frame budget) update as it runs. The
+    optional ``finish`` callback turns the audio into the stored result
+    (e.g. writes a file and returns its URL). It runs on a thread of its
+    own, so slow I/O never stalls the shared batch.
+
+    Finished jobs are kept for ``retention_seconds``. At most ``max_jobs``
+    are kept in total: the oldest finished jobs make room for new ones, and
+    when all of them are still unfinished ``submit`` raises ``TooManyJobs``.
+    """
+
+    def __init__(
+        self,
+        scheduler: Union[BatchScheduler, WorkerPool],
+        *,
+        max_jobs: int = 1000,
+        retention_seconds: float = 3600.0,
+    ):
+        self.scheduler = scheduler
+        self.max_jobs = max_jobs
+        self.retention_seconds = retention_seconds
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._lock = threading.Lock()
+        self._finisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="csm-job-finish")
+
+    def submit(
+        self,
+        request: SpeechRequest,
+        finish: Optional[Callable[[Any], Any]] = None,
+        on_audio: Optional[AudioCallback] = None,
+    ) -> Job:
+        """Queue ``request``; ``on_audio`` streams its audio as in ``BatchScheduler.submit``."""
+        job = Job(id=uuid.uuid4().hex, max_frames=int(request.max_audio_length_ms / 80))
+        with self._lock:
+            self._expire()
+            if len(self._jobs) >= self.max_jobs:
+                raise TooManyJobs(f"{self.max_jobs} jobs are still running or queued")
+            self._jobs[job.id] = job
+
+        def progress(frames: int, max_frames: int) -> None:
+            job.started_at = job.started_at or time.time()
+            job.frames = frames
+
+        try:
+            job.future = future = self.scheduler.submit(
+                request, on_progress=progress, on_audio=on_audio
+            )
+        except Exception:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+            raise
+        future.add_done_callback(
+            lambda future: self._finisher.submit(self._finish, job, future, finish)
+        )
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """The job, or None if it is unknown or has expired."""
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            self._expire()
+            counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return counts
+
+    def _finish(self, job: Job, future: Future, finish: Optional[Callable[[Any], Any]]) -> None:
+        try:
+            audio = future.result()
+            job.result = finish(audio) if finish is not None else audio
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+        job.started_at = job.started_at or time.time()
+        job.finished_at = time.time()
+
+    def _expire(self) -> None:
+        # Called with the lock held
+        now = time.time()
+        finished = [job for job in self._jobs.values() if job.finished_at is not None]
+        for job in finished:
+            if now - job.finished_at > self.retention_seconds:
+                del self._jobs[job.id]
+        # Oldest first, as submitted
+        finished = [job for job in finished if job.id in self._jobs]
+        while len(self._jobs) >= self.max_jobs and finished:
+            del self._jobs[finished.pop(0).id]
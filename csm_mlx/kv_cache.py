@@ -0,0 +1,101 @@
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import mlx.core as mx
+from mlx import nn
+from mlx_lm.models.base import create_causal_mask
+from mlx_lm.models.cache import KVCache, QuantizedKVCache, RotatingKVCache
+
+
+@dataclass(frozen=True)
+class KVCachePolicy:
+    """
+    How the backbone stores keys and values during generation.
+
+    The default keeps every position in full precision. ``bits`` (8 or 4)
+    stores them quantized in groups of ``group_size``, which cuts KV memory
+    by about 2x or 3.5x. ``max_size`` bounds the cache to that many
+    positions: the first ``keep`` positions (attention sinks) stay, and the
+    rest is a window of the most recent ones. The two can't be combined.
+    """
+
+    bits: Optional[int] = None
+    group_size: int = 64
+    max_size: Optional[int] = None
+    keep: int = 4
+
+    def __post_init__(self):
+        if self.bits is not None and self.max_size is not None:
+            raise ValueError("A KV cache can be quantized or rotating, not both")
+        if self.max_size is not None and not 0 <= self.keep < self.max_size:
+            raise ValueError("keep must be smaller than max_size")
+
+    @classmethod
+    def from_string(cls, spec: str) -> "KVCachePolicy":
+        """
+        Parse ``full``, ``q8``/``q4`` (quantized) or ``window:<max_size>[:<keep>]``
+        (rotating), the form the command-line tools accept.
+        """
+        kind, *values = spec.lower().split(":")
+        try:
+            if kind == "full" and not values:
+                return cls()
+            if kind in ("q8", "q4") and not values:
+                return cls(bits=int(kind[1:]))
+            if kind == "window" and 1 <= len(values) <= 2:
+                return cls(max_size=int(values[0]), keep=int(values[1]) if len(values) > 1 else 4)
+        except ValueError as e:
+            raise ValueError(f"Invalid KV cache policy '{spec}': {e}") from e
+        raise ValueError(
+            f"Invalid KV cache policy '{spec}', expected full, q8, q4 or window:<max_size>[:<keep>]"
+        )
+
+    @property
+    def is_default(self) -> bool:
+        return self.bits is None and self.max_size is None
+
+    def make_cache(self, model: nn.Module) -> list[Any]:
+        """One cache per layer of ``model``."""
+        if self.bits is not None:
+            return [
+                QuantizedKVCache(group_size=self.group_size, bits=self.bits)
+                for _ in model.layers
+            ]
+        if self.max_size is not None:
+            return [
+                RotatingKVCache(max_size=self.max_size, keep=self.keep)
+                for _ in model.layers
+            ]
+        return [KVCache() for _ in model.layers]
+
+
+def causal_mask(layer_cache: Any, length: int) -> Optional[mx.array]:
+    """
+    Attention mask for ``length`` new positions entering ``layer_cache``, or
+    ``None`` where the backbone's own causal mask is right.
+
+    Quantized attention adds the mask to the scores, so it gets an additive
+    mask rather than a boolean one. A rotating cache returns its kept
+    positions in temporal order (sinks, then the window, then the new ones),
+    and every new position sees the sinks plus the ``max_size - keep`` most
+    recent positions, as it would when decoding one position at a time.
+    """
+    if length == 1:
+        return None
+
+    offset = layer_cache.offset
+    if isinstance(layer_cache, QuantizedKVCache):
+        return mx.where(create_causal_mask(length, offset), 0.0, -1e9)
+
+    if isinstance(layer_cache, RotatingKVCache):
+        window = layer_cache.max_size - layer_cache.keep
+        if offset <= layer_cache.max_size:
+            keys = mx.arange(offset + length)
+        else:
+            keys = mx.concat(
+                [mx.arange(layer_cache.keep), mx.arange(offset - window, offset + length)]
+            )
+        queries = mx.arange(offset, offset + length)[:, None]
+        return (keys <= queries) & ((keys < layer_cache.keep) | (keys > queries - window))
+
+    return None
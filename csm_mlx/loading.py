@@ -0,0 +1,124 @@
+import hashlib
+import resource
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Union
+
+import mlx.core as mx
+from huggingface_hub import hf_hub_download, try_to_load_from_cache
+
+from csm_mlx.models import CSM, ModelArgs, csm_1b
+from csm_mlx.quantization import load_quantized, parameter_bytes
+
+DEFAULT_REPO = "senstella/csm-1b-mlx"
+DEFAULT_CHECKPOINT = "ckpt.safetensors"
+
+
+@dataclass
+class LoadStats:
+    seconds: float
+    parameter_bytes: int
+    # Peak resident set size of the whole process so far
+    peak_rss_bytes: int
+    lazy: bool
+
+    def __str__(self) -> str:
+        return (
+            f"{self.seconds:.2f} s, {self.parameter_bytes / 2**20:.0f} MiB of parameters"
+            f"{' (not yet read)' if self.lazy else ''}, "
+            f"peak RSS {self.peak_rss_bytes / 2**20:.0f} MiB"
+        )
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of this process."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def checkpoint_path(
+    repo_id: str = DEFAULT_REPO, filename: str = DEFAULT_CHECKPOINT
+) -> str:
+    """
+    Local path of a Hub checkpoint, downloading it only if it is not cached.
+
+    ``hf_hub_download`` asks the Hub for the latest revision on every call,
+    which costs a network round trip (or a timeout when offline) per start.
+    """
+    cached = try_to_load_from_cache(repo_id, filename)
+    if isinstance(cached, str):
+        return cached
+    return hf_hub_download(repo_id=repo_id, filename=filename)
+
+
+def weights_identity(path: Optional[Union[str, Path]] = None) -> str:
+    """
+    Short id of a checkpoint file or quantized directory (``None`` for the
+    default checkpoint) that changes whenever its weights might.
+
+    It hashes the resolved path, size and modification time of every file,
+    so it costs a few ``stat`` calls rather than reading the weights. Hub
+    files resolve to blobs named after their content hash. A default
+    checkpoint that is not downloaded yet is identified by its repo.
+    """
+    if path is None:
+        cached = try_to_load_from_cache(DEFAULT_REPO, DEFAULT_CHECKPOINT)
+        if not isinstance(cached, str):
+            return f"{DEFAULT_REPO}/{DEFAULT_CHECKPOINT}"
+        path = cached
+
+    path = Path(path).resolve()
+    files = sorted(path.iterdir()) if path.is_dir() else [path]
+    digest = hashlib.sha256()
+    for file in files:
+        file = file.resolve()
+        if file.is_file():
+            stat = file.stat()
+            digest.update(f"{file}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:16]
+
+
+def load_csm(
+    path: Optional[Union[str, Path]] = None,
+    *,
+    args: Optional[ModelArgs] = None,
+    lazy: bool = False,
+) -> tuple[CSM, LoadStats]:
+    """
+    Build a CSM and load its weights without allocating anything twice.
+
+    ``path`` is a safetensors checkpoint, a directory written by
+    ``save_quantized``, or ``None`` for the default checkpoint. Module
+    construction is lazy in MLX: the initial (random or zero) parameters are
+    graphs that are never evaluated, because ``load_weights`` replaces them
+    before anything reads them. ``mx.load`` is lazy as well, so each tensor
+    is read from the file straight into its own buffer when it is evaluated.
+
+    With ``lazy=False`` every tensor is read here. With ``lazy=True`` they are
+    read on first use instead, so loading returns at once; MLX only evaluates
+    arrays on the thread that created them, so the model must then be used
+    (or ``mx.eval(model.parameters())`` run) on the calling thread.
+
+    Returns:
+        The model and how long loading took and how much memory it used
+    """
+    start_time = time.time()
+
+    if path is not None and Path(path).is_dir():
+        model = load_quantized(path, lazy=lazy)
+    else:
+        model = CSM(args or csm_1b())
+        model.load_weights(str(path or checkpoint_path()))
+        if not lazy:
+            mx.eval(model.parameters())
+
+    stats = LoadStats(
+        seconds=time.time() - start_time,
+        parameter_bytes=parameter_bytes(model),
+        peak_rss_bytes=peak_rss_bytes(),
+        lazy=lazy,
+    )
+    return model, stats
@@ -0,0 +1,170 @@
+import re
+from collections import deque
+from collections.abc import Callable
+from typing import Generator, Optional
+
+import mlx.core as mx
+
+from csm_mlx.generation import PromptTooLong, _prepare, default_stream
+from csm_mlx.kv_cache import KVCachePolicy
+from csm_mlx.models import CSM
+from csm_mlx.prefix_cache import PrefixCache
+from csm_mlx.segment import Segment
+from csm_mlx.tokenizers import decode_audio
+
+SAMPLE_RATE = 24_000
+
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+")
+_CLAUSE_BREAK = re.compile(r"(?<=[,;:])\s+")
+
+
+def _pack(pieces: list[str], max_chars: int) -> list[str]:
+    packed, current = [], ""
+    for piece in pieces:
+        if current and len(current) + 1 + len(piece) > max_chars:
+            packed.append(current)
+            current = piece
+        else:
+            current = f"{current} {piece}" if current else piece
+    if current:
+        packed.append(current)
+    return packed
+
+
+def split_text(text: str, max_chars: int = 250) -> list[str]:
+    """
+    Split ``text`` at sentence boundaries into segments of at most
+    ``max_chars`` characters.
+
+    Short sentences are packed together. A sentence that is too long on its
+    own is split at clause punctuation, then between words.
+    """
+    pieces = []
+    for sentence in _SENTENCE_BREAK.split(text.strip()):
+        if len(sentence) <= max_chars:
+            pieces.append(sentence)
+            continue
+
+        for clause in _CLAUSE_BREAK.split(sentence):
+            if len(clause) <= max_chars:
+                pieces.append(clause)
+            else:
+                pieces.extend(_pack(clause.split(), max_chars))
+
+    return _pack([piece for piece in pieces if piece], max_chars)
+
+
+def _crossfade(tail: mx.array, audio: mx.array) -> mx.array:
+    n = min(tail.shape[0], audio.shape[0])
+    ramp = mx.linspace(0, 1, n).astype(audio.dtype)
+    mixed = tail[:n] * (1 - ramp) + audio[:n] * ramp
+    return mx.concat([mixed, audio[n:]], axis=0)
+
+
+def stream_generate_long(
+    model: CSM,
+    text: str,
+    speaker: int,
+    context: Optional[list[Segment]] = None,
+    *,
+    max_segment_chars: int = 250,
+    max_segment_ms: float = 30_000,
+    history: int = 2,
+    crossfade_ms: float = 40.0,
+    sampler: Optional[Callable[..., mx.array]] = None,
+    compiled: bool = True,
+    pipelined: bool = True,
+    prefix_cache: Optional[PrefixCache] = None,
+    n_codebooks: Optional[int] = None,
+    prefill_chunk_size: Optional[int] = None,
+    kv_cache: Optional[KVCachePolicy] = None,
+    stream: mx.Stream = default_stream,
+) -> Generator[mx.array, None, None]:
+    """
+    Synthesize text of any length, one segment at a time.
+
+    ``text`` is split at sentence boundaries (see ``split_text``). Each
+    segment is generated with ``context`` (e.g. a voice reference, always
+    kept) followed by the last ``history`` generated segments. Those are
+    carried as text plus Mimi codes, so nothing is re-encoded, and the
+    oldest is dropped early if the prompt would not fit the backbone window.
+    The context is bounded, so every segment costs about the same no matter
+    how far into the document it is.
+
+    Consecutive segments are crossfaded over ``crossfade_ms``. Audio is
+    yielded once per segment; only the crossfade tail is held back.
+    """
+    context = list(context or [])
+    recent: deque[Segment] = deque(maxlen=history)
+    max_audio_frames = int(max_segment_ms / 80)
+    fade = int(SAMPLE_RATE * crossfade_ms / 1000)
+    tail: Optional[mx.array] = None
+
+    for segment_text in split_text(text, max_segment_chars):
+        while True:
+            try:
+                engine, input, mask = _prepare(
+                    model,
+                    segment_text,
+                    speaker,
+                    context + list(recent),
+                    max_audio_frames,
+                    sampler=sampler,
+                    compiled=compiled,
+                    stream=stream,
+                    prefix_cache=prefix_cache,
+                    n_codebooks=n_codebooks,
+                    prefill_chunk_size=prefill_chunk_size,
+                    kv_cache=kv_cache,
+                )
+                break
+            except PromptTooLong:
+                if not recent:
+                    raise
+                recent.popleft()
+
+        n_frames = 0
+        for _ in engine.run(input, mask, max_audio_frames, pipelined=pipelined):
+            n_frames += 1
+        if n_frames == 0:
+            continue
+
+        audio_tokens = engine.frames(n_frames)
+        audio = (
+            decode_audio(audio_tokens, n_audio_codebooks=engine.n_codebooks)
+            .squeeze(0)
+            .squeeze(0)
+        )
+        recent.append(
+            Segment(
+                speaker=speaker,
+                text=segment_text,
+                audio=audio,
+                audio_tokens=audio_tokens[0],
+            )
+        )
+
+        if tail is not None:
+            audio = _crossfade(tail, audio)
+            tail = None
+        if fade and audio.shape[0] > fade:
+            audio, tail = audio[:-fade], audio[-fade:]
+
+        yield audio
+
+    if tail is not None:
+        yield tail
+
+
+def generate_long(
+    model: CSM,
+    text: str,
+    speaker: int,
+    context: Optional[list[Segment]] = None,
+    **kwargs,
+) -> mx.array:
+    """``stream_generate_long``, concatenated into a single array."""
+    chunks = list(stream_generate_long(model, text, speaker, context, **kwargs))
+    if not chunks:
+        return mx.zeros((0,))
+    return mx.concat(chunks, axis=0)
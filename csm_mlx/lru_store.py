@@ -0,0 +1,253 @@
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Container
+from typing import Any, Optional, Union
+
+import numpy as np
+
+# Written before being renamed into place; left behind only by a crash
+TEMP_EXTENSION = ".tmp"
+
+
+class DiskLRU:
+    """
+    Files in a directory with a size quota and an optional age limit.
+
+    Once the files ending in ``extensions`` take more than ``max_bytes``,
+    ``evict`` deletes the least recently used ones, by modification time:
+    ``touch`` a file when it is used. Files not used for ``max_age_seconds``
+    are deleted too, and so are files ending in ``temp_extensions`` older
+    than ``temp_grace_seconds``. Nothing younger than ``grace_seconds`` is
+    deleted.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        extensions: Union[str, tuple[str, ...]],
+        *,
+        max_age_seconds: Optional[float] = None,
+        grace_seconds: float = 0.0,
+        temp_extensions: Union[str, tuple[str, ...]] = TEMP_EXTENSION,
+        temp_grace_seconds: float = 600.0,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.extensions = extensions
+        self.max_age_seconds = max_age_seconds
+        self.grace_seconds = grace_seconds
+        self.temp_extensions = temp_extensions
+        self.temp_grace_seconds = temp_grace_seconds
+        self.removed_files = 0
+        self.removed_bytes = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.bytes = sum(size for _, _, size in self.entries())
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def temp_path(self) -> str:
+        """A new, empty temporary file to write a file in before ``add``."""
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix=TEMP_EXTENSION)
+        os.close(fd)
+        return path
+
+    def entries(
+        self, extensions: Union[str, tuple[str, ...], None] = None
+    ) -> list[tuple[str, float, int]]:
+        """(name, mtime, size) of the files ending in ``extensions`` (by default the store's)."""
+        extensions = extensions or self.extensions
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(extensions):
+                continue
+            try:
+                stat = os.stat(self.path(name))
+            except FileNotFoundError:
+                continue
+            entries.append((name, stat.st_mtime, stat.st_size))
+        return entries
+
+    def add(self, temp_path: str, name: str) -> bool:
+        """
+        Move the written file ``temp_path`` into place as ``name``. If ``name``
+        is already stored, ``temp_path`` is deleted and ``name`` touched instead.
+
+        Returns:
+            Whether the file is new
+        """
+        path = self.path(name)
+        size = os.path.getsize(temp_path)
+        with self._lock:
+            if os.path.exists(path):
+                os.remove(temp_path)
+                os.utime(path)
+                return False
+            os.replace(temp_path, path)
+            self.bytes += size
+            return True
+
+    def touch(self, name: str) -> None:
+        """Mark a file as just used."""
+        try:
+            os.utime(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def evict(self, keep: Container[str] = ()) -> tuple[int, int]:
+        """
+        Delete leftover temporary files and files past the age limit, then
+        the least recently used files until the store fits in ``max_bytes``.
+        Files named in ``keep`` stay.
+
+        Returns:
+            The number of files and bytes removed
+        """
+        now = time.time()
+        removed_files = removed_bytes = 0
+
+        with self._lock:
+            for name, mtime, _ in self.entries(self.temp_extensions):
+                if now - mtime > self.temp_grace_seconds:
+                    self._remove(name)
+
+            entries = sorted(self.entries(), key=lambda entry: entry[1])
+            self.bytes = sum(size for _, _, size in entries)
+            for name, mtime, size in entries:
+                if name in keep or now - mtime < self.grace_seconds:
+                    continue
+                expired = self.max_age_seconds is not None and now - mtime > self.max_age_seconds
+                if not expired and self.bytes <= self.max_bytes:
+                    continue
+                if self._remove(name):
+                    self.bytes -= size
+                    removed_files += 1
+                    removed_bytes += size
+
+            self.removed_files += removed_files
+            self.removed_bytes += removed_bytes
+
+        return removed_files, removed_bytes
+
+    def _remove(self, name: str) -> bool:
+        try:
+            os.remove(self.path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+
+class LRUStore:
+    """
+    Arrays by key, least recently used first out.
+
+    Recently used arrays are kept in memory (up to ``max_memory_bytes``).
+    With a ``directory``, they are also written there as ``.npy`` files; the
+    least recently used files are deleted once the directory holds more
+    than ``max_disk_bytes``.
+
+    Subclasses define the ``key``, and may override ``_prepare`` (the array
+    kept and written for a value) and ``_load`` (a file read back).
+    """
+
+    def __init__(
+        self,
+        *,
+        max_memory_bytes: int,
+        directory: Optional[str] = None,
+        max_disk_bytes: int = 1 << 30,
+    ):
+        self.max_memory_bytes = max_memory_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+
+        self._memory: OrderedDict[str, Any] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = DiskLRU(directory, max_disk_bytes, ".npy") if directory is not None else None
+        self._lock = threading.Lock()
+
+    def _prepare(self, value: Any) -> Any:
+        return value
+
+    def _load(self, path: str) -> Any:
+        return np.load(path)
+
+    def _remember(self, key: str, value: Any) -> None:
+        # Called with the lock held
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+
+        self._memory[key] = value
+        self._memory_bytes += value.nbytes
+        while self._memory_bytes > self.max_memory_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                return value
+
+            if self._disk is None:
+                return None
+
+            name = f"{key}.npy"
+            try:
+                value = self._load(self._disk.path(name))
+            except (FileNotFoundError, RuntimeError, ValueError):
+                return None
+            self._disk.touch(name)  # bump for LRU eviction
+
+            self._remember(key, value)
+            return value
+
+    def put(self, key: str, value: Any, *, to_disk: bool = True) -> None:
+        """Store ``value``; with ``to_disk=False`` only in memory, to ``write`` later."""
+        value = self._prepare(value)
+        with self._lock:
+            self._remember(key, value)
+        if to_disk:
+            self._write(key, value)
+
+    def write(self, key: str, value: Any) -> None:
+        """Store ``value`` in the disk tier, if there is one."""
+        self._write(key, self._prepare(value))
+
+    def _write(self, key: str, value: Any) -> None:
+        if self._disk is None or os.path.exists(self._disk.path(f"{key}.npy")):
+            return
+
+        temp_path = self._disk.temp_path()
+        try:
+            with open(temp_path, "wb") as f:
+                np.save(f, np.asarray(value))
+            self._disk.add(temp_path, f"{key}.npy")
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        if self._disk.bytes > self._disk.max_bytes:
+            self._disk.evict()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": self._disk.bytes if self._disk is not None else 0,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
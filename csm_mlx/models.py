@@ -1,6 +1,8 @@
 from dataclasses import dataclass
+from typing import Optional
 
 import mlx.core as mx
+import numpy as np
 from mlx import nn
 from mlx_lm.models.base import BaseModelArgs
 from mlx_lm.models.llama import LlamaModel
@@ -33,6 +35,7 @@ class CSM(nn.Module):
         super().__init__()
 
         # Configuration
+        self.args = args
         self.n_text_vocab = args.n_text_vocab
         self.n_audio_vocab = args.n_audio_vocab
         self.n_audio_codebooks = args.n_audio_codebooks
@@ -65,6 +68,10 @@ class CSM(nn.Module):
         self.audio_head = mx.zeros(
             (args.n_audio_codebooks - 1, self.n_decoder_embedding, args.n_audio_vocab)
         )
+        # Set by csm_mlx.quantization.quantize_model, which also adds
+        # ``audio_head_scales`` / ``audio_head_biases``
+        self.audio_head_bits: Optional[int] = None
+        self.audio_head_group_size: Optional[int] = None
 
         # Patch embeddings
         self.backbone.embed_tokens = nn.Identity()  # type: ignore
@@ -79,6 +86,68 @@ class CSM(nn.Module):
     def embed_audio(self, codebook: int, tokens: mx.array) -> mx.array:
         return self.audio_embeddings(tokens + codebook * self.n_audio_vocab)
 
+    def audio_head_logits(self, codebook: int, hidden: mx.array) -> mx.array:
+        """Logits of ``codebook`` (1 .. n_audio_codebooks - 1) from a decoder hidden state."""
+        if self.audio_head_bits is None:
+            return mx.matmul(hidden, self.audio_head[codebook - 1])
+
+        return mx.quantized_matmul(
+            hidden,
+            self.audio_head[codebook - 1],
+            self.audio_head_scales[codebook - 1],
+            self.audio_head_biases[codebook - 1],
+            transpose=True,
+            group_size=self.audio_head_group_size,
+            bits=self.audio_head_bits,
+        )
+
+    def embed_masked(self, tokens: mx.array, token_mask: mx.array) -> mx.array:
+        """
+        Backbone input: the sum of the embeddings of the unmasked columns.
+
+        Equal to ``(embed_tokens(tokens) * token_mask[..., None]).sum(-2)``, but
+        only unmasked positions are looked up. Text rows skip the audio table
+        and audio rows skip the text table. The mask is read on the host, so
+        this is meant for prompts, not for compiled code.
+
+        Args:
+            tokens, token_mask: (batch, seq_len, n_audio_codebooks + 1)
+
+        Returns:
+            (batch, seq_len, n_backbone_embedding)
+        """
+        batch, seq_len, n_columns = tokens.shape
+        host_tokens = np.asarray(tokens).reshape(-1, n_columns)
+        positions, columns = np.nonzero(
+            np.asarray(token_mask.astype(mx.bool_)).reshape(-1, n_columns)
+        )
+
+        text = columns == self.n_audio_codebooks
+        lookups = [
+            (self.text_embeddings, positions[text], host_tokens[positions[text], columns[text]]),
+            (
+                self.audio_embeddings,
+                positions[~text],
+                host_tokens[positions[~text], columns[~text]] + columns[~text] * self.n_audio_vocab,
+            ),
+        ]
+
+        embeds = None
+        # Quantized embeddings cannot look up an empty set of ids
+        for table, rows, ids in lookups:
+            if ids.size == 0:
+                continue
+            looked_up = table(mx.array(ids))
+            if embeds is None:
+                embeds = mx.zeros((batch * seq_len, looked_up.shape[-1]), dtype=looked_up.dtype)
+            embeds = embeds.at[mx.array(rows)].add(looked_up)
+
+        if embeds is None:
+            # Quantized tables keep their weights packed; their scales have the model's dtype
+            dtype = getattr(self.text_embeddings, "scales", self.text_embeddings.weight).dtype
+            embeds = mx.zeros((batch * seq_len, self.n_backbone_embedding), dtype=dtype)
+        return embeds.reshape(batch, seq_len, -1)
+
     def embed_tokens(self, tokens: mx.array) -> mx.array:
         text_embeds = mx.expand_dims(self.text_embeddings(tokens[:, :, -1]), axis=-2)
 
@@ -0,0 +1,128 @@
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import mlx.core as mx
+import numpy as np
+
+
+@dataclass
+class PrefixEntry:
+    length: int
+    # one (keys, values) pair per backbone layer, each (1, n_kv_heads, length, head_dim)
+    state: list[tuple[Any, Any]]
+    nbytes: int
+
+
+def _nbytes(tree: Any) -> int:
+    if isinstance(tree, mx.array):
+        return tree.nbytes
+    return sum(_nbytes(x) for x in tree)
+
+
+class PrefixCache:
+    """
+    LRU cache of backbone KV states, keyed on the tokenized prompt prefix.
+
+    ``generate`` stores the KV state of the context segments (everything
+    before the text being spoken) after prefilling them. A later request whose
+    prompt starts with the same tokens, e.g. the same voice reference clip and
+    transcript, copies the longest stored prefix into its cache and only
+    prefills the rest.
+
+    Entries are evicted least-recently-used first once their KV states take
+    more than ``max_bytes``. A cache belongs to one model: the key is the
+    prompt only.
+    """
+
+    def __init__(self, max_bytes: int = 1 << 30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries: OrderedDict[bytes, PrefixEntry] = OrderedDict()
+        self._lengths: Counter[int] = Counter()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(tokens: np.ndarray, mask: np.ndarray, length: int) -> bytes:
+        digest = hashlib.sha1()
+        digest.update(tokens[:length].tobytes())
+        digest.update(mask[:length].tobytes())
+        return digest.digest()
+
+    @staticmethod
+    def _host(tokens: mx.array, mask: mx.array) -> tuple[np.ndarray, np.ndarray]:
+        return (
+            np.asarray(tokens.astype(mx.int64)),
+            np.asarray(mask.astype(mx.bool_)),
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(
+        self, tokens: mx.array, mask: mx.array, max_length: int
+    ) -> Optional[PrefixEntry]:
+        """
+        Longest stored prefix of ``tokens``/``mask`` (both (seq_len, 33)) that
+        is at most ``max_length`` long.
+        """
+        host_tokens, host_mask = self._host(tokens, mask)
+
+        with self._lock:
+            for length in sorted(self._lengths, reverse=True):
+                if length > max_length:
+                    continue
+
+                key = self._key(host_tokens, host_mask, length)
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    return entry
+
+        return None
+
+    @staticmethod
+    def restore(entry: PrefixEntry, cache: list[Any]) -> None:
+        """Load ``entry`` into an empty backbone cache."""
+        for layer_cache, layer_state in zip(cache, entry.state):
+            layer_cache.state = layer_state
+            layer_cache.offset = entry.length
+
+    def insert(self, tokens: mx.array, mask: mx.array, cache: list[Any]) -> None:
+        """
+        Store the state of ``cache``, which must hold exactly the KV entries
+        of ``tokens``/``mask``.
+        """
+        length = tokens.shape[0]
+        state = [layer_cache.state for layer_cache in cache]
+        mx.eval(state)
+
+        entry = PrefixEntry(length=length, state=state, nbytes=_nbytes(state))
+        if entry.nbytes > self.max_bytes:
+            return
+
+        key = self._key(*self._host(tokens, mask), length)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+
+            self._entries[key] = entry
+            self._lengths[length] += 1
+            self.nbytes += entry.nbytes
+
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self._lengths[evicted.length] -= 1
+                if not self._lengths[evicted.length]:
+                    del self._lengths[evicted.length]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._lengths.clear()
+            self.nbytes = 0
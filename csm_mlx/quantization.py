@@ -0,0 +1,150 @@
+import json
+from dataclasses import asdict
+from pathlib import Path
+from typing import Optional, Union
+
+import mlx.core as mx
+from mlx import nn
+from mlx.utils import tree_flatten
+
+from csm_mlx.engine import FrameEngine
+from csm_mlx.generation import tokenize_prompt
+from csm_mlx.kv_cache import KVCachePolicy
+from csm_mlx.models import CSM, ModelArgs
+
+MODULE_GROUPS = (
+    "backbone",
+    "decoder",
+    "text_embeddings",
+    "audio_embeddings",
+    "projection",
+    "codebook0_head",
+    "audio_head",
+)
+
+
+def quantize_model(
+    model: CSM,
+    *,
+    group_size: int = 64,
+    bits: int = 4,
+    module_bits: Optional[dict[str, Optional[int]]] = None,
+) -> dict:
+    """
+    Quantize the weights of ``model`` in place.
+
+    Every group in ``MODULE_GROUPS`` is quantized to ``bits`` unless
+    ``module_bits`` gives it another width; ``None`` keeps that group in full
+    precision. The custom ``audio_head`` is stored transposed, one quantized
+    (n_audio_vocab, n_decoder_embedding) matrix per codebook, and evaluated
+    with ``mx.quantized_matmul`` (see ``CSM.audio_head_logits``).
+
+    Returns:
+        The quantization config, as written by ``save_quantized``
+    """
+    module_bits = {name: bits for name in MODULE_GROUPS} | dict(module_bits or {})
+    unknown = set(module_bits) - set(MODULE_GROUPS)
+    if unknown:
+        raise ValueError(f"Unknown module groups: {sorted(unknown)}")
+
+    for name in ("backbone", "decoder"):
+        if module_bits[name] is not None:
+            nn.quantize(getattr(model, name), group_size=group_size, bits=module_bits[name])
+
+    for name in ("text_embeddings", "audio_embeddings", "projection", "codebook0_head"):
+        if module_bits[name] is not None:
+            module = getattr(model, name)
+            setattr(model, name, module.to_quantized(group_size, module_bits[name]))
+
+    if module_bits["audio_head"] is not None:
+        weights, scales, biases = zip(
+            *(
+                mx.quantize(head.T, group_size, module_bits["audio_head"])
+                for head in model.audio_head
+            )
+        )
+        model.audio_head = mx.stack(weights)
+        model.audio_head_scales = mx.stack(scales)
+        model.audio_head_biases = mx.stack(biases)
+        model.audio_head_bits = module_bits["audio_head"]
+        model.audio_head_group_size = group_size
+
+    return {"group_size": group_size, "module_bits": module_bits}
+
+
+def parameter_bytes(model: nn.Module) -> int:
+    """Bytes taken by the parameters of ``model``, including quantization scales."""
+    return sum(value.nbytes for _, value in tree_flatten(model.parameters()))
+
+
+def teacher_forced_codes(
+    model: CSM,
+    text: str,
+    speaker: int,
+    reference: mx.array,
+    kv_cache: Optional[KVCachePolicy] = None,
+) -> mx.array:
+    """
+    Codes ``model`` predicts for every frame of ``reference`` when fed the
+    reference frames before it, so one early mismatch does not derail the
+    rest of the comparison. Decoding is greedy.
+
+    Args:
+        reference: (1, n_audio_codebooks, n_frames), e.g. from ``generate_codes``
+
+    Returns:
+        (1, n_audio_codebooks, n_frames)
+    """
+    tokens, mask = tokenize_prompt(model, text, speaker, [])
+    tokens, mask = mx.expand_dims(tokens, 0), mx.expand_dims(mask, 0)
+    n_frames = reference.shape[2]
+
+    engine = FrameEngine(model, max_frames=n_frames, kv_cache=kv_cache)
+    predictions = []
+    for index in range(n_frames):
+        sample = engine.step(tokens, mask)
+        mx.eval(sample)
+        predictions.append(sample)
+        tokens, mask = engine.next_input(reference[:, :, index])
+
+    return mx.stack(predictions, axis=2)
+
+
+def save_quantized(model: CSM, path: Union[str, Path], quantization: dict) -> None:
+    """
+    Write ``model.safetensors`` and ``config.json`` to the directory ``path``.
+
+    ``quantization`` is the config returned by ``quantize_model``.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    weights = dict(tree_flatten(model.parameters()))
+    mx.save_safetensors(str(path / "model.safetensors"), weights)
+
+    config = asdict(model.args) | {"quantization": quantization}
+    with open(path / "config.json", "w") as f:
+        json.dump(config, f, indent=2)
+
+
+def load_quantized(path: Union[str, Path], *, lazy: bool = False) -> CSM:
+    """
+    Load a model written by ``save_quantized``.
+
+    With ``lazy=True`` the weights are read on first use (see ``load_csm``).
+    """
+    path = Path(path)
+    with open(path / "config.json") as f:
+        config = json.load(f)
+
+    quantization = config.pop("quantization")
+    model = CSM(ModelArgs.from_dict(config))
+    quantize_model(
+        model,
+        group_size=quantization["group_size"],
+        module_bits=quantization["module_bits"],
+    )
+    model.load_weights(str(path / "model.safetensors"))
+    if not lazy:
+        mx.eval(model.parameters())
+    return model
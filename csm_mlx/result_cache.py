@@ -0,0 +1,256 @@
+import hashlib
+import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Optional, Union
+
+import mlx.core as mx
+import numpy as np
+
+from csm_mlx.audio_io import as_float32
+from csm_mlx.lru_store import LRUStore
+from csm_mlx.scheduler import (
+    AudioCallback,
+    BatchScheduler,
+    ProgressCallback,
+    SpeechRequest,
+    VoiceRequest,
+)
+from csm_mlx.worker_pool import WorkerPool
+
+
+class ResultCache(LRUStore):
+    """
+    Generated audio keyed on everything that determines it, kept as float32
+    arrays; ``.npy`` files in the disk tier are memory-mapped on read.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_memory_bytes: int = 256 << 20,
+        directory: Optional[str] = None,
+        max_disk_bytes: int = 1 << 30,
+    ):
+        super().__init__(
+            max_memory_bytes=max_memory_bytes, directory=directory, max_disk_bytes=max_disk_bytes
+        )
+
+    @staticmethod
+    def key(request: SpeechRequest, model_id: str) -> Optional[str]:
+        """
+        Key of a seeded request's audio from the model ``model_id``, or None
+        for an unseeded request, whose audio is random.
+        """
+        if request.seed is None:
+            return None
+
+        digest = hashlib.sha256()
+        digest.update(
+            json.dumps(
+                [
+                    model_id,
+                    request.text,
+                    request.speaker,
+                    request.temperature,
+                    request.min_p,
+                    request.seed,
+                    int(request.max_audio_length_ms / 80),
+                ]
+            ).encode()
+        )
+        for segment in request.context:
+            digest.update(json.dumps([segment.speaker, segment.text]).encode())
+            digest.update(np.asarray(segment.audio.astype(mx.float32)).tobytes())
+        if request.voice is not None:
+            digest.update(f"voice:{request.voice.digest}".encode())
+        return digest.hexdigest()
+
+    def _prepare(self, audio: Any) -> np.ndarray:
+        return as_float32(audio)
+
+    def _load(self, path: str) -> np.ndarray:
+        return np.load(path, mmap_mode="r")
+
+
+@dataclass
+class _Flight:
+    """One generation in progress and everyone waiting for it."""
+
+    futures: list[Future] = field(default_factory=list)
+    on_progress: list[ProgressCallback] = field(default_factory=list)
+    # The streaming caller that started the generation, until it stops listening
+    stream: Optional[AudioCallback] = None
+    # Callers that joined after the generation started get their audio in one piece
+    late_audio: list[AudioCallback] = field(default_factory=list)
+    # Stopped early for the caller that started it, so not worth caching
+    truncated: bool = False
+
+
+class CachedScheduler:
+    """
+    ``BatchScheduler`` or ``WorkerPool`` that answers repeated requests from a
+    ``ResultCache``.
+
+    A seeded request samples the same codes whatever else is in the batch,
+    so its audio depends only on its parameters and the weights, identified
+    by ``model_id``. A request already in the cache resolves at once. One
+    identical to a request still being generated joins it rather than
+    generating again (single flight), and gets its progress from then on.
+    Unseeded requests go straight to the scheduler.
+
+    Same interface as the scheduler it wraps, except that results are
+    NumPy arrays. A streaming request that hits the cache, or joins another
+    one, gets its audio as a single chunk.
+    """
+
+    def __init__(
+        self,
+        scheduler: Union[BatchScheduler, WorkerPool],
+        cache: ResultCache,
+        model_id: str,
+    ):
+        self.scheduler = scheduler
+        self.cache = cache
+        self.model_id = model_id
+        self.hits = self.joined = self.misses = 0
+        self._flights: dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        # Disk writes stay off the scheduler's thread
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="csm-result-cache")
+
+    def submit(
+        self,
+        request: SpeechRequest,
+        on_progress: Optional[ProgressCallback] = None,
+        on_audio: Optional[AudioCallback] = None,
+    ) -> Future:
+        key = self.cache.key(request, self.model_id)
+        if key is None:
+            return self._convert(
+                self.scheduler.submit(request, on_progress=on_progress, on_audio=on_audio)
+            )
+
+        future: Future = Future()
+        future.set_running_or_notify_cancel()
+        with self._lock:
+            audio = self.cache.get(key)
+            flight = self._flights.get(key)
+            if audio is not None:
+                self.hits += 1
+            elif flight is not None:
+                self.joined += 1
+                flight.futures.append(future)
+                if on_progress is not None:
+                    flight.on_progress.append(on_progress)
+                if on_audio is not None:
+                    flight.late_audio.append(on_audio)
+                return future
+            else:
+                self.misses += 1
+                flight = self._flights[key] = _Flight(futures=[future], stream=on_audio)
+                if on_progress is not None:
+                    flight.on_progress.append(on_progress)
+
+        if audio is not None:
+            if on_audio is not None:
+                on_audio(audio)
+            future.set_result(audio)
+            return future
+
+        def progress(frames: int, max_frames: int) -> None:
+            for callback in list(flight.on_progress):
+                callback(frames, max_frames)
+
+        def stream(chunk: mx.array) -> bool:
+            callback = flight.stream
+            if callback is None or callback(chunk):
+                return True
+            # The streaming caller stopped: carry on only for whoever joined since
+            with self._lock:
+                flight.stream = None
+                flight.truncated = len(flight.futures) == 1
+                if flight.truncated:
+                    # Identical requests from now on must not join for cut-off audio
+                    self._flights.pop(key, None)
+                return not flight.truncated
+
+        # Called without the lock, which the scheduler's callbacks take
+        try:
+            shared = self.scheduler.submit(
+                request,
+                on_progress=progress,
+                on_audio=stream if on_audio is not None else None,
+            )
+        except Exception as e:
+            with self._lock:
+                del self._flights[key]
+            for joined in flight.futures:
+                joined.set_exception(e)
+            return future
+        shared.add_done_callback(lambda shared: self._land(key, flight, shared))
+        return future
+
+    def generate(self, request: SpeechRequest, timeout: Optional[float] = None) -> np.ndarray:
+        """``submit`` and wait for the audio."""
+        return self.submit(request).result(timeout)
+
+    def compile_voice(self, request: VoiceRequest) -> Future:
+        """Passed straight to the scheduler: compiled voices are not cached here."""
+        return self.scheduler.compile_voice(request)
+
+    @property
+    def ready(self) -> bool:
+        return getattr(self.scheduler, "ready", True)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "joined": self.joined,
+                "misses": self.misses,
+                "in_flight": len(self._flights),
+                **self.cache.stats(),
+            }
+
+    def close(self) -> None:
+        self.scheduler.close()
+        self._writer.shutdown()
+
+    def _land(self, key: str, flight: _Flight, shared: Future) -> None:
+        try:
+            audio, error = as_float32(shared.result()), None
+        except BaseException as e:
+            audio, error = None, e
+
+        with self._lock:
+            # Already gone if it was truncated, and maybe replaced by a new flight since
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if audio is not None and not flight.truncated:
+                # In memory before the flight is gone, so no request misses both
+                self.cache.put(key, audio, to_disk=False)
+                self._writer.submit(self.cache.write, key, audio)
+        if audio is not None:
+            for callback in flight.late_audio:
+                callback(audio)
+        for future in flight.futures:
+            if error is None:
+                future.set_result(audio)
+            else:
+                future.set_exception(error)
+
+    @staticmethod
+    def _convert(shared: Future) -> Future:
+        future: Future = Future()
+        future.set_running_or_notify_cancel()
+
+        def done(shared: Future) -> None:
+            try:
+                future.set_result(as_float32(shared.result()))
+            except BaseException as e:
+                future.set_exception(e)
+
+        shared.add_done_callback(done)
+        return future
@@ -0,0 +1,520 @@
+import random
+import threading
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Generator, Optional, Union
+
+import mlx.core as mx
+from mlx_lm.models.cache import make_prompt_cache
+
+from csm_mlx.compiled_voice import CompiledVoice, compile_voice_steps
+from csm_mlx.engine import FrameEngine, select_cache_rows
+from csm_mlx.generation import _padding_mask, _prepare_steps
+from csm_mlx.models import CSM
+from csm_mlx.prefix_cache import PrefixCache
+from csm_mlx.segment import Segment
+from csm_mlx.tokenizers import StreamingAudioDecoder, decode_audio
+
+MAX_SEQ_LEN = 2048
+
+
+@dataclass
+class SpeechRequest:
+    text: str
+    speaker: int
+    context: list[Segment] = field(default_factory=list)
+    max_audio_length_ms: float = 90_000
+    temperature: float = 0.7
+    min_p: float = 0.05
+    seed: Optional[int] = None
+    # Used in place of `context`, skipping its Mimi encoding and prefill
+    voice: Optional[CompiledVoice] = None
+
+
+@dataclass
+class VoiceRequest:
+    """Compile ``context`` into a ``CompiledVoice`` for the weights ``model_id``."""
+
+    context: list[Segment]
+    model_id: str = ""
+
+
+@dataclass
+class _Prepared:
+    # backbone KV state of the prompt minus its last position, per layer
+    state: list[tuple[mx.array, mx.array]]
+    length: int
+    # the last prompt position, fed with the next batch step
+    tokens: mx.array
+    mask: mx.array
+    max_frames: int
+
+
+# Called with (frames generated, frame budget) after every frame
+ProgressCallback = Callable[[int, int], None]
+# Called with each new piece of audio; returning False stops the request early
+AudioCallback = Callable[[mx.array], bool]
+
+
+@dataclass
+class _Pending:
+    request: Union[SpeechRequest, VoiceRequest]
+    future: Future
+    on_progress: Optional[ProgressCallback] = None
+    on_audio: Optional[AudioCallback] = None
+    # the prefill in progress, then its result
+    prefill: Optional[Generator[None, None, _Prepared]] = None
+    prepared: Optional[_Prepared] = None
+
+
+@dataclass
+class _Row:
+    request: SpeechRequest
+    future: Future
+    key: mx.array
+    max_frames: int
+    on_progress: Optional[ProgressCallback] = None
+    frames: list[mx.array] = field(default_factory=list)
+    # Streaming rows only: their decoder, the audio sent so far and how
+    # many frames it covers
+    on_audio: Optional[AudioCallback] = None
+    decoder: Optional[StreamingAudioDecoder] = None
+    audio: list[mx.array] = field(default_factory=list)
+    decoded: int = 0
+
+
+def sample_rows(
+    logits: mx.array, temperature: mx.array, min_p: mx.array, noise: mx.array
+) -> mx.array:
+    """
+    Min-p sampling with one temperature and min-p per row.
+
+    Uses the Gumbel-max trick with the caller's ``noise`` (standard Gumbel,
+    same shape as ``logits``), so a row's samples only depend on its own noise
+    and not on which other rows share the batch.
+
+    Args:
+        logits: (batch, vocab)
+        temperature, min_p: (batch, 1); a temperature of 0 is greedy
+    """
+    logits = logits.astype(mx.float32)
+    threshold = logits.max(axis=-1, keepdims=True) + mx.log(min_p)
+    logits = mx.where(logits < threshold, -mx.inf, logits)
+    return mx.argmax(logits / mx.maximum(temperature, 1e-5) + noise, axis=-1)
+
+
+class _BatchEngine(FrameEngine):
+    """FrameEngine sampling every row with its own parameters and noise."""
+
+    def _sample(self, logits: mx.array, codebook: int) -> mx.array:
+        temperature, min_p, noise = self.sampling_state
+        return sample_rows(logits, temperature, min_p, noise[:, codebook])
+
+
+class BatchScheduler:
+    """
+    Continuous-batching generation for concurrent callers.
+
+    Requests from any thread are queued with ``submit``. A single worker
+    thread owns the model and runs one shared batch: at every frame boundary
+    it prefills queued requests on their own, splices their backbone KV state
+    into the batch and keeps decoding all rows together. A row that emits EOS
+    or reaches its length limit is decoded to audio, handed to its ``Future``
+    and evicted, without waiting for the rest of the batch.
+
+    Prompts are prefilled in chunks of ``prefill_chunk_size`` positions, one
+    chunk per frame boundary, so a long prompt delays the running rows by
+    one chunk per frame rather than by its whole prefill.
+
+    Rows are left-padded to a common cache length like in ``generate_batch``.
+    Splicing a row in or compacting the padding away moves its keys to other
+    positions; since RoPE is a rotation, the cached keys are re-rotated by
+    the offset (``Llama3ScaledRoPE.shift``) instead of being recomputed.
+
+    Sampling is min-p with per-row temperature and min-p. Each row draws its
+    noise from a key derived from ``SpeechRequest.seed``, so a seeded request
+    produces the same codes however the batch around it changes.
+
+    A request submitted with ``on_audio`` is decoded as it goes, by a
+    streaming Mimi session of its own: its first frame right away, so
+    playback can start, then ``audio_chunk_frames`` frames at a time.
+
+    ``compile_voice`` prefills a voice's reference segments the same way,
+    between frames, and hands back their state rather than joining the batch.
+    """
+
+    def __init__(
+        self,
+        model: CSM,
+        *,
+        max_batch_size: int = 8,
+        n_codebooks: Optional[int] = None,
+        prefix_cache: Optional[PrefixCache] = None,
+        prefill_chunk_size: Optional[int] = 256,
+        audio_chunk_frames: int = 4,
+        stream: Optional[mx.Stream] = None,
+    ):
+        self.model = model
+        # Lazy arrays can only be evaluated on the thread that built them,
+        # so make the weights concrete before the worker thread uses them
+        mx.eval(model.parameters())
+        self.max_batch_size = max_batch_size
+        self.n_codebooks = n_codebooks
+        self.prefix_cache = prefix_cache
+        self.prefill_chunk_size = prefill_chunk_size
+        self.audio_chunk_frames = audio_chunk_frames
+        self.stream = stream
+
+        # Set up on the worker thread, which owns all of the batch state
+        self._engine: _BatchEngine
+        self._rows: list[_Row] = []
+        self._padding: mx.array
+        # (batch, 1, embedding): what each row feeds the backbone next
+        self._embeds: Optional[mx.array] = None
+
+        self._pending: deque[_Pending] = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(
+        self,
+        request: SpeechRequest,
+        on_progress: Optional[ProgressCallback] = None,
+        on_audio: Optional[AudioCallback] = None,
+    ) -> Future:
+        """
+        Queue ``request``; the future resolves to its audio array.
+
+        ``on_progress(frames, max_frames)`` is called on the worker thread
+        after every generated frame. ``on_audio(chunk)`` is called there with
+        each decoded chunk, in order, before the future resolves to all of
+        them joined; if it returns False, generation stops and the future
+        gets the audio so far. Both must be quick and must not raise.
+        """
+        return self._enqueue(_Pending(request, Future(), on_progress, on_audio))
+
+    def compile_voice(self, request: VoiceRequest) -> Future:
+        """Queue ``request``; the future resolves to its ``CompiledVoice``."""
+        return self._enqueue(_Pending(request, Future()))
+
+    def _enqueue(self, entry: _Pending) -> Future:
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("BatchScheduler is closed")
+            self._pending.append(entry)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._loop, name="csm-batch-scheduler", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+        return entry.future
+
+    def generate(self, request: SpeechRequest, timeout: Optional[float] = None) -> mx.array:
+        """``submit`` and wait for the audio."""
+        return self.submit(request).result(timeout)
+
+    def stats(self) -> dict[str, int]:
+        with self._condition:
+            return {"active": len(self._rows), "queued": len(self._pending)}
+
+    def close(self) -> None:
+        """Finish the queued and running requests, then stop the worker."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self) -> None:
+        # Streams belong to the thread that created them
+        if self.stream is None:
+            self.stream = mx.new_stream(mx.default_device())
+        self._engine = _BatchEngine(
+            self.model, max_frames=1, n_codebooks=self.n_codebooks, stream=self.stream
+        )
+        self._reset()
+
+        while True:
+            with self._condition:
+                while not self._pending and not self._rows and not self._closed:
+                    self._condition.wait()
+                if self._closed and not self._pending and not self._rows:
+                    return
+
+                incoming = list(self._pending)
+                self._pending.clear()
+
+            try:
+                self._admit(incoming)
+                if self._rows:
+                    self._step()
+            except Exception as e:
+                for row in self._rows:
+                    if row.decoder is not None:
+                        row.decoder.close()
+                    if not row.future.done():
+                        row.future.set_exception(e)
+                self._reset()
+
+    def _admit(self, incoming: list[_Pending]) -> None:
+        """
+        Splice queued requests into the batch, in order, while they fit.
+
+        Voice compiles never join the batch, so they don't wait for room in
+        it, nor behind speech requests; each kind keeps its own order.
+        """
+        queue = deque(incoming)
+        leftover: list[_Pending] = []
+        # Kinds of request with an entry waiting, which later ones of that kind queue behind
+        waiting: set[type] = set()
+        try:
+            while queue:
+                entry = queue.popleft()
+                kind = type(entry.request)
+                if kind in waiting or (
+                    kind is SpeechRequest and len(self._rows) >= self.max_batch_size
+                ):
+                    leftover.append(entry)
+                    waiting.add(kind)
+                    continue
+
+                if entry.prepared is None:
+                    if entry.prefill is None:
+                        if not entry.future.set_running_or_notify_cancel():
+                            continue  # cancelled while queued
+                        entry.prefill = self._prefill(entry.request)
+
+                    # One prefill chunk per frame boundary
+                    try:
+                        next(entry.prefill)
+                    except StopIteration as done:
+                        if isinstance(entry.request, VoiceRequest):
+                            entry.future.set_result(done.value)
+                            continue
+                        entry.prepared = done.value
+                    except Exception as e:
+                        entry.future.set_exception(e)
+                        continue
+
+                    if entry.prepared is None:
+                        leftover.append(entry)
+                        waiting.add(kind)
+                        continue
+
+                if not self._fits(entry.prepared):
+                    leftover.append(entry)
+                    waiting.add(kind)
+                    continue
+
+                try:
+                    self._join(entry)
+                except Exception as e:
+                    entry.future.set_exception(e)
+                    raise
+        finally:
+            leftover.extend(queue)
+            if leftover:
+                with self._condition:
+                    self._pending.extendleft(reversed(leftover))
+
+    def _prefill(
+        self, request: Union[SpeechRequest, VoiceRequest]
+    ) -> Generator[None, None, Union[_Prepared, CompiledVoice]]:
+        if isinstance(request, VoiceRequest):
+            return (
+                yield from compile_voice_steps(
+                    self.model,
+                    request.context,
+                    model_id=request.model_id,
+                    prefill_chunk_size=self.prefill_chunk_size,
+                    stream=self.stream,
+                )
+            )
+
+        max_frames = int(request.max_audio_length_ms / 80)
+        engine, tokens, mask = yield from _prepare_steps(
+            self.model,
+            request.text,
+            request.speaker,
+            request.context,
+            max_frames,
+            sampler=None,
+            compiled=False,
+            stream=self.stream,
+            prefix_cache=self.prefix_cache,
+            n_codebooks=self.n_codebooks,
+            prefill_chunk_size=self.prefill_chunk_size or MAX_SEQ_LEN,
+            voice=request.voice,
+        )
+
+        return _Prepared(
+            state=[layer_cache.state for layer_cache in engine.backbone_cache],
+            length=engine.backbone_cache[0].offset,
+            tokens=tokens[:, -1:],
+            mask=mask[:, -1:],
+            max_frames=max_frames,
+        )
+
+    def _offset(self) -> int:
+        return self._engine.backbone_cache[0].offset if self._rows else 0
+
+    def _fits(self, prepared: _Prepared) -> bool:
+        remaining = [row.max_frames - len(row.frames) for row in self._rows]
+        offset = max(self._offset(), prepared.length)
+        return offset + max(remaining + [prepared.max_frames]) < MAX_SEQ_LEN
+
+    def _join(self, entry: _Pending) -> None:
+        prepared = entry.prepared
+        assert prepared is not None
+
+        offset = self._offset()
+        new_offset = max(offset, prepared.length)
+        grow, pad = new_offset - offset, new_offset - prepared.length
+
+        for layer, layer_cache, (keys, values) in zip(
+            self.model.backbone.layers, self._engine.backbone_cache, prepared.state
+        ):
+            rope = layer.self_attn.rope
+            keys = _pad_left(rope.shift(keys, pad), pad)
+            values = _pad_left(values, pad)
+            if self._rows:
+                batch_keys, batch_values = layer_cache.state
+                keys = mx.concat([_pad_left(rope.shift(batch_keys, grow), grow), keys])
+                values = mx.concat([_pad_left(batch_values, grow), values])
+            layer_cache.state = (keys, values)
+
+        self._padding = mx.concat([self._padding + grow, mx.array([pad], dtype=mx.int32)])
+        embeds = self._engine.embed(prepared.tokens, prepared.mask)
+        self._embeds = mx.concat([self._embeds, embeds]) if self._rows else embeds
+        self._eval_state()
+
+        request = entry.request
+        seed = request.seed if request.seed is not None else random.getrandbits(32)
+        self._rows.append(
+            _Row(
+                request=request,
+                future=entry.future,
+                key=mx.random.key(seed),
+                max_frames=prepared.max_frames,
+                on_progress=entry.on_progress,
+                on_audio=entry.on_audio,
+                decoder=(
+                    StreamingAudioDecoder(n_audio_codebooks=self._engine.n_codebooks)
+                    if entry.on_audio is not None
+                    else None
+                ),
+            )
+        )
+
+    def _step(self) -> None:
+        engine = self._engine
+        shape = (engine.n_codebooks, self.model.n_audio_vocab)
+
+        noise = []
+        for row in self._rows:
+            row.key, key = mx.random.split(row.key)
+            noise.append(mx.random.gumbel(shape, key=key))
+        engine.sampling_state[:] = [
+            mx.array([[row.request.temperature] for row in self._rows]),
+            mx.array([[row.request.min_p] for row in self._rows]),
+            mx.stack(noise),
+        ]
+
+        key_len = engine.backbone_cache[0].offset + 1
+        sample = engine.step_embeds(
+            self._embeds,
+            attention_mask=_padding_mask(self._padding, 1, key_len),
+        )
+        eos = (sample.sum(axis=-1) == 0).tolist()
+
+        keep = []
+        for index, row in enumerate(self._rows):
+            stopped = False
+            if not eos[index]:
+                row.frames.append(sample[index])
+                if row.on_progress is not None:
+                    row.on_progress(len(row.frames), row.max_frames)
+                if row.on_audio is not None and (
+                    row.decoded == 0 or len(row.frames) - row.decoded >= self.audio_chunk_frames
+                ):
+                    stopped = not self._stream(row)
+            if eos[index] or stopped or len(row.frames) >= row.max_frames:
+                self._finish(row)
+            else:
+                keep.append(index)
+
+        self._embeds = engine.next_embeds
+
+        if len(keep) < len(self._rows):
+            self._evict(keep)
+
+    def _stream(self, row: _Row) -> bool:
+        """Decode the row's frames not streamed yet and send them; False to stop."""
+        assert row.decoder is not None and row.on_audio is not None
+        codes = mx.expand_dims(mx.stack(row.frames[row.decoded :], axis=1), 0)
+        audio = row.decoder.decode(codes).squeeze(0).squeeze(0)
+        mx.eval(audio)
+        row.decoded = len(row.frames)
+        row.audio.append(audio)
+        return row.on_audio(audio)
+
+    def _finish(self, row: _Row) -> None:
+        if row.decoder is not None:
+            if row.decoded < len(row.frames):
+                self._stream(row)
+            row.decoder.close()
+            audio = mx.concat(row.audio) if row.audio else mx.zeros((0,))
+        elif row.frames:
+            codes = mx.expand_dims(mx.stack(row.frames, axis=1), 0)
+            audio = decode_audio(codes, n_audio_codebooks=codes.shape[1]).squeeze(0).squeeze(0)
+        else:
+            audio = mx.zeros((0,))
+        mx.eval(audio)
+        row.future.set_result(audio)
+
+    def _evict(self, keep: list[int]) -> None:
+        if not keep:
+            self._reset()
+            return
+
+        rows = mx.array(keep)
+        self._rows = [self._rows[index] for index in keep]
+        self._padding = self._padding[rows]
+        self._embeds = self._embeds[rows]
+        select_cache_rows(self._engine.backbone_cache, rows)
+
+        # Drop the leading positions that are padding for every remaining row
+        drop = self._padding.min().item()
+        if drop > 0:
+            for layer, layer_cache in zip(self.model.backbone.layers, self._engine.backbone_cache):
+                keys, values = layer_cache.state
+                layer_cache.state = (
+                    layer.self_attn.rope.shift(keys[..., drop:, :], -drop),
+                    values[..., drop:, :],
+                )
+            self._padding = self._padding - drop
+        self._eval_state()
+
+    def _eval_state(self) -> None:
+        mx.eval(
+            [layer_cache.state for layer_cache in self._engine.backbone_cache],
+            self._padding,
+            self._embeds,
+        )
+
+    def _reset(self) -> None:
+        self._rows = []
+        self._padding = mx.zeros((0,), dtype=mx.int32)
+        self._embeds = None
+        self._engine.backbone_cache = make_prompt_cache(self.model.backbone)
+
+
+def _pad_left(x: mx.array, width: int) -> mx.array:
+    """Left-pad the sequence axis of a (batch, heads, seq_len, head_dim) array."""
+    if width == 0:
+        return x
+    return mx.pad(x, [(0, 0), (0, 0), (width, 0), (0, 0)])
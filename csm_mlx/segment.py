@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Optional
 
 import mlx.core as mx
 
@@ -9,3 +10,5 @@ class Segment:
     text: str
     # (num_samples,), sample_rate = 24_000
     audio: mx.array
+    # (n_audio_codebooks, num_frames), Mimi codes of `audio` if already known
+    audio_tokens: Optional[mx.array] = None
@@ -1,12 +1,17 @@
+import hashlib
+import threading
 from functools import cache
+from typing import Optional
 
 import mlx.core as mx
+import numpy as np
 from huggingface_hub import hf_hub_download
 from moshi_mlx.models.mimi import Mimi, mimi_202407
 from tokenizers.processors import TemplateProcessing
 from transformers import AutoTokenizer, LlamaTokenizer
 
 from csm_mlx.config import TOKENIZERS
+from csm_mlx.lru_store import LRUStore
 from csm_mlx.segment import Segment
 
 
@@ -57,26 +62,123 @@ def tokenize_text_segment(text: str, speaker: int) -> tuple[mx.array, mx.array]:
     return mx.concat(frame_tokens, axis=0), mx.concat(frame_masks, axis=0)
 
 
+class AudioTokenCache(LRUStore):
+    """
+    Content-addressed cache of Mimi codes for context audio.
+
+    Entries are keyed by a hash of the audio samples and the codebook count,
+    and kept as compact int16 arrays. Files in the disk tier are read
+    straight into an ``mx.array``.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_memory_bytes: int = 64 << 20,
+        directory: Optional[str] = None,
+        max_disk_bytes: int = 1 << 30,
+    ):
+        super().__init__(
+            max_memory_bytes=max_memory_bytes, directory=directory, max_disk_bytes=max_disk_bytes
+        )
+
+    @staticmethod
+    def key(audio: mx.array, n_audio_codebooks: int) -> str:
+        digest = hashlib.sha256(np.asarray(audio.astype(mx.float32)).tobytes())
+        digest.update(f":{n_audio_codebooks}".encode())
+        return digest.hexdigest()
+
+    def _prepare(self, audio_tokens: mx.array) -> mx.array:
+        # Through NumPy, so the cached array is never a lazy one of another thread
+        return mx.array(np.asarray(audio_tokens).astype(np.int16))
+
+    def _load(self, path: str) -> mx.array:
+        audio_tokens = mx.load(path)
+        # Evaluated here, as a lazy array only works on this thread
+        mx.eval(audio_tokens)
+        return audio_tokens
+
+    def get(self, key: str) -> Optional[mx.array]:
+        """
+        Returns:
+            (n_audio_codebooks, n_frames) or None
+        """
+        return super().get(key)
+
+
+_audio_token_cache: Optional[AudioTokenCache] = AudioTokenCache()
+
+
+def get_audio_token_cache() -> Optional[AudioTokenCache]:
+    return _audio_token_cache
+
+
+def set_audio_token_cache(audio_token_cache: Optional[AudioTokenCache]) -> None:
+    """
+    Replace the cache ``tokenize_audio`` uses, e.g. with one that also has a
+    disk tier. ``None`` disables caching.
+    """
+    global _audio_token_cache
+    _audio_token_cache = audio_token_cache
+
+
 def tokenize_audio(
     audio: mx.array, *, n_audio_codebooks: int = 32
 ) -> tuple[mx.array, mx.array]:
+    return tokenize_audio_tokens(encode_audio(audio, n_audio_codebooks=n_audio_codebooks))
+
+
+def encode_audio(audio: mx.array, *, n_audio_codebooks: int = 32) -> mx.array:
+    """
+    Mimi codes of ``audio``, from the audio token cache if it has them.
+
+    Returns:
+        (n_audio_codebooks, n_frames)
+    """
+    audio_token_cache = get_audio_token_cache()
+    key = None
+    audio_tokens = None
+    if audio_token_cache is not None:
+        key = audio_token_cache.key(audio, n_audio_codebooks)
+        audio_tokens = audio_token_cache.get(key)
+
+    if audio_tokens is None:
+        audio_tokenizer = get_audio_tokenizer(n_audio_codebooks)
+
+        # (K, T)
+        audio_tokens = audio_tokenizer.encode(
+            mx.expand_dims(mx.expand_dims(audio, 0), 0)
+        )[0]
+
+        if audio_token_cache is not None and key is not None:
+            audio_token_cache.put(key, audio_tokens)
+
+    return audio_tokens
+
+
+def tokenize_audio_tokens(audio_tokens: mx.array) -> tuple[mx.array, mx.array]:
+    """
+    Frame already encoded Mimi codes, skipping the encoder.
+
+    Args:
+        audio_tokens: (K, T). With fewer than 32 codebooks, the missing ones
+            are masked out.
+
+    Returns:
+        (T + 1, 33), (T + 1, 33), including the EOS frame
+    """
     frame_tokens = []
     frame_masks = []
 
-    audio_tokenizer = get_audio_tokenizer(n_audio_codebooks)
-
-    # (K, T)
-    audio_tokens = audio_tokenizer.encode(mx.expand_dims(mx.expand_dims(audio, 0), 0))[
-        0
-    ]
     # add EOS frame
     eos_frame = mx.zeros((audio_tokens.shape[0], 1))
     audio_tokens = mx.concat([audio_tokens, eos_frame], axis=1)
 
     audio_frame = mx.zeros((audio_tokens.shape[1], 33), dtype=mx.int64)
     audio_frame_mask = mx.zeros((audio_tokens.shape[1], 33), dtype=mx.int64)
-    audio_frame[:, :-1] = audio_tokens.swapaxes(0, 1)
-    audio_frame_mask[:, :-1] = True
+    n_codebooks = audio_tokens.shape[0]
+    audio_frame[:, :n_codebooks] = audio_tokens.swapaxes(0, 1)
+    audio_frame_mask[:, :n_codebooks] = True
 
     frame_tokens.append(audio_frame)
     frame_masks.append(audio_frame_mask)
@@ -92,9 +194,12 @@ def tokenize_segment(
         (seq_len, 33), (seq_len, 33)
     """
     text_tokens, text_masks = tokenize_text_segment(segment.text, segment.speaker)
-    audio_tokens, audio_masks = tokenize_audio(
-        segment.audio, n_audio_codebooks=n_audio_codebooks
-    )
+    if segment.audio_tokens is not None:
+        audio_tokens, audio_masks = tokenize_audio_tokens(segment.audio_tokens)
+    else:
+        audio_tokens, audio_masks = tokenize_audio(
+            segment.audio, n_audio_codebooks=n_audio_codebooks
+        )
 
     return mx.concat([text_tokens, audio_tokens], axis=0).astype(mx.int64), mx.concat(
         [text_masks, audio_masks], axis=0
@@ -104,3 +209,95 @@ def tokenize_segment(
 def decode_audio(audio_tokens: mx.array, *, n_audio_codebooks=32) -> mx.array:
     audio_tokenizer = get_audio_tokenizer(n_audio_codebooks)
     return audio_tokenizer.decode(audio_tokens)
+
+
+_stream_decoder_pool: dict[int, list[Mimi]] = {}
+_stream_decoder_lock = threading.Lock()
+
+
+def _acquire_stream_mimi(n_audio_codebooks: int) -> Mimi:
+    with _stream_decoder_lock:
+        pool = _stream_decoder_pool.setdefault(n_audio_codebooks, [])
+        if pool:
+            return pool.pop()
+
+    # Streaming state lives on the Mimi instance, so every session gets its own
+    # instance. The weights are shared with the cached tokenizer; the fresh
+    # instance's own initial parameters are never evaluated.
+    mimi = Mimi(mimi_202407(n_audio_codebooks))
+    mimi.update(get_audio_tokenizer(n_audio_codebooks).parameters())
+    return mimi
+
+
+def _release_stream_mimi(n_audio_codebooks: int, mimi: Mimi) -> None:
+    with _stream_decoder_lock:
+        _stream_decoder_pool.setdefault(n_audio_codebooks, []).append(mimi)
+
+
+class StreamingAudioDecoder:
+    """
+    Incremental Mimi decoding session.
+
+    Unlike ``decode_audio``, which decodes every call from a cold state, the
+    session keeps Mimi's streaming state (causal convolution buffers, the
+    decoder transformer's KV cache and the upsampler) between calls, so the
+    audio of consecutive chunks joins without discontinuities. Frames can be
+    decoded as they arrive with ``decode``, or buffered with ``push`` and
+    decoded ``chunk_frames`` at a time.
+
+    Use it as a context manager (or call ``close``) so the underlying Mimi
+    instance is returned to the pool for the next session.
+    """
+
+    def __init__(self, *, n_audio_codebooks: int = 32, chunk_frames: int = 1):
+        if chunk_frames < 1:
+            raise ValueError("chunk_frames must be at least 1")
+
+        self.n_audio_codebooks = n_audio_codebooks
+        self.chunk_frames = chunk_frames
+        self._pending: list[mx.array] = []
+        self._mimi: Optional[Mimi] = _acquire_stream_mimi(n_audio_codebooks)
+        self._mimi.reset_all()
+
+    def decode(self, audio_tokens: mx.array) -> mx.array:
+        """
+        Args:
+            audio_tokens: (1, n_audio_codebooks, n_frames)
+
+        Returns:
+            (1, 1, n_frames * 1920)
+        """
+        if self._mimi is None:
+            raise RuntimeError("StreamingAudioDecoder is closed")
+        return self._mimi.decode_step(audio_tokens)
+
+    def push(self, frame: mx.array) -> Optional[mx.array]:
+        """
+        Buffer one ``(1, n_audio_codebooks)`` frame, decoding once
+        ``chunk_frames`` frames are buffered.
+        """
+        self._pending.append(frame)
+        if len(self._pending) < self.chunk_frames:
+            return None
+        return self.flush()
+
+    def flush(self) -> Optional[mx.array]:
+        """Decode whatever is buffered, if anything."""
+        if not self._pending:
+            return None
+
+        audio_tokens = mx.stack(self._pending, axis=-1)
+        self._pending = []
+        return self.decode(audio_tokens)
+
+    def close(self) -> None:
+        if self._mimi is not None:
+            _release_stream_mimi(self.n_audio_codebooks, self._mimi)
+            self._mimi = None
+            self._pending = []
+
+    def __enter__(self) -> "StreamingAudioDecoder":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
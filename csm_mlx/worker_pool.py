@@ -0,0 +1,420 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field, replace
+from functools import partial
+from typing import Any, Callable, Optional, Union
+
+import numpy as np
+
+from csm_mlx.scheduler import AudioCallback, ProgressCallback, SpeechRequest, VoiceRequest
+
+# How often a crashed worker may take down the same request before it fails
+MAX_ATTEMPTS = 2
+# Longest wait before restarting a worker that keeps exiting
+MAX_RESTART_DELAY = 30.0
+# Workers report progress every this many frames (about one second of audio)
+PROGRESS_FRAMES = 12
+# Compiled voices each worker keeps, so a voice is sent to it only once
+MAX_WORKER_VOICES = 16
+
+
+@dataclass
+class _Job:
+    request: Union[SpeechRequest, VoiceRequest]
+    future: Future
+    on_progress: Optional[ProgressCallback] = None
+    on_audio: Optional[AudioCallback] = None
+    attempts: int = 0
+
+
+@dataclass
+class _Worker:
+    index: int
+    process: Any
+    inbox: Any
+    started_at: float
+    ready: bool = False
+    restarts: int = 0
+    # Restarts since a worker in this slot last loaded the model, for the restart delay
+    crashes: int = 0
+    exited_at: Optional[float] = None
+    # ids of the jobs sent to this worker and not finished yet
+    active: set[str] = field(default_factory=set)
+    # Digests of the voices the worker has, least recently used first, as
+    # the worker tracks them: both update in the order requests are sent
+    voices: OrderedDict[str, None] = field(default_factory=OrderedDict)
+
+
+def _use_voice(voices: OrderedDict, digest: str) -> bool:
+    """Mark the voice ``digest`` as just used; returns whether it was there already."""
+    known = digest in voices
+    if known:
+        voices.move_to_end(digest)
+    else:
+        voices[digest] = None
+        while len(voices) > MAX_WORKER_VOICES:
+            voices.popitem(last=False)
+    return known
+
+
+def _worker_main(
+    index: int,
+    model_path: Optional[str],
+    max_batch_size: int,
+    inbox: Any,
+    results: Any,
+) -> None:
+    """Load the model, then run every request sent to ``inbox`` in one BatchScheduler."""
+    from csm_mlx.compiled_voice import CompiledVoice
+    from csm_mlx.loading import load_csm
+    from csm_mlx.scheduler import BatchScheduler
+
+    model, load_stats = load_csm(model_path)
+    scheduler = BatchScheduler(model, max_batch_size=max_batch_size)
+    results.put(("ready", index, os.getpid(), load_stats.seconds))
+
+    # Streaming jobs still running, and those the parent no longer wants audio for
+    streaming: set[str] = set()
+    cancelled: set[str] = set()
+    # Compiled voices by digest, evicted in step with the parent's _Worker.voices
+    voices: OrderedDict[str, CompiledVoice] = OrderedDict()
+
+    def finished(job_id: str, future: Future) -> None:
+        streaming.discard(job_id)
+        cancelled.discard(job_id)
+        try:
+            result = future.result()
+            if not isinstance(result, CompiledVoice):
+                result = np.asarray(result)
+            results.put(("done", index, job_id, result))
+        except Exception as e:
+            results.put(("error", index, job_id, f"{type(e).__name__}: {e}"))
+
+    def progress(job_id: str, frames: int, max_frames: int) -> None:
+        # The first frame too, so the parent knows the request has started
+        if frames == 1 or frames % PROGRESS_FRAMES == 0:
+            results.put(("progress", index, job_id, (frames, max_frames)))
+
+    def audio(job_id: str, chunk: Any) -> bool:
+        if job_id in cancelled:
+            return False
+        results.put(("audio", index, job_id, np.asarray(chunk)))
+        return True
+
+    while (item := inbox.get()) is not None:
+        kind, job_id, *payload = item
+        if kind == "cancel":
+            if job_id in streaming:
+                cancelled.add(job_id)
+            continue
+        request, voice, report_progress, stream_audio = payload
+        if isinstance(voice, CompiledVoice):
+            _use_voice(voices, voice.digest)
+            voices[voice.digest] = voice
+            request = replace(request, voice=voice)
+        elif voice is not None:
+            if voices.get(voice) is None:
+                # Out of step with the parent; without its voice the audio would be wrong
+                results.put(("error", index, job_id, f"RuntimeError: Worker does not have voice {voice}"))
+                continue
+            _use_voice(voices, voice)
+            request = replace(request, voice=voices[voice])
+        if stream_audio:
+            streaming.add(job_id)
+        if isinstance(request, VoiceRequest):
+            future = scheduler.compile_voice(request)
+        else:
+            future = scheduler.submit(
+                request,
+                on_progress=partial(progress, job_id) if report_progress else None,
+                on_audio=partial(audio, job_id) if stream_audio else None,
+            )
+        future.add_done_callback(partial(finished, job_id))
+    scheduler.close()
+
+
+class WorkerPool:
+    """
+    ``BatchScheduler`` spread over several processes.
+
+    Each of the ``n_workers`` processes loads the model once and runs its
+    own BatchScheduler. Requests wait in one queue in this process and are
+    handed to the ready worker with the fewest active requests, never more
+    than ``max_batch_size`` per worker, so a busy worker does not hoard work
+    another one could start on.
+
+    A worker that exits is started again, after a delay that doubles with
+    every restart in a row that has not loaded the model (up to
+    ``MAX_RESTART_DELAY``), so a worker that cannot load it does not spin
+    but one that crashed after loading is back quickly. The requests it was
+    running are queued again, up to ``MAX_ATTEMPTS`` times, after which they
+    fail with a ``RuntimeError``, so a request that crashes workers cannot
+    loop forever.
+
+    Streaming requests are never retried, since part of their audio has
+    already been handed out.
+
+    Same interface as ``BatchScheduler``, except that results and streamed
+    chunks are NumPy arrays, as they cross a process boundary. For the same
+    reason a request's compiled voice is copied to the worker, the first
+    time it goes there; each worker keeps the ``MAX_WORKER_VOICES`` most
+    recently used, which later requests name by digest.
+    """
+
+    def __init__(
+        self,
+        n_workers: int,
+        *,
+        model_path: Optional[str] = None,
+        max_batch_size: int = 8,
+        poll_interval: float = 1.0,
+    ):
+        self.model_path = model_path
+        self.max_batch_size = max_batch_size
+        self.poll_interval = poll_interval
+
+        # Spawn rather than fork: MLX state must not be shared with the children
+        self._context = multiprocessing.get_context("spawn")
+        self._results = self._context.Queue()
+        self._jobs: dict[str, _Job] = {}
+        self._queue: deque[str] = deque()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._workers = [self._start(index) for index in range(n_workers)]
+        self._threads = [
+            threading.Thread(target=target, name=name, daemon=True)
+            for target, name in (
+                (self._collect, "csm-pool-collector"),
+                (self._monitor, "csm-pool-monitor"),
+            )
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _start(self, index: int, restarts: int = 0, crashes: int = 0) -> _Worker:
+        inbox = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, self.model_path, self.max_batch_size, inbox, self._results),
+            name=f"csm-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        return _Worker(index, process, inbox, time.time(), restarts=restarts, crashes=crashes)
+
+    def submit(
+        self,
+        request: SpeechRequest,
+        on_progress: Optional[ProgressCallback] = None,
+        on_audio: Optional[AudioCallback] = None,
+    ) -> Future:
+        """
+        Queue ``request``; the future resolves to its audio as a NumPy array.
+
+        ``on_progress(frames, max_frames)`` is called from this process on the
+        first frame and every ``PROGRESS_FRAMES`` frames, and ``on_audio(chunk)``
+        with every chunk as in ``BatchScheduler.submit``; a worker stops the
+        request soon after ``on_audio`` returns False. Both must be quick and
+        must not raise.
+        """
+        return self._enqueue(_Job(request, Future(), on_progress, on_audio))
+
+    def compile_voice(self, request: VoiceRequest) -> Future:
+        """Queue ``request`` for a worker; the future resolves to its ``CompiledVoice``."""
+        return self._enqueue(_Job(request, Future()))
+
+    def _enqueue(self, job: _Job) -> Future:
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("WorkerPool is closed")
+            self._jobs[job_id] = job
+            self._queue.append(job_id)
+            self._dispatch()
+        return job.future
+
+    def generate(self, request: SpeechRequest, timeout: Optional[float] = None) -> np.ndarray:
+        """``submit`` and wait for the audio."""
+        return self.submit(request).result(timeout)
+
+    @property
+    def ready(self) -> bool:
+        """Whether at least one worker has loaded the model."""
+        with self._lock:
+            return any(worker.ready for worker in self._workers)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "active": sum(len(worker.active) for worker in self._workers),
+                "queued": len(self._queue),
+                "ready": sum(worker.ready for worker in self._workers),
+                "workers": [
+                    {
+                        "index": worker.index,
+                        "pid": worker.process.pid,
+                        "alive": worker.process.is_alive(),
+                        "exit_code": worker.process.exitcode,
+                        "ready": worker.ready,
+                        "active": len(worker.active),
+                        "restarts": worker.restarts,
+                        "uptime": time.time() - worker.started_at,
+                    }
+                    for worker in self._workers
+                ],
+            }
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Let the workers finish what they are running, then stop them."""
+        with self._lock:
+            self._closed = True
+            queued = [self._jobs.pop(job_id, None) for job_id in self._queue]
+            self._queue.clear()
+            for worker in self._workers:
+                worker.inbox.put(None)
+        for job in queued:
+            if job is not None:
+                job.future.set_exception(RuntimeError("WorkerPool is closed"))
+        for worker in self._workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+    def _dispatch(self) -> None:
+        # Called with the lock held
+        while self._queue:
+            idle = [
+                worker
+                for worker in self._workers
+                if worker.ready and len(worker.active) < self.max_batch_size
+            ]
+            if not idle:
+                return
+            worker = min(idle, key=lambda worker: len(worker.active))
+            job_id = self._queue.popleft()
+            job = self._jobs.get(job_id)
+            if job is None:
+                continue  # already answered by a worker that exited since
+            if job.attempts == 0 and not job.future.set_running_or_notify_cancel():
+                del self._jobs[job_id]
+                continue  # cancelled while queued
+            job.attempts += 1
+            worker.active.add(job_id)
+            # A voice is sent by its digest alone once the worker has it
+            request, voice = job.request, getattr(job.request, "voice", None)
+            if voice is not None:
+                request = replace(request, voice=None)
+                if _use_voice(worker.voices, voice.digest):
+                    voice = voice.digest
+            worker.inbox.put(
+                (
+                    "run",
+                    job_id,
+                    request,
+                    voice,
+                    job.on_progress is not None,
+                    job.on_audio is not None,
+                )
+            )
+
+    def _collect(self) -> None:
+        while True:
+            try:
+                message = self._results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if self._closed:
+                    return
+                continue
+
+            kind, index, *payload = message
+            # Run once the lock is released: callbacks may call back into the
+            # pool, and resolving a future runs its done callbacks
+            action: Optional[Callable[[], Any]] = None
+            on_audio: Optional[AudioCallback] = None
+            with self._lock:
+                worker = self._workers[index]
+                if kind == "ready":
+                    pid, _ = payload
+                    # Not a late message from a process that has been replaced
+                    if pid == worker.process.pid:
+                        worker.ready = True
+                        worker.crashes = 0
+                elif kind == "progress":
+                    job_id, (frames, max_frames) = payload
+                    job = self._jobs.get(job_id)
+                    if job is not None and job.on_progress is not None:
+                        action = partial(job.on_progress, frames, max_frames)
+                elif kind == "audio":
+                    job_id, chunk = payload
+                    job = self._jobs.get(job_id)
+                    if job is not None:
+                        on_audio = job.on_audio
+                else:
+                    job_id, result = payload
+                    worker.active.discard(job_id)
+                    job = self._jobs.pop(job_id, None)
+                    if job is not None:
+                        if kind == "done":
+                            action = partial(job.future.set_result, result)
+                        else:
+                            action = partial(job.future.set_exception, RuntimeError(result))
+                self._dispatch()
+
+            if action is not None:
+                action()
+            if on_audio is not None and not on_audio(chunk):
+                with self._lock:
+                    job.on_audio = None
+                    worker.inbox.put(("cancel", job_id))
+
+    def _monitor(self) -> None:
+        while not self._closed:
+            time.sleep(self.poll_interval)
+            failed: list[tuple[_Job, Exception]] = []
+            with self._lock:
+                if self._closed:
+                    return
+                for worker in list(self._workers):
+                    if worker.process.is_alive():
+                        continue
+                    if worker.exited_at is None:
+                        failed += self._requeue(worker)
+                    delay = min(MAX_RESTART_DELAY, 0.5 * 2**worker.crashes)
+                    if time.time() - worker.exited_at >= delay:
+                        self._workers[worker.index] = self._start(
+                            worker.index, worker.restarts + 1, worker.crashes + 1
+                        )
+                self._dispatch()
+            # Outside the lock, as failing a future runs its done callbacks
+            for job, error in failed:
+                job.future.set_exception(error)
+
+    def _requeue(self, worker: _Worker) -> list[tuple[_Job, Exception]]:
+        # Called with the lock held, once the worker has exited. Returns the
+        # jobs that are not retried, for the caller to fail without the lock.
+        worker.exited_at = time.time()
+        worker.ready = False
+        failed: list[tuple[_Job, Exception]] = []
+        for job_id in worker.active:
+            job = self._jobs.get(job_id)
+            if job is None:
+                continue
+            if job.on_audio is not None:
+                del self._jobs[job_id]
+                failed.append((job, RuntimeError("Worker crashed while streaming this request")))
+            elif job.attempts >= MAX_ATTEMPTS:
+                del self._jobs[job_id]
+                failed.append(
+                    (job, RuntimeError(f"Worker crashed {job.attempts} times while running this request"))
+                )
+            else:
+                self._queue.appendleft(job_id)
+        worker.active.clear()
+        return failed
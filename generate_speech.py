@@ -6,32 +6,31 @@ This script generates speech from text using the CSM model for Apple Silicon wit
 
 Usage:
     python generate_speech.py --text "Your text here" --output output.wav --temp 0.5 --speaker 0 --max_duration 10000
+    python generate_speech.py --manifest corpus.jsonl --output-dir outputs/corpus --workers 2
 """
 
 import argparse
+import csv
+import json
+import multiprocessing
 import os
+import queue
+import re
 import time
-import numpy as np
-import torch
-import torchaudio
-import audiofile
+import mlx.core as mx
 from mlx_lm.sample_utils import make_sampler
-from huggingface_hub import hf_hub_download
-from csm_mlx import CSM, csm_1b, generate
+from csm_mlx import KVCachePolicy, generate, load_csm, write_audio
+from csm_mlx.loading import peak_rss_bytes
 
-def generate_speech(text, output_path, temperature=0.5, min_p=0.1, speaker=0, max_duration=10000):
+def generate_speech(text, output_path, temperature=0.5, min_p=0.1, speaker=0, max_duration=10000, model_path=None, kv_cache=None):
     """Generate speech from text using the CSM model."""
     start_time = time.time()
     
-    # Initialize the model
-    print("Initializing CSM model...")
-    csm = CSM(csm_1b())
-    
-    # Download and load weights
-    print("Loading model weights...")
-    weight = hf_hub_download(repo_id="senstella/csm-1b-mlx", filename="ckpt.safetensors")
-    csm.load_weights(weight)
-    print(f"Model loaded in {time.time() - start_time:.2f} seconds")
+    # A checkpoint file, a directory written by quantize_csm.py, or the default checkpoint.
+    # Weights are read on first use, so the generation time below includes reading them.
+    print(f"Loading model from {model_path or 'the default checkpoint'}...")
+    csm, load_stats = load_csm(model_path, lazy=True)
+    print(f"Model loaded in {load_stats}")
     
     # Generate audio from text
     print(f"Generating speech for: '{text}'")
@@ -44,16 +43,19 @@ def generate_speech(text, output_path, temperature=0.5, min_p=0.1, speaker=0, ma
         context=[],
         max_audio_length_ms=max_duration,
         sampler=make_sampler(temp=temperature, min_p=min_p),
+        kv_cache=kv_cache,
     )
     
     gen_time = time.time() - gen_start
     print(f"Speech generated in {gen_time:.2f} seconds")
+    print(f"Time to audio from start: {time.time() - start_time:.2f} seconds, "
+          f"peak RSS {peak_rss_bytes() / 2**20:.0f} MiB")
     
     # Create output directory if needed
     os.makedirs(os.path.dirname(os.path.abspath(output_path)) or '.', exist_ok=True)
     
-    # Save the generated audio
-    torchaudio.save(output_path, torch.Tensor(np.asarray(audio)).unsqueeze(0).cpu(), 24_000)
+    # Save the generated audio (16-bit WAV, or FLAC for a .flac path)
+    write_audio(output_path, audio)
     
     # Calculate audio duration
     audio_duration = len(audio) / 24000  # 24kHz sample rate
@@ -62,17 +64,225 @@ def generate_speech(text, output_path, temperature=0.5, min_p=0.1, speaker=0, ma
     print(f"Audio duration: {audio_duration:.2f} seconds")
     print(f"Real-time factor: {gen_time / audio_duration:.2f}x")
 
+# Manifest columns besides id and text; missing ones fall back to the command-line values
+MANIFEST_FIELDS = {
+    "speaker": int,
+    "temperature": float,
+    "min_p": float,
+    "max_duration": int,
+    "seed": int,
+}
+SAFE_ID = re.compile(r"[A-Za-z0-9_][A-Za-z0-9_.-]*")
+
+def read_manifest(path, defaults):
+    """
+    Read a JSONL or CSV manifest (by extension) into a list of items.
+
+    Every row needs `id` and `text`. `speaker`, `temperature`, `min_p`,
+    `max_duration` and `seed` are optional and default to `defaults`.
+    The id names the output file, so it must be unique and file-name safe.
+    """
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    items = []
+    seen = set()
+    for number, row in enumerate(rows, 1):
+        item_id, text = str(row.get("id") or ""), row.get("text")
+        if not SAFE_ID.fullmatch(item_id):
+            raise ValueError(f"Row {number}: id {item_id!r} is missing or not a safe file name")
+        if item_id in seen:
+            raise ValueError(f"Row {number}: duplicate id {item_id!r}")
+        if not text:
+            raise ValueError(f"Row {number}: missing text")
+        seen.add(item_id)
+
+        item = {"id": item_id, "text": text}
+        for field, cast in MANIFEST_FIELDS.items():
+            value = row.get(field)
+            item[field] = cast(value) if value not in (None, "") else defaults[field]
+        items.append(item)
+    return items
+
+def read_ledger(path):
+    """Ids already completed according to the ledger, skipping a torn last line"""
+    done = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["id"])
+                except (ValueError, KeyError):
+                    continue
+    return done
+
+def corpus_worker(worker_index, model_path, kv_cache, output_dir, tasks, results, audio_format="wav"):
+    """Load the model once, then synthesize manifest items until a None task"""
+    csm, load_stats = load_csm(model_path)
+    results.put({"worker": worker_index, "loaded": load_stats.seconds})
+
+    while (item := tasks.get()) is not None:
+        try:
+            if item["seed"] is not None:
+                mx.random.seed(item["seed"])
+            start_time = time.time()
+            audio = generate(
+                csm,
+                text=item["text"],
+                speaker=item["speaker"],
+                context=[],
+                max_audio_length_ms=item["max_duration"],
+                sampler=make_sampler(temp=item["temperature"], min_p=item["min_p"]),
+                kv_cache=kv_cache,
+            )
+            mx.eval(audio)
+            generation_time = time.time() - start_time
+
+            # Write under a temporary name so an interrupted run never leaves a truncated file
+            path = os.path.join(output_dir, f"{item['id']}.{audio_format}")
+            partial = f"{path}.partial"
+            write_audio(partial, audio, format=audio_format)
+            os.replace(partial, path)
+
+            results.put({
+                "id": item["id"],
+                "path": path,
+                "audio_seconds": len(audio) / 24000,
+                "generation_seconds": generation_time,
+                "worker": worker_index,
+            })
+        except Exception as e:
+            results.put({"id": item["id"], "error": str(e), "worker": worker_index})
+
+def synthesize_corpus(manifest, output_dir, workers=1, model_path=None, kv_cache=None, defaults=None,
+                      audio_format="wav"):
+    """
+    Synthesize every manifest item into `output_dir/<id>.<audio_format>`.
+
+    Each of the `workers` processes loads the model once and pulls items from
+    a shared queue, so long and short items balance across workers. Finished
+    items are appended to `output_dir/ledger.jsonl` by this process only, and
+    a rerun skips every id in the ledger. Failed items are not recorded and
+    are retried on the next run.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    ledger_path = os.path.join(output_dir, "ledger.jsonl")
+
+    items = read_manifest(manifest, defaults)
+    done = read_ledger(ledger_path)
+    pending = [item for item in items if item["id"] not in done]
+    print(f"{len(items)} items in manifest, {len(items) - len(pending)} already done, {len(pending)} to synthesize")
+    if not pending:
+        return
+
+    # Spawn rather than fork: MLX state must not be shared with the children
+    context = multiprocessing.get_context("spawn")
+    tasks, results = context.Queue(), context.Queue()
+    for item in pending:
+        tasks.put(item)
+    workers = max(1, min(workers, len(pending)))
+    for _ in range(workers):
+        tasks.put(None)
+
+    processes = [
+        context.Process(
+            target=corpus_worker,
+            args=(index, model_path, kv_cache, output_dir, tasks, results, audio_format),
+            daemon=True,
+        )
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    start_time = time.time()
+    completed = failed = 0
+    audio_seconds = generation_seconds = 0.0
+    with open(ledger_path, "a") as ledger:
+        while completed + failed < len(pending):
+            try:
+                result = results.get(timeout=1.0)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    print("All workers exited before the manifest was finished; rerun to resume")
+                    break
+                continue
+
+            if "loaded" in result:
+                print(f"Worker {result['worker']} loaded the model in {result['loaded']:.2f} seconds")
+                continue
+            if "error" in result:
+                failed += 1
+                print(f"[{completed + failed}/{len(pending)}] {result['id']} failed: {result['error']}")
+                continue
+
+            ledger.write(json.dumps(result) + "\n")
+            ledger.flush()
+            completed += 1
+            audio_seconds += result["audio_seconds"]
+            generation_seconds += result["generation_seconds"]
+            print(f"[{completed + failed}/{len(pending)}] {result['id']}: {result['audio_seconds']:.2f}s of audio "
+                  f"in {result['generation_seconds']:.2f}s (worker {result['worker']})")
+
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+    wall_time = time.time() - start_time
+    print(f"Synthesized {completed} items ({audio_seconds:.1f}s of audio) in {wall_time:.1f}s, {failed} failed")
+    if audio_seconds:
+        print(f"Real-time factor: {generation_seconds / audio_seconds:.2f}x per worker, "
+              f"{wall_time / audio_seconds:.2f}x aggregate over {workers} workers")
+
 def main():
     parser = argparse.ArgumentParser(description="Generate speech using CSM model")
-    parser.add_argument("--text", "-t", type=str, required=True, help="Text to convert to speech")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--text", "-t", type=str, help="Text to convert to speech")
+    source.add_argument("--manifest", type=str,
+                       help="JSONL or CSV manifest with id, text and optional speaker, temperature, min_p, max_duration, seed")
     parser.add_argument("--output", "-o", type=str, default="output.wav", help="Output audio file path")
     parser.add_argument("--temp", type=float, default=0.5, help="Temperature for sampling (higher = more variation)")
     parser.add_argument("--min_p", type=float, default=0.1, help="Minimum probability for sampling")
     parser.add_argument("--speaker", "-s", type=int, default=0, help="Speaker ID (0, 1, 2, etc.)")
     parser.add_argument("--max_duration", "-d", type=int, default=10000, 
                        help="Maximum audio duration in milliseconds")
+    parser.add_argument("--model", "-m", type=str, default=None,
+                       help="Checkpoint file, or quantized model directory written by quantize_csm.py")
+    parser.add_argument("--kv-cache", type=str, default="full",
+                       help="Backbone KV cache: full, q8, q4 or window:<max_size>[:<keep>]")
+    parser.add_argument("--output-dir", type=str, default="outputs/corpus",
+                       help="Output directory and ledger location for --manifest")
+    parser.add_argument("--workers", type=int, default=1,
+                       help="Worker processes for --manifest, each loading its own model")
+    parser.add_argument("--seed", type=int, default=None, help="Default random seed for manifest items")
+    parser.add_argument("--format", type=str, choices=["wav", "flac"], default="wav",
+                        help="Audio format of manifest items (FLAC needs soundfile)")
     
     args = parser.parse_args()
+    try:
+        kv_cache = KVCachePolicy.from_string(args.kv_cache)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    if args.manifest:
+        defaults = {
+            "speaker": args.speaker,
+            "temperature": args.temp,
+            "min_p": args.min_p,
+            "max_duration": args.max_duration,
+            "seed": args.seed,
+        }
+        try:
+            synthesize_corpus(args.manifest, args.output_dir, workers=args.workers,
+                              model_path=args.model, kv_cache=kv_cache, defaults=defaults,
+                              audio_format=args.format)
+        except ValueError as e:
+            parser.error(f"{args.manifest}: {e}")
+        return
     
     generate_speech(
         args.text, 
@@ -80,7 +290,9 @@ def main():
         temperature=args.temp, 
         min_p=args.min_p,
         speaker=args.speaker,
-        max_duration=args.max_duration
+        max_duration=args.max_duration,
+        model_path=args.model,
+        kv_cache=kv_cache
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Quantize CSM weights and check the result against the full-precision model
+
+Writes a directory that csm_mlx.load_quantized (or `generate_speech.py --model`)
+can load, and reports parameter memory, generation speed and how
+often the quantized model predicts the same codes as the original.
+
+Usage:
+    python quantize_csm.py --output csm-1b-4bit --bits 4
+    python quantize_csm.py --output csm-1b-mixed --bits 4 --module-bits backbone=8 audio_head=8 codebook0_head=none
+"""
+
+import argparse
+import time
+
+import mlx.core as mx
+
+from csm_mlx import load_csm, quantize_model, save_quantized
+from csm_mlx.generation import generate_codes
+from csm_mlx.quantization import MODULE_GROUPS, parameter_bytes, teacher_forced_codes
+
+DEFAULT_TEXTS = [
+    "Hello! This is a test of the Conversation Speech Model running on Apple Silicon with MLX.",
+    "The quick brown fox jumps over the lazy dog, then takes a long nap in the afternoon sun.",
+]
+
+
+def parse_module_bits(values):
+    """Parse `name=bits` pairs; `none` keeps a group in full precision"""
+    module_bits = {}
+    for value in values or []:
+        name, _, bits = value.partition("=")
+        if name not in MODULE_GROUPS:
+            raise ValueError(
+                f"Unknown module group '{name}', expected one of {', '.join(MODULE_GROUPS)}"
+            )
+        module_bits[name] = None if bits.lower() == "none" else int(bits)
+    return module_bits
+
+
+def time_generation(model, texts, speaker, max_duration):
+    """Greedy codes for every text, and the frames per second it took"""
+    codes = []
+    total_time = 0.0
+    total_frames = 0
+    for text in texts:
+        start_time = time.time()
+        frames = generate_codes(model, text, speaker, [], max_duration)
+        mx.eval(frames)
+        total_time += time.time() - start_time
+        total_frames += frames.shape[2]
+        codes.append(frames)
+    return codes, total_frames / max(total_time, 1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize CSM weights")
+    parser.add_argument("--output", "-o", type=str, required=True, help="Directory to write the quantized model to")
+    parser.add_argument("--bits", type=int, default=4, choices=[2, 3, 4, 6, 8], help="Default bit width")
+    parser.add_argument("--group_size", type=int, default=64, choices=[32, 64, 128], help="Quantization group size")
+    parser.add_argument("--module-bits", type=str, nargs="*", default=[],
+                        help=f"Per-group bit widths as name=bits, groups: {', '.join(MODULE_GROUPS)}")
+    parser.add_argument("--text", "-t", type=str, action="append", help="Text for the accuracy check (repeatable)")
+    parser.add_argument("--speaker", "-s", type=int, default=0, help="Speaker ID")
+    parser.add_argument("--max_duration", "-d", type=int, default=5000,
+                        help="Maximum audio duration in milliseconds for the accuracy check")
+    parser.add_argument("--skip-check", action="store_true", help="Only quantize and save")
+
+    args = parser.parse_args()
+    texts = args.text or DEFAULT_TEXTS
+    try:
+        module_bits = parse_module_bits(args.module_bits)
+    except ValueError as e:
+        parser.error(str(e))
+
+    print("Initializing CSM model...")
+    model, _ = load_csm()
+    full_bytes = parameter_bytes(model)
+
+    if not args.skip_check:
+        print("Generating full-precision reference codes...")
+        generate_codes(model, texts[0], args.speaker, [], 400)  # warm up
+        references, full_speed = time_generation(model, texts, args.speaker, args.max_duration)
+
+    print("Quantizing...")
+    quantization = quantize_model(model, group_size=args.group_size, bits=args.bits, module_bits=module_bits)
+    mx.eval(model.parameters())
+    quantized_bytes = parameter_bytes(model)
+
+    save_quantized(model, args.output, quantization)
+    print(f"Quantized model saved to {args.output}")
+
+    print()
+    for name in MODULE_GROUPS:
+        bits = quantization["module_bits"][name]
+        print(f"  {name:<18} {bits if bits is not None else 'full'}")
+    print(f"Parameters: {full_bytes / 2**20:.0f} MiB -> {quantized_bytes / 2**20:.0f} MiB "
+          f"({full_bytes / quantized_bytes:.2f}x smaller)")
+
+    if args.skip_check:
+        return
+
+    generate_codes(model, texts[0], args.speaker, [], 400)  # warm up
+    _, quantized_speed = time_generation(model, texts, args.speaker, args.max_duration)
+    print(f"Speed: {full_speed:.1f} -> {quantized_speed:.1f} frames/s "
+          f"({quantized_speed / full_speed:.2f}x), {quantized_speed * model.n_audio_codebooks:.0f} audio tokens/s")
+
+    matches = codebook0_matches = total = total_frames = 0
+    for text, reference in zip(texts, references):
+        if reference.shape[2] == 0:
+            continue
+        predicted = teacher_forced_codes(model, text, args.speaker, reference)
+        agreement = predicted == reference
+        matches += agreement.sum().item()
+        codebook0_matches += agreement[:, 0].sum().item()
+        total += agreement.size
+        total_frames += reference.shape[2]
+
+    print(f"Code agreement (teacher-forced, greedy): {100 * matches / max(total, 1):.1f}% of codes, "
+          f"{100 * codebook0_matches / max(total_frames, 1):.1f}% of codebook-0 codes "
+          f"over {total_frames} frames")
+
+
+if __name__ == "__main__":
+    main()
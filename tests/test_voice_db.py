@@ -0,0 +1,194 @@
+import json
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def voice_db(tmp_path, monkeypatch):
+    # The module opens its shared database in the working directory when first imported
+    monkeypatch.chdir(tmp_path)
+    import voice_db
+    return voice_db
+
+
+@pytest.fixture
+def db(voice_db, tmp_path):
+    db = voice_db.VoicePresetDB(str(tmp_path / "presets.db"))
+    yield db
+    db.close()
+
+
+def make_preset(voice_db, name, **fields):
+    return voice_db.VoicePreset(name=name, speaker_id=fields.pop('speaker_id', 0), temperature=0.9, min_p=0.05, **fields)
+
+
+def import_presets(db, created_at):
+    """Import a preset per created_at value; returns their IDs, in order"""
+    lines = [
+        json.dumps({'type': 'preset', 'id': index, 'name': f"p{index}", 'speaker_id': 0,
+                    'temperature': 0.9, 'min_p': 0.05, 'created_at': value})
+        for index, value in enumerate(created_at)
+    ]
+    before = db.get_preset_ids()
+    db.import_ndjson(lines)
+    return sorted(db.get_preset_ids() - before)
+
+
+def all_pages(list_page, limit):
+    items, cursors = [], []
+    cursor = None
+    while True:
+        page, cursor = list_page(limit=limit, cursor=cursor)
+        items += page
+        cursors.append(cursor)
+        if cursor is None:
+            return items, cursors
+
+
+def test_new_database_is_at_the_latest_version(voice_db, db):
+    with db._connection() as conn:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == len(voice_db.MIGRATIONS)
+
+
+def test_version_0_database_is_migrated_in_place(voice_db, tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    for statement in voice_db.MIGRATIONS[0]:
+        conn.execute(statement)
+    conn.execute("INSERT INTO voice_presets (name, speaker_id, temperature, min_p) VALUES ('old', 1, 0.8, 0.1)")
+    conn.execute("INSERT INTO voice_samples (preset_id, audio_path, text) VALUES (1, 'old.wav', 'hello')")
+    conn.commit()
+    conn.close()
+
+    db = voice_db.VoicePresetDB(path)
+    with db._connection() as conn:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == len(voice_db.MIGRATIONS)
+        indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'idx_voice_presets_created_at', 'idx_voice_presets_similar', 'idx_voice_samples_preset_id'} <= indexes
+    assert db.get_preset_by_id(1).name == 'old'
+    assert [sample['text'] for sample in db.get_voice_samples(1)] == ['hello']
+    db.close()
+
+    # Opening it again applies nothing
+    voice_db.VoicePresetDB(path).close()
+
+
+def test_pages_cover_every_preset_once_newest_first(db):
+    # Ties on created_at are ordered by ID
+    ids = import_presets(db, ['2024-01-01 00:00:00'] * 4 + ['2024-01-02 00:00:00'] * 3)
+
+    presets, cursors = all_pages(db.list_presets, limit=3)
+
+    assert [preset.id for preset in presets] == ids[4:][::-1] + ids[:4][::-1]
+    assert len(cursors) == 3
+
+
+def test_page_of_exactly_limit_rows_has_no_next_cursor(db):
+    import_presets(db, ['2024-01-01 00:00:00'] * 3)
+    presets, cursor = db.list_presets(limit=3)
+    assert len(presets) == 3
+    assert cursor is None
+
+
+def test_rows_added_meanwhile_do_not_shift_later_pages(voice_db, db):
+    ids = import_presets(db, ['2024-01-01 00:00:00'] * 6)
+
+    first, cursor = db.list_presets(limit=3)
+    db.create_preset(make_preset(voice_db, 'newer'))
+    second, _ = db.list_presets(limit=3, cursor=cursor)
+
+    assert [preset.id for preset in first + second] == ids[::-1]
+
+
+def test_invalid_cursor_is_a_value_error(voice_db, db):
+    wrong_id = voice_db.encode_cursor({'created_at': '2024-01-01 00:00:00', 'id': 'one'})
+    for cursor in ['not base64!', 'bm90IGpzb24=', wrong_id]:
+        with pytest.raises(ValueError):
+            db.list_presets(cursor=cursor)
+
+
+def test_sample_pages_are_of_one_preset(voice_db, db):
+    preset_id, other_id = db.create_presets([make_preset(voice_db, 'a'), make_preset(voice_db, 'b')])
+    db.add_voice_samples([(preset_id, f"{index}.wav", f"text {index}") for index in range(5)])
+    db.add_voice_sample(other_id, 'other.wav', 'other')
+
+    samples, _ = all_pages(lambda **page: db.list_voice_samples(preset_id, **page), limit=2)
+
+    assert [sample['audio_path'] for sample in samples] == [f"{index}.wav" for index in reversed(range(5))]
+
+
+def test_bulk_created_ids_match_their_presets(voice_db, db):
+    # IDs are not reused after the newest preset is deleted (AUTOINCREMENT)
+    first = db.create_presets([make_preset(voice_db, f"first {index}") for index in range(3)])
+    db.delete_preset(first[-1])
+
+    presets = [make_preset(voice_db, f"second {index}", speaker_id=index) for index in range(4)]
+    ids = db.create_presets(presets)
+
+    assert ids == list(range(first[-1] + 1, first[-1] + 5))
+    for preset_id, preset in zip(ids, presets):
+        stored = db.get_preset_by_id(preset_id)
+        assert (stored.name, stored.speaker_id) == (preset.name, preset.speaker_id)
+
+
+def test_bulk_create_with_samples(voice_db, db):
+    ids = db.create_presets(
+        [make_preset(voice_db, 'a'), make_preset(voice_db, 'b'), make_preset(voice_db, 'c')],
+        [(0, 'a.wav', 'for a'), (2, 'c.wav', 'for c')]
+    )
+    assert [[sample['audio_path'] for sample in db.get_voice_samples(preset_id)] for preset_id in ids] == [
+        ['a.wav'], [], ['c.wav']
+    ]
+
+
+def test_bulk_create_rolls_back_when_a_sample_fails(voice_db, db):
+    with pytest.raises(sqlite3.IntegrityError):
+        db.create_presets([make_preset(voice_db, 'a'), make_preset(voice_db, 'b')], [(1, 'b.wav', None)])
+    assert db.get_preset_ids() == set()
+
+
+def test_export_import_round_trip_remaps_ids(voice_db, db, tmp_path):
+    source = voice_db.VoicePresetDB(str(tmp_path / "source.db"))
+    ids = source.create_presets([make_preset(voice_db, 'a', seed='1'), make_preset(voice_db, 'b', description='second')])
+    source.add_voice_samples([(ids[0], 'a1.wav', 'one'), (ids[1], 'b.wav', 'two'), (ids[0], 'a2.wav', 'three')])
+    lines = list(source.export_ndjson())
+    source.close()
+
+    assert [json.loads(line)['type'] for line in lines] == ['preset'] * 2 + ['sample'] * 3
+
+    # Taken IDs in the target, so the imported presets get new ones
+    db.create_presets([make_preset(voice_db, 'existing') for _ in range(3)])
+    # batch_size=2 flushes mid-file, with samples of a preset from an earlier batch
+    counts = db.import_ndjson(lines, batch_size=2)
+
+    assert counts == {'presets': 2, 'samples': 3}
+    imported = {preset.name: preset for preset in db.get_all_presets() if preset.name != 'existing'}
+    assert sorted(preset.id for preset in imported.values()) == [4, 5]
+    assert (imported['a'].seed, imported['b'].description) == ('1', 'second')
+    assert sorted(sample['audio_path'] for sample in db.get_voice_samples(imported['a'].id)) == ['a1.wav', 'a2.wav']
+    assert [sample['text'] for sample in db.get_voice_samples(imported['b'].id)] == ['two']
+
+    # created_at comes across too
+    exported = {json.loads(line)['name']: json.loads(line) for line in lines[:2]}
+    assert imported['a'].created_at == exported['a']['created_at']
+
+
+@pytest.mark.parametrize('bad_line', [
+    '{"type": "preset", "id": 2, "name": "no speaker"}',
+    'not json',
+    '{"type": "unknown"}',
+    '{"type": "sample", "preset_id": 99, "audio_path": "x.wav", "text": "orphan"}',
+])
+def test_import_rolls_back_on_a_bad_line(db, bad_line):
+    lines = [
+        '{"type": "preset", "id": 1, "name": "good", "speaker_id": 0, "temperature": 0.9, "min_p": 0.05}',
+        '{"type": "sample", "preset_id": 1, "audio_path": "good.wav", "text": "fine"}',
+        '',
+        bad_line,
+    ]
+    with pytest.raises(ValueError, match='Line 4'):
+        db.import_ndjson(lines, batch_size=1)
+
+    assert db.get_preset_ids() == set()
+    assert db.get_sample_audio_paths() == set()
@@ -2,8 +2,11 @@
 Voice Preset Database - SQLite implementation for CSM-MLX
 """
 
+import base64
+import queue
 import sqlite3
 import os
+from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime
 import json
@@ -35,21 +38,12 @@ class VoicePreset:
             "description": self.description
         }
 
-class VoicePresetDB:
-    """SQLite database for voice presets"""
-    
-    def __init__(self, db_path="voice_presets.db"):
-        """Initialize database connection"""
-        self.db_path = db_path
-        self._init_db()
-    
-    def _init_db(self):
-        """Create tables if they don't exist"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Create voice_presets table
-        cursor.execute('''
+# Schema changes, applied in order to bring a database up to PRAGMA user_version = len(MIGRATIONS).
+# Databases created before versioning are at version 0 and already have the tables, hence IF NOT EXISTS.
+MIGRATIONS = [
+    # 1: the original tables
+    [
+        '''
         CREATE TABLE IF NOT EXISTS voice_presets (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -61,10 +55,9 @@ class VoicePresetDB:
             description TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-        ''')
-        
-        # Create voice_samples table to store sample audio for presets
-        cursor.execute('''
+        ''',
+        # Sample audio for presets
+        '''
         CREATE TABLE IF NOT EXISTS voice_samples (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             preset_id INTEGER NOT NULL,
@@ -73,222 +66,443 @@ class VoicePresetDB:
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (preset_id) REFERENCES voice_presets (id) ON DELETE CASCADE
         )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        ''',
+    ],
+    # 2: indexes for the preset list, a preset's samples (and the cascade on delete) and find_similar_preset
+    [
+        'CREATE INDEX IF NOT EXISTS idx_voice_presets_created_at ON voice_presets (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_voice_presets_similar ON voice_presets (speaker_id, temperature, min_p)',
+        'CREATE INDEX IF NOT EXISTS idx_voice_samples_preset_id ON voice_samples (preset_id, created_at)',
+    ],
+]
+
+def _row_to_preset(row):
+    """VoicePreset from a voice_presets row"""
+    return VoicePreset(
+        id=row['id'],
+        name=row['name'],
+        speaker_id=row['speaker_id'],
+        temperature=row['temperature'],
+        min_p=row['min_p'],
+        seed=row['seed'],
+        speed=row['speed'],
+        description=row['description'],
+        created_at=row['created_at']
+    )
+
+def _preset_values(preset):
+    """Values of a preset's columns, from name to description"""
+    return (
+        preset.name,
+        preset.speaker_id,
+        preset.temperature,
+        preset.min_p,
+        preset.seed,
+        preset.speed,
+        preset.description
+    )
+
+def encode_cursor(row):
+    """Opaque page cursor pointing just past a row, by (created_at, id)"""
+    return base64.urlsafe_b64encode(json.dumps([row['created_at'], row['id']]).encode()).decode()
+
+def decode_cursor(cursor):
+    """(created_at, id) from a page cursor; ValueError if it is malformed"""
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+    if not isinstance(row_id, int):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return created_at, row_id
+
+def _row_to_sample(row):
+    """Dictionary from a voice_samples row"""
+    return {
+        'id': row['id'],
+        'preset_id': row['preset_id'],
+        'audio_path': row['audio_path'],
+        'text': row['text'],
+        'created_at': row['created_at']
+    }
+
+class VoicePresetDB:
+    """
+    SQLite database for voice presets
+    
+    Connections are pooled rather than opened per call: each keeps its
+    prepared statements cached, runs in WAL mode (readers don't block the
+    writer) and enforces foreign keys. A connection serves one thread at a
+    time, and at most `pool_size` idle ones are kept.
+    """
+    
+    def __init__(self, db_path="voice_presets.db", pool_size=8):
+        """Initialize database connection"""
+        self.db_path = db_path
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._init_db()
+    
+    def _open(self):
+        """Open a configured connection"""
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode = WAL')
+        # Durable at every WAL checkpoint rather than every commit, which WAL makes safe
+        conn.execute('PRAGMA synchronous = NORMAL')
+        # Deleting a preset deletes its samples
+        conn.execute('PRAGMA foreign_keys = ON')
+        return conn
+    
+    @contextmanager
+    def _connection(self):
+        """A pooled connection; commits when the block succeeds and rolls back when it raises"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        try:
+            with conn:
+                yield conn
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+    
+    def close(self):
+        """Close the idle connections"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+    
+    def _init_db(self):
+        """Create the tables, or migrate an existing database to the current schema"""
+        with self._connection() as conn:
+            # One transaction, so a migration applies completely or not at all
+            conn.execute('BEGIN IMMEDIATE')
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {number}')
     
     def get_preset_by_id(self, preset_id):
         """Get a single preset by ID"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM voice_presets WHERE id = ?', (preset_id,))
-        row = cursor.fetchone()
-        
-        if not row:
-            conn.close()
-            return None
-        
-        preset = VoicePreset(
-            id=row['id'],
-            name=row['name'],
-            speaker_id=row['speaker_id'],
-            temperature=row['temperature'],
-            min_p=row['min_p'],
-            seed=row['seed'],
-            speed=row['speed'],
-            description=row['description'],
-            created_at=row['created_at']
-        )
-        
-        conn.close()
-        return preset
+        with self._connection() as conn:
+            row = conn.execute('SELECT * FROM voice_presets WHERE id = ?', (preset_id,)).fetchone()
+        return _row_to_preset(row) if row else None
     
     def get_all_presets(self):
         """Get all voice presets"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM voice_presets ORDER BY created_at DESC')
-        rows = cursor.fetchall()
-        
-        presets = []
-        for row in rows:
-            preset = VoicePreset(
-                id=row['id'],
-                name=row['name'],
-                speaker_id=row['speaker_id'],
-                temperature=row['temperature'],
-                min_p=row['min_p'],
-                seed=row['seed'],
-                speed=row['speed'],
-                description=row['description'],
-                created_at=row['created_at']
-            )
-            presets.append(preset)
-        
-        conn.close()
+        with self._connection() as conn:
+            rows = conn.execute('SELECT * FROM voice_presets ORDER BY created_at DESC').fetchall()
+        return [_row_to_preset(row) for row in rows]
+    
+    def get_preset_ids(self):
+        """IDs of every preset"""
+        with self._connection() as conn:
+            rows = conn.execute('SELECT id FROM voice_presets').fetchall()
+        return {row[0] for row in rows}
+    
+    def get_presets_by_ids(self, preset_ids):
+        """Presets by ID, as a dictionary; IDs that don't exist are left out"""
+        preset_ids = list(preset_ids)
+        presets = {}
+        with self._connection() as conn:
+            # In batches, within SQLite's limit on query parameters
+            for start in range(0, len(preset_ids), 500):
+                batch = preset_ids[start:start + 500]
+                rows = conn.execute(
+                    f'SELECT * FROM voice_presets WHERE id IN ({", ".join("?" * len(batch))})', batch
+                ).fetchall()
+                presets.update((row['id'], _row_to_preset(row)) for row in rows)
         return presets
     
+    def _page(self, conn, table, conditions, params, limit, cursor):
+        """
+        One page of rows, newest first, and the cursor of the next page (None
+        after the last one). Pages are keyed on (created_at, id), so each is
+        an index range scan however deep it is, and rows added meanwhile don't
+        shift later pages the way LIMIT/OFFSET would.
+        """
+        conditions = list(conditions)
+        params = list(params)
+        if cursor:
+            conditions.append('(created_at, id) < (?, ?)')
+            params.extend(decode_cursor(cursor))
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        rows = conn.execute(
+            f'SELECT * FROM {table} {where} ORDER BY created_at DESC, id DESC LIMIT ?',
+            (*params, limit + 1)
+        ).fetchall()
+        next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+        return rows[:limit], next_cursor
+    
+    def list_presets(self, limit=50, cursor=None):
+        """
+        A page of presets, newest first
+        
+        Returns:
+            The presets and the cursor of the next page, or None after the last one
+        """
+        with self._connection() as conn:
+            rows, next_cursor = self._page(conn, 'voice_presets', [], [], limit, cursor)
+        return [_row_to_preset(row) for row in rows], next_cursor
+    
     def create_preset(self, preset):
         """Create a new voice preset"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO voice_presets (name, speaker_id, temperature, min_p, seed, speed, description)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            preset.name,
-            preset.speaker_id,
-            preset.temperature,
-            preset.min_p,
-            preset.seed,
-            preset.speed,
-            preset.description
-        ))
-        
-        preset_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.execute('''
+            INSERT INTO voice_presets (name, speaker_id, temperature, min_p, seed, speed, description)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', _preset_values(preset))
+        return cursor.lastrowid
+    
+    def _insert_presets(self, conn, rows):
+        """
+        Insert preset rows (column values, then created_at or None for now)
+        with one statement and return their IDs. Runs in a write transaction,
+        so nothing else inserts meanwhile and the IDs are consecutive.
+        """
+        if not rows:
+            return []
+        conn.executemany('''
+        INSERT INTO voice_presets (name, speaker_id, temperature, min_p, seed, speed, description, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        ''', rows)
+        last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+    
+    def create_presets(self, presets, samples=()):
+        """
+        Create many presets in one transaction and return their IDs, in order
         
-        return preset_id
+        `samples` are (index in `presets`, audio_path, text) of voice samples
+        to add to the new presets, in the same transaction: if any insert
+        fails, no preset or sample is created.
+        """
+        with self._connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            preset_ids = self._insert_presets(conn, [(*_preset_values(preset), None) for preset in presets])
+            conn.executemany('''
+            INSERT INTO voice_samples (preset_id, audio_path, text)
+            VALUES (?, ?, ?)
+            ''', [(preset_ids[index], audio_path, text) for index, audio_path, text in samples])
+        return preset_ids
     
     def update_preset(self, preset):
         """Update an existing preset"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        UPDATE voice_presets 
-        SET name = ?, speaker_id = ?, temperature = ?, min_p = ?, seed = ?, speed = ?, description = ?
-        WHERE id = ?
-        ''', (
-            preset.name,
-            preset.speaker_id,
-            preset.temperature,
-            preset.min_p,
-            preset.seed,
-            preset.speed,
-            preset.description,
-            preset.id
-        ))
-        
-        success = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
-        
-        return success
+        with self._connection() as conn:
+            cursor = conn.execute('''
+            UPDATE voice_presets 
+            SET name = ?, speaker_id = ?, temperature = ?, min_p = ?, seed = ?, speed = ?, description = ?
+            WHERE id = ?
+            ''', (*_preset_values(preset), preset.id))
+        return cursor.rowcount > 0
+    
+    def update_presets(self, presets):
+        """Update many presets in one transaction and return how many existed"""
+        with self._connection() as conn:
+            cursor = conn.executemany('''
+            UPDATE voice_presets
+            SET name = ?, speaker_id = ?, temperature = ?, min_p = ?, seed = ?, speed = ?, description = ?
+            WHERE id = ?
+            ''', [(*_preset_values(preset), preset.id) for preset in presets])
+        return max(cursor.rowcount, 0)
     
     def delete_preset(self, preset_id):
-        """Delete a preset by ID"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Also delete related voice samples (cascade)
-        cursor.execute('DELETE FROM voice_presets WHERE id = ?', (preset_id,))
-        
-        success = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
-        
-        return success
+        """Delete a preset by ID, with its voice samples (cascade)"""
+        with self._connection() as conn:
+            cursor = conn.execute('DELETE FROM voice_presets WHERE id = ?', (preset_id,))
+        return cursor.rowcount > 0
     
     def add_voice_sample(self, preset_id, audio_path, text):
         """Add a sample audio for a voice preset"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO voice_samples (preset_id, audio_path, text)
-        VALUES (?, ?, ?)
-        ''', (preset_id, audio_path, text))
-        
-        sample_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        return sample_id
+        with self._connection() as conn:
+            cursor = conn.execute('''
+            INSERT INTO voice_samples (preset_id, audio_path, text)
+            VALUES (?, ?, ?)
+            ''', (preset_id, audio_path, text))
+        return cursor.lastrowid
     
     def get_voice_samples(self, preset_id):
         """Get all voice samples for a preset"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        with self._connection() as conn:
+            rows = conn.execute('''
+            SELECT * FROM voice_samples 
+            WHERE preset_id = ?
+            ORDER BY created_at DESC
+            ''', (preset_id,)).fetchall()
+        return [_row_to_sample(row) for row in rows]
+    
+    def get_reference_sample(self, preset_id):
+        """A preset's first voice sample, which its compiled voice is made from; None if it has none"""
+        with self._connection() as conn:
+            row = conn.execute('''
+            SELECT * FROM voice_samples
+            WHERE preset_id = ?
+            ORDER BY created_at, id
+            LIMIT 1
+            ''', (preset_id,)).fetchone()
+        return _row_to_sample(row) if row else None
+    
+    def list_voice_samples(self, preset_id, limit=50, cursor=None):
+        """A page of a preset's voice samples, newest first, and the cursor of the next page"""
+        with self._connection() as conn:
+            rows, next_cursor = self._page(conn, 'voice_samples', ['preset_id = ?'], [preset_id], limit, cursor)
+        return [_row_to_sample(row) for row in rows], next_cursor
+    
+    def add_voice_samples(self, samples):
+        """Add many (preset_id, audio_path, text) samples in one transaction and return how many"""
+        with self._connection() as conn:
+            cursor = conn.executemany('''
+            INSERT INTO voice_samples (preset_id, audio_path, text)
+            VALUES (?, ?, ?)
+            ''', samples)
+        return max(cursor.rowcount, 0)
+    
+    def export_ndjson(self):
+        """
+        Every preset, then every voice sample, as lines of newline-delimited
+        JSON with a "type" of "preset" or "sample"
+        
+        Rows are read as the lines are consumed, from one snapshot of the
+        database, so the export never holds the whole catalog in memory.
+        """
+        with self._connection() as conn:
+            # A read transaction: under WAL, a consistent snapshot that doesn't block writers
+            conn.execute('BEGIN')
+            for row in conn.execute('SELECT * FROM voice_presets ORDER BY id'):
+                yield json.dumps({'type': 'preset', **_row_to_preset(row).to_dict()}) + '\n'
+            for row in conn.execute('SELECT * FROM voice_samples ORDER BY id'):
+                yield json.dumps({'type': 'sample', **_row_to_sample(row)}) + '\n'
+    
+    def import_ndjson(self, lines, batch_size=1000):
+        """
+        Add the presets and samples in lines of `export_ndjson` output, in one
+        transaction: either all of them are imported or, if a line is
+        invalid, none are (ValueError)
+        
+        Presets get new IDs, and samples follow their preset to it. Rows are
+        inserted `batch_size` at a time with executemany.
         
-        cursor.execute('''
-        SELECT * FROM voice_samples 
-        WHERE preset_id = ?
-        ORDER BY created_at DESC
-        ''', (preset_id,))
+        Returns:
+            The number of presets and samples imported
+        """
+        presets = []  # (line number, exported ID, row values)
+        samples = []  # (line number, exported preset ID, audio_path, text, created_at)
+        new_ids = {}
+        counts = {'presets': 0, 'samples': 0}
         
-        samples = []
-        for row in cursor.fetchall():
-            sample = {
-                'id': row['id'],
-                'preset_id': row['preset_id'],
-                'audio_path': row['audio_path'],
-                'text': row['text'],
-                'created_at': row['created_at']
-            }
-            samples.append(sample)
+        def flush(conn):
+            # Presets first, so samples further down the batch can refer to them
+            ids = self._insert_presets(conn, [values for _, _, values in presets])
+            for (_, old_id, _), new_id in zip(presets, ids):
+                if old_id is not None:
+                    new_ids[old_id] = new_id
+            rows = []
+            for number, preset_id, *values in samples:
+                if preset_id not in new_ids:
+                    raise ValueError(f"Line {number}: sample of unknown preset {preset_id}")
+                rows.append((new_ids[preset_id], *values))
+            conn.executemany('''
+            INSERT INTO voice_samples (preset_id, audio_path, text, created_at)
+            VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+            ''', rows)
+            counts['presets'] += len(presets)
+            counts['samples'] += len(samples)
+            presets.clear()
+            samples.clear()
         
-        conn.close()
-        return samples
+        with self._connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for number, line in enumerate(lines, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    if record['type'] == 'preset':
+                        presets.append((number, record.get('id'), (
+                            str(record['name']),
+                            int(record['speaker_id']),
+                            float(record['temperature']),
+                            float(record['min_p']),
+                            record.get('seed'),
+                            float(record.get('speed') or 1.0),
+                            record.get('description'),
+                            record.get('created_at')
+                        )))
+                    elif record['type'] == 'sample':
+                        samples.append((
+                            number,
+                            record['preset_id'],
+                            str(record['audio_path']),
+                            str(record['text']),
+                            record.get('created_at')
+                        ))
+                    else:
+                        raise ValueError(f"unknown type {record['type']!r}")
+                except (ValueError, TypeError, KeyError) as e:
+                    raise ValueError(f"Line {number}: {e!r}") from e
+                
+                if len(presets) + len(samples) >= batch_size:
+                    flush(conn)
+            flush(conn)
+        return counts
+    
+    def get_sample_audio_paths(self):
+        """Audio paths of every voice sample"""
+        with self._connection() as conn:
+            rows = conn.execute('SELECT DISTINCT audio_path FROM voice_samples').fetchall()
+        return {row[0] for row in rows}
+    
+    def delete_orphan_samples(self, audio_exists):
+        """
+        Delete samples whose preset is gone (left over from before foreign keys
+        were enforced) or whose audio no longer passes `audio_exists(path)`
+        """
+        with self._connection() as conn:
+            cursor = conn.execute('DELETE FROM voice_samples WHERE preset_id NOT IN (SELECT id FROM voice_presets)')
+            deleted = cursor.rowcount
+            
+            rows = conn.execute('SELECT id, audio_path FROM voice_samples').fetchall()
+            missing = [(row[0],) for row in rows if not audio_exists(row[1])]
+            conn.executemany('DELETE FROM voice_samples WHERE id = ?', missing)
+            deleted += len(missing)
+        return deleted
     
     def find_similar_preset(self, speaker_id, temperature, min_p, seed=None):
         """Find presets with similar settings"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
         # Adjust temperature and min_p ranges for similarity
         temp_min = float(temperature) - 0.05
         temp_max = float(temperature) + 0.05
         minp_min = float(min_p) - 0.02
         minp_max = float(min_p) + 0.02
         
-        # Query for similar presets
-        if seed:
-            # If seed is provided, it must match exactly
-            cursor.execute('''
-            SELECT * FROM voice_presets 
-            WHERE speaker_id = ?
-            AND temperature BETWEEN ? AND ?
-            AND min_p BETWEEN ? AND ?
-            AND seed = ?
-            ORDER BY created_at DESC
-            ''', (speaker_id, temp_min, temp_max, minp_min, minp_max, seed))
-        else:
-            # If no seed, match by other parameters
-            cursor.execute('''
-            SELECT * FROM voice_presets 
-            WHERE speaker_id = ?
-            AND temperature BETWEEN ? AND ?
-            AND min_p BETWEEN ? AND ?
-            ORDER BY created_at DESC
-            ''', (speaker_id, temp_min, temp_max, minp_min, minp_max))
-        
-        presets = []
-        for row in cursor.fetchall():
-            preset = VoicePreset(
-                id=row['id'],
-                name=row['name'],
-                speaker_id=row['speaker_id'],
-                temperature=row['temperature'],
-                min_p=row['min_p'],
-                seed=row['seed'],
-                speed=row['speed'],
-                description=row['description'],
-                created_at=row['created_at']
-            )
-            presets.append(preset)
-        
-        conn.close()
-        return presets
+        with self._connection() as conn:
+            # Query for similar presets
+            if seed:
+                # If seed is provided, it must match exactly
+                rows = conn.execute('''
+                SELECT * FROM voice_presets 
+                WHERE speaker_id = ?
+                AND temperature BETWEEN ? AND ?
+                AND min_p BETWEEN ? AND ?
+                AND seed = ?
+                ORDER BY created_at DESC
+                ''', (speaker_id, temp_min, temp_max, minp_min, minp_max, seed)).fetchall()
+            else:
+                # If no seed, match by other parameters
+                rows = conn.execute('''
+                SELECT * FROM voice_presets 
+                WHERE speaker_id = ?
+                AND temperature BETWEEN ? AND ?
+                AND min_p BETWEEN ? AND ?
+                ORDER BY created_at DESC
+                ''', (speaker_id, temp_min, temp_max, minp_min, minp_max)).fetchall()
+        return [_row_to_preset(row) for row in rows]
 
 # Create a singleton instance
 db = VoicePresetDB()
\ No newline at end of file